@@ -26,6 +26,9 @@ setup(
         "transformers",
         "sentence_transformers",
     ],
+    extras_require={  # Optional: dependencies of optional features
+        "onnx": ["onnx", "onnxruntime"],
+    },
     long_description=long_description,  # Optional: the long description of the package
     long_description_content_type="text/markdown",  # Optional: the format of the long description
 )
@@ -1,5 +1,10 @@
 from .download import parse_download_string, download
 from .utils import *
-from .embed import embed
+from .embed import embed, embed_to_memmap, EmbeddingCache
 from .ner import ner, mask, ner_and_mask
-from .query import find_nearest_neighbours
\ No newline at end of file
+from .dedup import reprint_clusters
+from .query import find_nearest_neighbours, CorpusIndex, ShardedCorpusIndex, IncrementalCorpusIndex
+from .ner_mask_embed_query import search_same_story
+from .utils.query_cache import QueryCache
+from .pipeline import run_pipeline, stream_ner_mask_embed
+from .service import SearchService, serve
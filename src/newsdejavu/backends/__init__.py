@@ -0,0 +1 @@
+from .onnx_runtime import BACKENDS, onnx_token_classifier, onnx_sentence_model
@@ -0,0 +1,107 @@
+'''
+Throughput and parity benchmark of the inference backends.
+
+The same texts are masked and embedded with every backend, on CPU. The report gives the texts per second of NER and
+masking and of embedding for each backend, their speedup over eager PyTorch, the fraction of texts masked exactly as
+PyTorch masks them, and the lowest cosine similarity between an embedding and its PyTorch counterpart. The first call of
+each backend (which loads, and for ONNX may export, the model) is not timed.
+
+Can also be run as a script on a text file with one article per line:
+
+    python -m newsdejavu.backends.benchmark articles.txt --ner-model ner_model --sentence-model same_story_model
+'''
+
+import time
+import argparse
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+from ..ner import ner_and_mask
+from ..embed import embed
+from .onnx_runtime import BACKENDS, check_backend
+
+
+def best_time(function, repeats: int) -> float:
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+
+def backend_benchmark(texts: List[str], ner_model: str, sentence_model: str, backends: Sequence[str] = BACKENDS,
+                      batch_size: int = 32, repeats: int = 3) -> List[Dict]:
+    """
+    Measures NER and embedding throughput of each backend on CPU, and compares its outputs with those of PyTorch.
+
+    Args:
+        texts (List[str]): The texts to mask and embed.
+        ner_model (str): Path or identifier of the NER model.
+        sentence_model (str): Path or identifier of the sentence model.
+        backends (Sequence[str]): The backends to compare. PyTorch is always run first, as the reference. Defaults to
+            'torch', 'onnx' and 'onnx-int8'.
+        batch_size (int): Batch size of both models. Defaults to 32.
+        repeats (int): Number of timed runs per backend, of which the fastest is reported. Defaults to 3.
+
+    Returns:
+        List[Dict]: One row per backend with the 'backend', 'ner_texts_per_second', 'embed_texts_per_second',
+        'ner_speedup', 'embed_speedup', 'masked_text_agreement' and 'min_embedding_cosine'.
+    """
+    for backend in backends:
+        check_backend(backend)
+
+    results = []
+    reference = None
+    for backend in ['torch'] + [backend for backend in backends if backend != 'torch']:
+        def run_ner():
+            return ner_and_mask(texts, ner_model, batch_size = batch_size, torch_device = 'cpu', backend = backend)
+
+        masked_texts = run_ner()
+        ner_seconds = best_time(run_ner, repeats)
+
+        # Every backend embeds the texts as PyTorch masked them, so embedding times and outputs are comparable
+        embed_inputs = masked_texts if reference is None else reference[0]
+
+        def run_embed():
+            return embed(embed_inputs, sentence_model, batch_size = batch_size, device = 'cpu', backend = backend)
+
+        embeddings = run_embed()
+        embed_seconds = best_time(run_embed, repeats)
+
+        if reference is None:
+            reference = (masked_texts, embeddings, ner_seconds, embed_seconds)
+
+        if backend in backends:
+            results.append({'backend': backend,
+                            'ner_texts_per_second': len(texts) / ner_seconds,
+                            'embed_texts_per_second': len(texts) / embed_seconds,
+                            'ner_speedup': reference[2] / ner_seconds,
+                            'embed_speedup': reference[3] / embed_seconds,
+                            'masked_text_agreement': float(np.mean([masked == reference_masked for masked, reference_masked
+                                                                    in zip(masked_texts, reference[0])])),
+                            'min_embedding_cosine': float(np.min(np.sum(embeddings * reference[1], axis = 1)))})
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Compare the throughput and outputs of the inference backends.')
+    parser.add_argument('texts', help = 'Path to a text file with one article per line')
+    parser.add_argument('--ner-model', required = True)
+    parser.add_argument('--sentence-model', required = True)
+    parser.add_argument('--batch-size', type = int, default = 32)
+    parser.add_argument('--repeats', type = int, default = 3)
+    args = parser.parse_args()
+
+    with open(args.texts) as f:
+        texts = [line.strip() for line in f if line.strip()]
+
+    for row in backend_benchmark(texts, args.ner_model, args.sentence_model, batch_size = args.batch_size,
+                                 repeats = args.repeats):
+        print(f"{row['backend']:<10} NER {row['ner_texts_per_second']:8.1f} texts/s ({row['ner_speedup']:.2f}x)  "
+              f"embed {row['embed_texts_per_second']:8.1f} texts/s ({row['embed_speedup']:.2f}x)  "
+              f"masked text agreement {row['masked_text_agreement']:.4f}  "
+              f"min cosine {row['min_embedding_cosine']:.4f}")
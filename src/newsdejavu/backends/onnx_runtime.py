@@ -0,0 +1,213 @@
+'''
+ONNX Runtime inference backend for the NER and sentence models.
+
+On CPU-only machines, eager PyTorch leaves a lot of speed on the table. With backend = 'onnx' (or 'onnx-int8'), the
+transformer inside the token classification pipeline or the SentenceTransformer is exported once to an ONNX graph with
+torch.onnx (and its weights dynamically quantized to int8 for 'onnx-int8'), and is then run by ONNX Runtime. Only the
+transformer is replaced: tokenization, entity aggregation, pooling and normalization stay those of the PyTorch model,
+so the outputs can be used exactly like the PyTorch ones.
+
+Exported graphs are cached on disk, under ~/.cache/newsdejavu/onnx or the NEWSDEJAVU_ONNX_CACHE directory, keyed on the
+model (and the files of a local model directory), the graph kind, the quantization and the torch and transformers
+versions, so each model is only exported once.
+
+onnx and onnxruntime are optional dependencies (pip install newsdejavu[onnx]), imported only when an ONNX backend is
+used.
+'''
+
+import os
+import json
+import hashlib
+import inspect
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+import transformers
+from transformers.modeling_outputs import BaseModelOutput, TokenClassifierOutput
+
+BACKENDS = ('torch', 'onnx', 'onnx-int8')
+ONNX_OPSET = 17
+ONNX_CACHE_ENV = 'NEWSDEJAVU_ONNX_CACHE'
+DEFAULT_ONNX_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'newsdejavu', 'onnx')
+
+# Exports of the same graph from several threads are serialized
+export_lock = threading.Lock()
+
+
+def check_backend(backend: str):
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown backend {backend}, use one of {list(BACKENDS)}')
+
+
+def import_onnxruntime():
+    try:
+        import onnxruntime
+    except ImportError:
+        raise ImportError('The ONNX backends need onnx and onnxruntime: pip install onnx onnxruntime')
+    return onnxruntime
+
+
+def onnx_cache_dir(cache_dir: Optional[str] = None) -> str:
+    return cache_dir or os.environ.get(ONNX_CACHE_ENV) or DEFAULT_ONNX_CACHE
+
+
+def model_fingerprint(model_id: str) -> Dict:
+    """
+    Describes the model an ONNX graph is exported from. The files of a local model directory are included, so a model
+    retrained in place is exported again.
+    """
+    fingerprint = {'model': model_id, 'torch': torch.__version__, 'transformers': transformers.__version__,
+                   'opset': ONNX_OPSET}
+    if os.path.isdir(model_id):
+        files = {}
+        for directory, _, names in os.walk(model_id):
+            for name in names:
+                path = os.path.join(directory, name)
+                files[os.path.relpath(path, model_id)] = [os.path.getsize(path), os.path.getmtime(path)]
+        fingerprint['files'] = dict(sorted(files.items()))
+
+    return fingerprint
+
+
+class ExportedOutput(torch.nn.Module):
+    """
+    Calls a transformer with named inputs and returns a single output tensor, which is what the ONNX exporter traces.
+    """
+
+    def __init__(self, model: torch.nn.Module, input_names: List[str], output_name: str):
+        super().__init__()
+        self.model = model
+        self.input_names = input_names
+        self.output_name = output_name
+
+    def forward(self, *inputs: torch.Tensor) -> torch.Tensor:
+        return self.model(**dict(zip(self.input_names, inputs)), return_dict = True)[self.output_name]
+
+
+def export_onnx(model: torch.nn.Module, path: str, input_names: List[str], output_name: str):
+    """
+    Exports a transformer to an ONNX graph with dynamic batch and sequence dimensions.
+    """
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names + [output_name]}
+    dummy_inputs = tuple(torch.ones((2, 8), dtype = torch.long) for _ in input_names)
+    # torch 2.5 added the dynamo exporter (the default from 2.9), which does not take dynamic_axes. Older releases
+    # only have the TorchScript exporter and reject the dynamo keyword.
+    export_kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad():
+        torch.onnx.export(ExportedOutput(model.eval(), input_names, output_name), dummy_inputs, path,
+                          input_names = input_names, output_names = [output_name], dynamic_axes = dynamic_axes,
+                          opset_version = ONNX_OPSET, **export_kwargs)
+
+
+def cached_onnx_graph(model: torch.nn.Module, model_id: str, kind: str, input_names: List[str], output_name: str,
+                      quantize: bool, cache_dir: Optional[str] = None) -> str:
+    """
+    Returns the path of the ONNX graph of a model, exporting (and quantizing) it first if it is not cached yet.
+    """
+    fingerprint = {**model_fingerprint(model_id), 'kind': kind, 'inputs': input_names, 'quantize': quantize}
+    key = hashlib.sha256(json.dumps(fingerprint, sort_keys = True).encode('utf-8')).hexdigest()[:24]
+    directory = os.path.join(onnx_cache_dir(cache_dir), key)
+    path = os.path.join(directory, 'model_int8.onnx' if quantize else 'model.onnx')
+
+    with export_lock:
+        if os.path.exists(path):
+            return path
+
+        os.makedirs(directory, exist_ok = True)
+        import_onnxruntime()
+        temporary_path = f'{path}.{os.getpid()}.tmp'
+        export_onnx(model, temporary_path, input_names, output_name)
+        if quantize:
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+
+            quantized_path = f'{path}.{os.getpid()}.int8.tmp'
+            quantize_dynamic(temporary_path, quantized_path, weight_type = QuantType.QInt8)
+            os.remove(temporary_path)
+            temporary_path = quantized_path
+
+        # Written last, so a graph is only ever found complete
+        os.replace(temporary_path, path)
+        with open(os.path.join(directory, 'fingerprint.json'), 'w') as f:
+            json.dump(fingerprint, f, indent = 4)
+
+    return path
+
+
+class OnnxModel(torch.nn.Module):
+    """
+    Stands in for a transformers model inside a pipeline or SentenceTransformer, running an ONNX graph instead.
+    Takes and returns torch tensors, with the output under output_name like the model it replaces.
+    """
+
+    def __init__(self, path: str, config, output_name: str, num_threads: Optional[int] = None):
+        super().__init__()
+        onnxruntime = import_onnxruntime()
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = num_threads or torch.get_num_threads()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(path, options, providers = ['CPUExecutionProvider'])
+        self.input_names = [graph_input.name for graph_input in self.session.get_inputs()]
+        self.path = path
+        self.config = config
+        self.output_name = output_name
+
+    @property
+    def device(self) -> torch.device:
+        return torch.device('cpu')
+
+    @property
+    def dtype(self) -> torch.dtype:
+        return torch.float32
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: Optional[torch.Tensor] = None,
+                token_type_ids: Optional[torch.Tensor] = None, **kwargs):
+        inputs = {'input_ids': input_ids, 'attention_mask': attention_mask, 'token_type_ids': token_type_ids}
+        feed = {}
+        for name in self.input_names:
+            value = inputs[name]
+            if value is None:
+                value = torch.ones_like(input_ids) if name == 'attention_mask' else torch.zeros_like(input_ids)
+            feed[name] = value.detach().cpu().numpy().astype(np.int64)
+
+        output = torch.from_numpy(self.session.run([self.output_name], feed)[0])
+        if self.output_name == 'logits':
+            return TokenClassifierOutput(logits = output)
+        return BaseModelOutput(last_hidden_state = output)
+
+
+def graph_inputs(tokenizer) -> List[str]:
+    names = ['input_ids', 'attention_mask']
+    if 'token_type_ids' in tokenizer.model_input_names:
+        names.append('token_type_ids')
+    return names
+
+
+def onnx_token_classifier(token_classifier, model_id: str, quantize: bool = False, cache_dir: Optional[str] = None):
+    """
+    Replaces the model of a CPU token classification pipeline with its ONNX graph, and returns the pipeline.
+    """
+    model = token_classifier.model
+    path = cached_onnx_graph(model, model_id, 'token_classification', graph_inputs(token_classifier.tokenizer),
+                             'logits', quantize, cache_dir)
+    token_classifier.model = OnnxModel(path, model.config, 'logits')
+
+    return token_classifier
+
+
+def onnx_sentence_model(sentence_model, model_id: str, quantize: bool = False, cache_dir: Optional[str] = None):
+    """
+    Replaces the transformer of a CPU SentenceTransformer with its ONNX graph, and returns the SentenceTransformer.
+    """
+    transformer = sentence_model[0]
+    # Older sentence-transformers releases hold the transformer in auto_model
+    attribute = 'model' if isinstance(getattr(transformer, 'model', None), torch.nn.Module) else 'auto_model'
+    model = getattr(transformer, attribute)
+
+    path = cached_onnx_graph(model, model_id, 'feature_extraction', graph_inputs(transformer.tokenizer),
+                             'last_hidden_state', quantize, cache_dir)
+    setattr(transformer, attribute, OnnxModel(path, model.config, 'last_hidden_state'))
+
+    return sentence_model
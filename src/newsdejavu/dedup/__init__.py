@@ -0,0 +1 @@
+from .minhash import reprint_clusters, ReprintClusters
@@ -0,0 +1,159 @@
+'''
+Reprint detection with MinHash and locality-sensitive hashing.
+
+Newspapers reprinted wire stories many times, with small differences in OCR noise, headlines and cuts. Each text is
+reduced to the set of its word shingles (runs of consecutive words of the cleaned, lowercased text), and the Jaccard
+similarity of two texts' shingle sets is estimated by the fraction of agreeing entries in their MinHash signatures.
+LSH splits the signatures into bands and only compares texts that agree on a whole band, so clustering takes time
+linear in the corpus size instead of quadratic. Candidate pairs are kept if their estimated similarity reaches the
+threshold, and reprint clusters are the connected components of the kept pairs.
+'''
+
+import re
+import zlib
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+from ..utils.clean_text import clean_text
+
+WORD_REGEX = re.compile(r'\w+')
+
+DEFAULT_THRESHOLD = 0.5
+DEFAULT_NUM_PERM = 128
+DEFAULT_SHINGLE_SIZE = 3
+
+# Universal hashing modulo a Mersenne prime, keeping 32 bits of each hash
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+LOW_29_BITS = np.uint64((1 << 29) - 1)
+
+
+def shingle_hashes(text: str, shingle_size: int = DEFAULT_SHINGLE_SIZE) -> np.ndarray:
+    """
+    Returns the distinct 32-bit hashes of the word shingles of a text. Texts shorter than one shingle are a single
+    shingle.
+    """
+    words = WORD_REGEX.findall(clean_text(text, True, []).lower())
+    shingles = {' '.join(words[i:i + shingle_size]) for i in range(max(1, len(words) - shingle_size + 1))}
+
+    return np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingles), dtype = np.uint64,
+                       count = len(shingles))
+
+
+def universal_hashes(a: np.ndarray, b: np.ndarray, hashes: np.ndarray) -> np.ndarray:
+    """
+    Returns (a * hashes + b) mod MERSENNE_PRIME, exactly, for a and b below the prime and 32-bit hashes. The product
+    can reach 2^93, so a is split into its high 29 and low 32 bits, and the high part of the product is reduced using
+    2^61 = 1 (mod prime) before any intermediate value can overflow uint64.
+    """
+    # Below 2^61, and high * 2^32 = (high >> 29) * 2^61 + (high & (2^29 - 1)) * 2^32
+    high = (a >> np.uint64(32)) * hashes
+    high = (high >> np.uint64(29)) + ((high & LOW_29_BITS) << np.uint64(32))
+    low = (a & MAX_HASH) * hashes % MERSENNE_PRIME
+
+    # Each term is below 2^62, so the sum stays below 2^64
+    return (high + low + b) % MERSENNE_PRIME
+
+
+def minhash_signatures(texts: Sequence[str], num_perm: int = DEFAULT_NUM_PERM,
+                       shingle_size: int = DEFAULT_SHINGLE_SIZE, seed: int = 0) -> np.ndarray:
+    """
+    Returns the MinHash signature of each text as a (num_texts, num_perm) uint32 array.
+    """
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, MERSENNE_PRIME, size = (num_perm, 1), dtype = np.uint64)
+    b = rng.integers(0, MERSENNE_PRIME, size = (num_perm, 1), dtype = np.uint64)
+
+    signatures = np.empty((len(texts), num_perm), dtype = np.uint32)
+    for i, text in enumerate(texts):
+        hashes = shingle_hashes(text, shingle_size)
+        signatures[i] = (universal_hashes(a, b, hashes) & MAX_HASH).min(axis = 1)
+
+    return signatures
+
+
+def lsh_bands(threshold: float, num_perm: int) -> Tuple[int, int]:
+    """
+    Returns the number of bands and rows per band splitting the signatures. Pairs of texts with Jaccard similarity s
+    share a band with probability 1 - (1 - s^rows)^bands, an S-curve whose steep part, around (1 / bands)^(1 / rows),
+    is placed at or just below the threshold so that few true reprints are missed.
+    """
+    divisors = [rows for rows in range(1, num_perm + 1) if num_perm % rows == 0]
+    rows = max([rows for rows in divisors if (rows / num_perm) ** (1 / rows) <= threshold], default = 1)
+
+    return num_perm // rows, rows
+
+
+class ReprintClusters:
+    """
+    The reprint clusters of a list of texts. labels holds the cluster of each text, numbered by the position of the
+    cluster's representative, its first text.
+
+    Example:
+        >>> clusters = reprint_clusters(corpus['article'])
+        >>> masked = ner_and_mask([corpus['article'][i] for i in clusters.representatives], ner_model)
+        >>> clusters.counts
+    """
+
+    def __init__(self, labels: np.ndarray):
+        self.labels = labels
+        self.representatives, self.counts = np.unique(labels, return_counts = True)
+
+    def __len__(self) -> int:
+        return len(self.representatives)
+
+    def members(self, representative: int) -> List[int]:
+        return np.flatnonzero(self.labels == representative).tolist()
+
+
+def find(parents: np.ndarray, i: int) -> int:
+    while parents[i] != i:
+        parents[i] = parents[parents[i]]
+        i = parents[i]
+    return i
+
+
+def reprint_clusters(texts: Sequence[str], threshold: float = DEFAULT_THRESHOLD, num_perm: int = DEFAULT_NUM_PERM,
+                     shingle_size: int = DEFAULT_SHINGLE_SIZE, seed: int = 0) -> ReprintClusters:
+    """
+    Groups texts that are reprints of each other, i.e. whose word shingle sets have an estimated Jaccard similarity of
+    at least threshold (directly or through other reprints).
+
+    Args:
+        texts (Sequence[str]): The texts, e.g. raw OCR articles. They are cleaned before shingling.
+        threshold (float): The estimated Jaccard similarity above which two texts are reprints. Defaults to 0.5.
+        num_perm (int): The length of the MinHash signatures. Longer signatures estimate similarity more precisely.
+            Defaults to 128.
+        shingle_size (int): The number of words per shingle. Defaults to 3.
+        seed (int): The seed of the MinHash permutations. Defaults to 0.
+
+    Returns:
+        ReprintClusters: The cluster of every text.
+    """
+    if not 0 < threshold <= 1:
+        raise ValueError(f'threshold must be in (0, 1], got {threshold}')
+
+    signatures = minhash_signatures(texts, num_perm, shingle_size, seed)
+    bands, rows = lsh_bands(threshold, num_perm)
+    parents = np.arange(len(texts))
+
+    for band in range(bands):
+        band_signatures = np.ascontiguousarray(signatures[:, band * rows:(band + 1) * rows])
+        _, buckets = np.unique(band_signatures.view(np.dtype((np.void, 4 * rows))), return_inverse = True)
+        order = np.argsort(buckets.ravel(), kind = 'stable')
+        bucket_starts = np.flatnonzero(np.diff(buckets.ravel()[order], prepend = -1))
+
+        for start, end in zip(bucket_starts, np.append(bucket_starts[1:], len(order))):
+            if end - start < 2:
+                continue
+            members = order[start:end]
+            similarity = (signatures[members[1:]] == signatures[members[0]]).mean(axis = 1)
+            root = find(parents, members[0])
+            for member in members[1:][similarity >= threshold]:
+                member_root = find(parents, member)
+                parents[max(root, member_root)] = min(root, member_root)
+                root = min(root, member_root)
+
+    labels = np.array([find(parents, i) for i in range(len(texts))], dtype = np.int64)
+    return ReprintClusters(labels)
@@ -5,12 +5,22 @@ Download function for American Stories dataset.
 import os
 import requests
 import re
-from datasets import load_dataset
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+from datasets import Dataset, concatenate_datasets, load_dataset
+import pyarrow.parquet as pq
 import json
 
+from ..utils.dataset import get_dataset
+from ..utils.cache import atomic_write, file_sha256
+from .embeddings import year_embeddings
+
 MIN_AMERICAN_STORIES_YEAR = 1774
 MAX_AMERICAN_STORIES_YEAR = 1963
 
+REPO_ID = 'dell-research-harvard/AmericanStories'
+CHECKSUMS_FILE = 'checksums.json'
+
 def parse_american_stories_args(args: list) -> dict:
     """
     Parse the American Stories download string into a dictionary of args. There are two possible args for the American Stories download function:
@@ -77,47 +87,116 @@ def parse_american_stories_args(args: list) -> dict:
     return inputs, default_save_folder
 
 
-def download_american_stories(save_folder: str, **kwargs):
+def fetch_american_stories_year(year: int, repo_id: str = REPO_ID) -> Dataset:
+    """
+    Fetch the articles of one year of the American Stories dataset from the Hugging Face hub.
+    """
+    return load_dataset(repo_id, year_list = [str(year)])[str(year)]
+
+
+def year_file(save_folder: str, year: int) -> str:
+    return os.path.join(save_folder, f'dataset_{year}.parquet')
+
+
+def load_checksums(save_folder: str) -> Dict[str, str]:
+    checksums_path = os.path.join(save_folder, CHECKSUMS_FILE)
+    if not os.path.exists(checksums_path):
+        return {}
+
+    with open(checksums_path) as f:
+        return json.load(f)
+
+
+def is_downloaded(save_folder: str, year: int, checksums: Dict[str, str]) -> bool:
+    """
+    Whether a year has been downloaded and its Parquet file still matches the checksum recorded when it was written.
+    """
+    path = year_file(save_folder, year)
+    return os.path.exists(path) and checksums.get(str(year)) == file_sha256(path)
+
+
+def save_year(save_folder: str, year: int, dataset: Dataset) -> str:
+    """
+    Write a year of articles to zstd-compressed Parquet and return the file's checksum.
+    """
+    path = year_file(save_folder, year)
+    # Dataset.to_parquet() always uses snappy, so the table is written with pyarrow directly
+    atomic_write(path, lambda f: pq.write_table(dataset.with_format('arrow')[:], f, compression = 'zstd'), mode = 'wb')
+
+    return file_sha256(path)
+
+
+def download_year(save_folder: str, year: int, fetch_year: Callable[[int], Dataset]) -> str:
+    """
+    Store a year in save_folder, fetching it with fetch_year unless an earlier version of this function saved it as
+    JSON, and return the checksum of its Parquet file.
+    """
+    legacy_path = os.path.join(save_folder, f'dataset_{year}.json')
+    if os.path.exists(legacy_path):
+        dataset = load_dataset('json', data_files = legacy_path)['train']
+    else:
+        dataset = fetch_year(year)
+
+    return save_year(save_folder, year, dataset)
+
+
+def download_american_stories(save_folder: str, fetch_year: Optional[Callable[[int], Dataset]] = None,
+                              num_workers: int = 4, columns: Optional[List[str]] = None,
+                              embeddings_options: Optional[dict] = None, **kwargs) -> Dataset:
     """
     Download the American Stories dataset and save it to the indicated folder.
 
+    Each year is stored as its own zstd-compressed Parquet file, dataset_{year}.parquet, with its SHA-256 checksum
+    recorded in checksums.json. Years that are already downloaded and pass their checksum are not fetched again, and
+    missing years are fetched concurrently.
+
     Args:
     - save_folder: the folder in which to save the downloaded data
+    - fetch_year: a function returning the Dataset of articles of one year. Defaults to fetching from the Hugging Face hub;
+      tests pass a local stand-in
+    - num_workers: the number of years to fetch concurrently
+    - columns: the columns to load (e.g. ['article_id', 'article']). Defaults to all columns
+    - embeddings_options: with the 'embeddings' arg, keyword arguments for download.embeddings.year_embeddings(), e.g.
+      {'mirror': '/shared/american_stories_embeddings', 'dtype': 'int8'}
     - kwargs: a dictionary of args for the American Stories download function
+
+    Returns:
+    - a memory-mapped Dataset of the articles of all requested years, in year order. With the 'embeddings' arg, it also
+      has a 'masked_article' column and an 'embedding' column (see download.embeddings.embedding_matrix())
     """
-    import huggingface_hub
+    fetch_year = fetch_year or fetch_american_stories_year
 
-    REPO_ID = 'dell-research-harvard/AmericanStories'
-    
     # Get the embeddings arg
     embeddings = kwargs.get('embeddings', False)
 
-    if embeddings:
-        raise NotImplementedError('Embeddings are not yet available for the American Stories dataset.')
-    
     # Get the years arg
     years = kwargs.get('years', [])
     year_range = kwargs.get('year_range', None)
     if year_range:
         years = list(range(year_range[0], year_range[1]+1))
-    
-    years = list(map(str, years))
+    if embeddings and not years:
+        raise ValueError('The embeddings download needs the years to embed, e.g. "american stories:1850-1860:embeddings"')
 
-    # Remove years that already have a downloaded dataset
-    if os.path.exists(save_folder):
-        downloaded_years = [f.split('_')[-1] for f in os.listdir(save_folder)]
-        years = [year for year in years if year not in downloaded_years]
-    
-    if years:
-        # Download the files
-        dataset = load_dataset("dell-research-harvard/AmericanStories", year_list = years)
+    os.makedirs(save_folder, exist_ok = True)
+    checksums = load_checksums(save_folder)
 
-        if not os.path.exists(save_folder):
-            os.makedirs(save_folder)
-        
-        for year in years:
-            dataset[year].to_json(os.path.join(save_folder, f'dataset_{year}.json'))
-                     
-    print([os.path.join(save_folder, f'dataset_{year}.json') for year in years])
-    return load_dataset("json", data_files = [os.path.join(save_folder, f'dataset_{year}.json') for year in years])['train']
+    # Only fetch years without a valid downloaded file
+    missing_years = [year for year in years if not is_downloaded(save_folder, year, checksums)]
+
+    if missing_years:
+        with ThreadPoolExecutor(max_workers = num_workers) as executor:
+            futures = {year: executor.submit(download_year, save_folder, year, fetch_year) for year in missing_years}
+            for year, future in futures.items():
+                checksums[str(year)] = future.result()
+                atomic_write(os.path.join(save_folder, CHECKSUMS_FILE), lambda f: json.dump(checksums, f, indent = 4))
+
+    articles = get_dataset([year_file(save_folder, year) for year in years], columns)
+    if not embeddings:
+        return articles
+
+    # Masked texts and embeddings are stored per year, next to the articles. They are computed from the article texts,
+    # whichever columns are returned.
+    year_datasets = {year: get_dataset([year_file(save_folder, year)], ['article']) for year in years}
+    masked_and_embedded = year_embeddings(save_folder, year_datasets, **(embeddings_options or {}))
 
+    return concatenate_datasets([articles, masked_and_embedded], axis = 1)
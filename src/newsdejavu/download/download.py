@@ -49,9 +49,11 @@ def parse_download_string(download_string: str) -> Tuple[callable, dict, str]:
     return download_function, args, os.path.join('data', default_save_folder)
 
 
-def download(dataset: str, save_folder: str = None) -> Dataset:
+def download(dataset: str, save_folder: str = None, **kwargs) -> Dataset:
     '''
     download the indicated dataset to the indicated save folder
+
+    Further keyword arguments (e.g. columns or num_workers) are passed on to the dataset's download function.
     '''
 
     # Get params and download function
@@ -60,4 +62,4 @@ def download(dataset: str, save_folder: str = None) -> Dataset:
     # Override the default save folder if one is provided
     save_folder = save_folder or default_save_folder
 
-    return fetcher(save_folder, **args)
\ No newline at end of file
+    return fetcher(save_folder, **args, **kwargs)
\ No newline at end of file
@@ -0,0 +1,190 @@
+'''
+Pre-computed masked texts and embeddings for downloaded corpora.
+
+For each year, the entity-masked text and the normalised same-story embedding of every article are stored next to the
+raw articles in embeddings_{year}.parquet, as a 'masked_article' column and an 'embedding' column of fixed-size float16
+or int8 vectors. int8 vectors are the float vectors scaled by 127 and rounded, which is accurate to within 0.4% for
+normalised vectors. embeddings_manifest.json records the models and dtype the shards were made with, and the SHA-256
+of each shard.
+
+Shards are copied from a local mirror (a directory with the same layout, e.g. on shared storage) when it has them, and
+computed with ner_and_mask() and embed() otherwise.
+'''
+
+import os
+import json
+import shutil
+from typing import Dict, List, Optional
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from datasets import Dataset
+
+from ..ner import ner_and_mask
+from ..embed import embed
+from ..utils.dataset import get_dataset
+from ..utils.cache import atomic_write, file_sha256
+
+EMBEDDINGS_MANIFEST = 'embeddings_manifest.json'
+EMBEDDING_DTYPES = {'float16': np.float16, 'int8': np.int8}
+INT8_SCALE = 127
+
+# Environment variable naming the default local mirror of embedding shards
+MIRROR_ENVIRONMENT_VARIABLE = 'NEWSDEJAVU_EMBEDDINGS_MIRROR'
+
+DEFAULT_NER_MODEL = 'dell-research-harvard/historical_newspaper_ner'
+DEFAULT_SENTENCE_MODEL = 'dell-research-harvard/same-story'
+
+
+def embeddings_file(folder: str, year: int) -> str:
+    return os.path.join(folder, f'embeddings_{year}.parquet')
+
+
+def quantize(embeddings: np.ndarray, dtype: str) -> np.ndarray:
+    """
+    Converts normalised float32 embeddings to the compact storage dtype.
+    """
+    if dtype not in EMBEDDING_DTYPES:
+        raise ValueError(f'Unknown embedding dtype {dtype}, must be one of {", ".join(EMBEDDING_DTYPES)}')
+
+    if dtype == 'int8':
+        return np.clip(np.rint(embeddings * INT8_SCALE), -INT8_SCALE, INT8_SCALE).astype(np.int8)
+
+    return embeddings.astype(np.float16)
+
+
+def embedding_matrix(dataset: Dataset, column: str = 'embedding') -> np.ndarray:
+    """
+    Returns the embeddings stored in a dataset's column as a normalised float32 matrix, ready for CorpusIndex.build().
+
+    Example:
+        >>> corpus = download('american stories:1850-1860:embeddings')
+        >>> corpus_index = CorpusIndex.build(embedding_matrix(corpus))
+    """
+    vectors = dataset.with_format('arrow')[column].combine_chunks()
+    dim = vectors.type.list_size
+    flat = vectors.flatten().to_numpy(zero_copy_only = False)
+    embeddings = flat.reshape(-1, dim).astype(np.float32)
+
+    if flat.dtype == np.int8:
+        embeddings /= np.linalg.norm(embeddings, axis = 1, keepdims = True).clip(min = 1e-12)
+
+    return embeddings
+
+
+def save_year_embeddings(path: str, masked_articles: List[str], embeddings: np.ndarray, dtype: str) -> str:
+    """
+    Writes the masked texts and quantized embeddings of a year to Parquet and returns the file's checksum.
+    """
+    vectors = quantize(np.asarray(embeddings, dtype = np.float32), dtype)
+    table = pa.table({'masked_article': masked_articles,
+                      'embedding': pa.FixedSizeListArray.from_arrays(pa.array(vectors.ravel()), vectors.shape[1])})
+    atomic_write(path, lambda f: pq.write_table(table, f, compression = 'zstd'), mode = 'wb')
+
+    return file_sha256(path)
+
+
+def load_embeddings_manifest(folder: str) -> Optional[Dict]:
+    manifest_path = os.path.join(folder, EMBEDDINGS_MANIFEST)
+    if not os.path.exists(manifest_path):
+        return None
+
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def copy_from_mirror(mirror: Optional[str], save_folder: str, year: int, settings: Dict) -> Optional[str]:
+    """
+    Copies a year's shard from the mirror if the mirror has it for the same models and dtype, and returns its checksum.
+    """
+    if not mirror:
+        return None
+
+    mirror_manifest = load_embeddings_manifest(mirror)
+    if mirror_manifest is None or any(mirror_manifest.get(key) != value for key, value in settings.items()):
+        return None
+    if str(year) not in mirror_manifest['years'] or not os.path.exists(embeddings_file(mirror, year)):
+        return None
+
+    def copy(f):
+        with open(embeddings_file(mirror, year), 'rb') as source:
+            shutil.copyfileobj(source, f)
+
+    path = embeddings_file(save_folder, year)
+    atomic_write(path, copy, mode = 'wb')
+
+    checksum = file_sha256(path)
+    if checksum != mirror_manifest['years'][str(year)]:
+        os.remove(path)
+        raise ValueError(f'Embeddings for {year} in mirror {mirror} do not match their checksum')
+
+    return checksum
+
+
+def compute_year_embeddings(articles: Dataset, path: str, settings: Dict, ner_batch_size: int,
+                            embed_batch_size: int) -> str:
+    """
+    Runs NER, masking and embedding over a year of articles and saves the result, returning the file's checksum.
+    """
+    masked_articles = ner_and_mask(articles, settings['ner_model'], batch_size = ner_batch_size)
+    embeddings = embed(masked_articles, settings['sentence_model'], batch_size = embed_batch_size)
+
+    return save_year_embeddings(path, masked_articles, embeddings, settings['dtype'])
+
+
+def year_embeddings(save_folder: str, year_datasets: Dict[int, Dataset], ner_model: Optional[str] = None,
+                    sentence_model: Optional[str] = None, dtype: str = 'float16', mirror: Optional[str] = None,
+                    ner_batch_size: int = 256, embed_batch_size: int = 512) -> Dataset:
+    """
+    Makes sure save_folder holds an embeddings shard for every year, and returns the masked texts and embeddings of
+    all years as one dataset, aligned row by row with the concatenated year datasets.
+
+    Args:
+        save_folder (str): The folder holding the raw articles, where the shards are stored.
+        year_datasets (Dict[int, Dataset]): The raw articles of each year, in order.
+        ner_model (Optional[str]): The NER model used for masking. Defaults to DEFAULT_NER_MODEL.
+        sentence_model (Optional[str]): The sentence embedding model. Defaults to DEFAULT_SENTENCE_MODEL.
+        dtype (str): The storage dtype of the embeddings, 'float16' or 'int8'. Defaults to 'float16'.
+        mirror (Optional[str]): A local directory to copy existing shards from. Defaults to the directory named by the
+            NEWSDEJAVU_EMBEDDINGS_MIRROR environment variable, if set.
+        ner_batch_size (int): Batch size for NER when shards are computed. Defaults to 256.
+        embed_batch_size (int): Batch size for embedding when shards are computed. Defaults to 512.
+
+    Returns:
+        Dataset: The 'masked_article' and 'embedding' columns of all years.
+    """
+    if dtype not in EMBEDDING_DTYPES:
+        raise ValueError(f'Unknown embedding dtype {dtype}, must be one of {", ".join(EMBEDDING_DTYPES)}')
+
+    settings = {'ner_model': ner_model or DEFAULT_NER_MODEL, 'sentence_model': sentence_model or DEFAULT_SENTENCE_MODEL,
+                'dtype': dtype}
+    mirror = mirror or os.environ.get(MIRROR_ENVIRONMENT_VARIABLE)
+
+    manifest = load_embeddings_manifest(save_folder)
+    if manifest is not None:
+        mismatched = [key for key, value in settings.items() if manifest.get(key) != value]
+        if mismatched:
+            raise ValueError(f'{save_folder} contains embeddings made with different settings ({", ".join(mismatched)}). '
+                             f'Delete its embeddings files or pass a different save_folder.')
+    else:
+        manifest = {**settings, 'years': {}}
+
+    for year, articles in year_datasets.items():
+        path = embeddings_file(save_folder, year)
+        if os.path.exists(path) and manifest['years'].get(str(year)) == file_sha256(path):
+            continue
+
+        checksum = copy_from_mirror(mirror, save_folder, year, settings)
+        if checksum is None:
+            print(f'computing embeddings for {year}')
+            checksum = compute_year_embeddings(articles, path, settings, ner_batch_size, embed_batch_size)
+
+        manifest['years'][str(year)] = checksum
+        atomic_write(os.path.join(save_folder, EMBEDDINGS_MANIFEST), lambda f: json.dump(manifest, f, indent = 4))
+
+    embeddings = get_dataset([embeddings_file(save_folder, year) for year in year_datasets])
+    if len(embeddings) != sum(len(articles) for articles in year_datasets.values()):
+        raise ValueError(f'The embeddings in {save_folder} do not have one row per article')
+
+    return embeddings
@@ -1 +1,2 @@
-from .embed import embed
\ No newline at end of file
+from .embed import embed, embed_to_memmap
+from .cache import EmbeddingCache
\ No newline at end of file
@@ -0,0 +1,171 @@
+'''
+Content-addressed on-disk cache of sentence embeddings.
+
+Embeddings are keyed on the model identifier plus a SHA-256 hash of the whitespace-normalised masked text, so the same
+wire story reprinted across many newspapers, or an article that is downloaded again with a later year, is only ever
+encoded once per model. A model run in another precision (a half precision dtype, or an ONNX backend) has an identifier
+of its own (see embedding_model_id()), since its embeddings differ slightly from the full precision PyTorch ones. The
+cache is a single SQLite file and is bounded in size: when it grows past max_bytes, the least recently used embeddings
+are evicted.
+'''
+
+import os
+import re
+import time
+import sqlite3
+import threading
+import hashlib
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+
+WHITESPACE_REGEX = re.compile(r'\s+')
+
+# SQLite limits the number of host parameters in one statement
+MAX_SQL_PARAMETERS = 500
+
+
+def normalise_text(text: str) -> str:
+    """
+    Collapses runs of whitespace and strips the ends of a masked text, since tokenizers ignore both.
+    """
+    return WHITESPACE_REGEX.sub(' ', text).strip()
+
+
+def embedding_model_id(model: str, torch_dtype: Optional[torch.dtype] = None, backend: str = 'torch') -> str:
+    """
+    Returns the identifier embeddings of a model run in the given dtype and on the given backend are cached under.
+    float32 PyTorch embeddings keep the plain model identifier, so caches written before these settings were part of
+    the key stay valid.
+    """
+    settings = [] if torch_dtype in (None, torch.float32) else [str(torch_dtype)]
+    if backend != 'torch':
+        settings.append(backend)
+
+    return f'{model} ({", ".join(settings)})' if settings else model
+
+
+def embedding_cache_key(model: str, text: str) -> str:
+    """
+    Returns the cache key of a text embedded with the given model, identified as by embedding_model_id().
+    """
+    return hashlib.sha256(f'{model}\x00{normalise_text(text)}'.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    A size-bounded LRU cache of float32 embeddings stored in a SQLite database.
+
+    Args:
+        path (str): Path of the SQLite database file. It is created if it does not exist.
+        max_bytes (Optional[int]): Maximum total size of the cached embeddings. Least recently used entries are evicted
+            once it is exceeded. Defaults to 10 GB. None means unbounded.
+
+    Example:
+        >>> cache = EmbeddingCache('data/embedding_cache.sqlite')
+        >>> embeddings = embed(masked_corpus, same_story_model, cache = cache)
+    """
+
+    def __init__(self, path: str, max_bytes: Optional[int] = 10 * 1024 ** 3):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+
+        self.path = path
+        self.max_bytes = max_bytes
+        # embed() may run on worker threads (the streaming pipeline, the search service), so the connection is shared
+        # across threads and every use of it, and of total_bytes, holds the lock. put_many() takes it again in evict().
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread = False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS embeddings '
+                                '(key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)')
+        self.connection.commit()
+
+        self.total_bytes = self.connection.execute('SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings').fetchone()[0]
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        """
+        Returns the cached embeddings of the given keys, omitting keys that are not in the cache, and marks them as
+        recently used.
+        """
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        with self.lock:
+            for start in range(0, len(unique_keys), MAX_SQL_PARAMETERS):
+                chunk = unique_keys[start:start + MAX_SQL_PARAMETERS]
+                rows = self.connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+                for key, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype = np.float32)
+
+            if found:
+                now = time.time()
+                self.connection.executemany('UPDATE embeddings SET last_used = ? WHERE key = ?',
+                                            [(now, key) for key in found])
+                self.connection.commit()
+
+        return found
+
+    def put_many(self, keys: List[str], embeddings: np.ndarray):
+        """
+        Adds embeddings to the cache, then evicts least recently used entries if the cache is over its size limit.
+        """
+        now = time.time()
+        rows = [(key, np.asarray(embedding, dtype = np.float32).tobytes(), now) for key, embedding in zip(keys, embeddings)]
+
+        with self.lock:
+            # Replaced entries no longer count towards the total
+            replaced = self.get_sizes([key for key, _, _ in rows])
+            self.connection.executemany('INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)',
+                                        rows)
+            self.connection.commit()
+            self.total_bytes += sum(len(vector) for _, vector, _ in rows) - sum(replaced.values())
+
+            self.evict()
+
+    def get_sizes(self, keys: List[str]) -> Dict[str, int]:
+        sizes = {}
+        unique_keys = list(dict.fromkeys(keys))
+        with self.lock:
+            for start in range(0, len(unique_keys), MAX_SQL_PARAMETERS):
+                chunk = unique_keys[start:start + MAX_SQL_PARAMETERS]
+                rows = self.connection.execute(
+                    f"SELECT key, LENGTH(vector) FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+                sizes.update(rows)
+
+        return sizes
+
+    def evict(self):
+        """
+        Removes least recently used embeddings until the cache is within max_bytes.
+        """
+        if self.max_bytes is None:
+            return
+
+        with self.lock:
+            while self.total_bytes > self.max_bytes:
+                rows = self.connection.execute('SELECT key, LENGTH(vector) FROM embeddings ORDER BY last_used LIMIT ?',
+                                               (MAX_SQL_PARAMETERS,)).fetchall()
+                if not rows:
+                    self.total_bytes = 0
+                    break
+
+                evicted = []
+                for key, size in rows:
+                    if self.total_bytes <= self.max_bytes:
+                        break
+                    evicted.append((key,))
+                    self.total_bytes -= size
+
+                self.connection.executemany('DELETE FROM embeddings WHERE key = ?', evicted)
+                self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -1,14 +1,123 @@
-from typing import List, Dict, Optional, Union
-from transformers import PreTrainedModel, AutoTokenizer
+from typing import Callable, List, Dict, Iterable, Optional, Union
+from itertools import islice
+from transformers import PreTrainedModel
 from sentence_transformers import SentenceTransformer
 import numpy as np
+import torch
 import os
+import json
 import pickle
+from tqdm import tqdm
+from datasets import Dataset
 
 from newsdejavu.utils.wrangling import find_mask_token, find_sep_token
+from newsdejavu.utils.cache import atomic_write
+from newsdejavu.utils.registry import get_tokenizer, get_sentence_model, model_name, loaded_model_settings
+from newsdejavu.utils.batching import token_lengths, token_budget_batches
+from .cache import EmbeddingCache, embedding_cache_key, embedding_model_id
 
 
-def embed(corpus: Union[List, List[Dict[str, str]]], model: str, batch_size: int = 512, save_path: Optional[str] = None) -> np.ndarray:
+def resolve_sentence_model(model: Union[str, SentenceTransformer], device: Optional[str] = None,
+                           torch_dtype: Optional[torch.dtype] = None, backend: str = 'torch'):
+    """
+    Returns the tokenizer of a sentence model and a function returning the model itself. Models given by path are
+    fetched from the model registry, so they are only loaded once per process, and only if something is encoded.
+    """
+    if isinstance(model, str):
+        return get_tokenizer(model), lambda: get_sentence_model(model, device, torch_dtype, backend)
+
+    return model.tokenizer, lambda: model
+
+
+def sentence_model_id(model: Union[str, SentenceTransformer], torch_dtype: Optional[torch.dtype] = None,
+                      backend: str = 'torch') -> str:
+    """
+    Returns the identifier embeddings of a model are cached (and embed_to_memmap() outputs resumed) under. The dtype and
+    backend of an already-loaded model are read from the model itself, since the torch_dtype and backend arguments do
+    not apply to it.
+    """
+    if not isinstance(model, str):
+        torch_dtype, backend = loaded_model_settings(model)
+
+    return embedding_model_id(model_name(model), torch_dtype, backend)
+
+
+def corpus_texts(corpus: Iterable) -> Iterable[str]:
+    """
+    Yields the masked text of each corpus item, which is either a string or a dict with a "masked_sentence" key.
+    """
+    for item in corpus:
+        yield item if isinstance(item, str) else item["masked_sentence"]
+
+
+def replace_special_tokens(texts: Iterable[str], mask_tok: str, sep_tok: str) -> List[str]:
+    """
+    Replaces the generic '[MASK]' and '[SEP]' tokens with the tokens of the sentence model's tokenizer.
+    """
+    data = []
+    for text in texts:
+        # Correct [MASK] token for tokenizer
+        text = text.replace('[MASK]', mask_tok)
+        text = text.replace('[SEP]', sep_tok)
+        data.append(text)
+
+    return data
+
+
+def encode(sentence_model: SentenceTransformer, data: List[str], batch_size: int,
+           max_batch_tokens: Optional[int] = None) -> np.ndarray:
+    """
+    Encodes a list of texts and normalizes the embeddings to unit length. If max_batch_tokens is given, texts are
+    bucketed by tokenized length into batches of at most max_batch_tokens padded tokens instead of batch_size texts.
+    """
+    if max_batch_tokens:
+        lengths = token_lengths(sentence_model.tokenizer, data, sentence_model.max_seq_length)
+        corpus_embeddings = None
+        for batch in tqdm(token_budget_batches(lengths, max_batch_tokens)):
+            batch_embeddings = sentence_model.encode([data[i] for i in batch], show_progress_bar = False,
+                                                     batch_size = len(batch))
+            if corpus_embeddings is None:
+                corpus_embeddings = np.empty((len(data), batch_embeddings.shape[1]), dtype = batch_embeddings.dtype)
+            corpus_embeddings[batch] = batch_embeddings
+    else:
+        corpus_embeddings = sentence_model.encode(data, show_progress_bar = True, batch_size = batch_size)
+
+    # Normalize the embeddings to unit length
+    corpus_embeddings /= np.linalg.norm(corpus_embeddings, axis = 1, keepdims = True)
+
+    return corpus_embeddings
+
+
+def encode_with_cache(model: str, data: List[str], batch_size: int, cache: EmbeddingCache,
+                      load_sentence_model: Callable[[], SentenceTransformer],
+                      max_batch_tokens: Optional[int] = None) -> np.ndarray:
+    """
+    Looks up each text in the embedding cache and only encodes the distinct texts that are not cached yet. The sentence
+    model is only loaded if there is something to encode.
+    """
+    keys = [embedding_cache_key(model, text) for text in data]
+    cached = cache.get_many(keys)
+
+    missing = {}
+    for key, text in zip(keys, data):
+        if key not in cached and key not in missing:
+            missing[key] = text
+
+    print(f'{len(data) - sum(key not in cached for key in keys)} embeddings found in cache, {len(missing)} distinct texts to embed')
+
+    if missing:
+        print("embedding corpus ...")
+        new_embeddings = encode(load_sentence_model(), list(missing.values()), batch_size, max_batch_tokens)
+        cache.put_many(list(missing.keys()), new_embeddings)
+        cached.update(zip(missing.keys(), new_embeddings))
+
+    return np.stack([cached[key] for key in keys]) if keys else np.zeros((0, 0), dtype = np.float32)
+
+
+def embed(corpus: Union[List, List[Dict[str, str]]], model: Union[str, SentenceTransformer], batch_size: int = 512,
+          save_path: Optional[str] = None, cache: Optional[Union[str, EmbeddingCache]] = None,
+          device: Optional[str] = None, torch_dtype: Optional[torch.dtype] = None,
+          max_batch_tokens: Optional[int] = None, backend: str = 'torch') -> np.ndarray:
     """
     Create embeddings from masked sentences in a given corpus using a specified model.
     
@@ -22,9 +131,20 @@ def embed(corpus: Union[List, List[Dict[str, str]]], model: str, batch_size: int
             a "masked_sentence" key representing the text to embed.
         model (str): The model identifier used for embedding. This should be a valid Hugging Face model path.
             If the model is not found, the function attempts to fetch it from 'dell-research-harvard' or
-            'sentence-transformers' as fallback repositories.
+            'sentence-transformers' as fallback repositories. Models given by path are loaded once per process and
+            reused by later calls (see utils.registry). An already-loaded SentenceTransformer can also be passed.
         save_path (Optional[str]): The file path where the embeddings should be saved. If not provided,
             embeddings are not saved to disk. Default is None.
+        cache (Optional[Union[str, EmbeddingCache]]): An on-disk embedding cache, or the path of one. If provided,
+            only texts whose (model, dtype and backend, normalized text) key is not in the cache are encoded, and
+            each distinct text is encoded once. Default is None.
+        device (Optional[str]): The torch device to run the model on. Defaults to the SentenceTransformer default.
+        torch_dtype (Optional[torch.dtype]): The dtype to run the model in. Defaults to the model's own dtype.
+        max_batch_tokens (Optional[int]): If provided, texts are sorted by tokenized length and batched so that each
+            batch holds at most this many tokens including padding, instead of batch_size texts. Default is None.
+        backend (str): The inference backend of models given by path: 'torch', or 'onnx' / 'onnx-int8' to run the
+            model on CPU with ONNX Runtime, with float32 or dynamically quantized int8 weights (see
+            newsdejavu.backends). Default is 'torch'.
 
     Returns:
         np.ndarray: An array of embeddings, one for each masked sentence in the corpus.
@@ -44,45 +164,137 @@ def embed(corpus: Union[List, List[Dict[str, str]]], model: str, batch_size: int
         - It replaces '[MASK]' and '[SEP]' tokens in the corpus with the appropriate tokens for the specified model.
     """
 
-    ##if no organization is provided in the model repo, try dell-research-harvard > sentence-transformers > throw error
-    
-    try:
-        tokenizer = AutoTokenizer.from_pretrained(model)
-    except:
-        try:
-            tokenizer = AutoTokenizer.from_pretrained(f"dell-research-harvard/{model}")
-        except:
-            tokenizer = AutoTokenizer.from_pretrained(f"sentence-transformers/{model}")
-                    
+    tokenizer, load_sentence_model = resolve_sentence_model(model, device, torch_dtype, backend)
 
     mask_tok = find_mask_token(tokenizer)
     sep_tok = find_sep_token(tokenizer)
     
-    if isinstance(corpus[0], str):
-        corpus_text_list = corpus
-    else:
-        corpus_text_list=[corpus_subdict["masked_sentence"] for corpus_subdict in corpus] 
-    data = []
-    for text in corpus_text_list:
-        # Correct [MASK] token for tokenizer
-        text = text.replace('[MASK]', mask_tok)
-        text = text.replace('[SEP]', sep_tok)
-        data.append(text)
+    data = replace_special_tokens(corpus_texts(corpus), mask_tok, sep_tok)
     
 
     print(f'{len(data)} articles in corpus')
 
-    print("embedding corpus ...")
-    sentence_model=SentenceTransformer(model)
-    corpus_embeddings = sentence_model.encode(data, show_progress_bar = True, batch_size = batch_size)
-
-    # Normalize the embeddings to unit length
-    corpus_embeddings = corpus_embeddings / np.linalg.norm(corpus_embeddings, axis = 1, keepdims = True)
+    if cache is not None:
+        if isinstance(cache, str):
+            cache = EmbeddingCache(cache)
+        corpus_embeddings = encode_with_cache(sentence_model_id(model, torch_dtype, backend), data, batch_size, cache, load_sentence_model,
+                                              max_batch_tokens)
+    else:
+        print("embedding corpus ...")
+        corpus_embeddings = encode(load_sentence_model(), data, batch_size, max_batch_tokens)
 
     if save_path:
-        if not os.path.exists(save_path):
-            os.makedirs(save_path)
+        save_dir = os.path.dirname(save_path)
+        if save_dir and not os.path.exists(save_dir):
+            os.makedirs(save_dir)
         with open(f'{save_path}.pkl', 'wb') as f:
             pickle.dump(corpus_embeddings, f)
     
     return corpus_embeddings
+
+
+def embed_to_memmap(corpus: Union[Iterable, Dataset], model: Union[str, SentenceTransformer], output_path: str,
+                    chunk_size: int = 16384, batch_size: int = 512, num_rows: Optional[int] = None,
+                    cache: Optional[Union[str, EmbeddingCache]] = None, device: Optional[str] = None,
+                    torch_dtype: Optional[torch.dtype] = None, max_batch_tokens: Optional[int] = None,
+                    backend: str = 'torch') -> np.ndarray:
+    """
+    Embeds a corpus chunk by chunk into a preallocated .npy file, so peak memory is bounded by the chunk size rather
+    than the corpus size.
+
+    Each chunk of masked texts is read from the corpus, encoded, normalized in place and written into a memory-mapped
+    output array. A sidecar manifest '{output_path}.meta.json' records the model, the output shape and how many rows
+    have been written. If the function is interrupted, calling it again with the same arguments resumes after the last
+    completed chunk, and calling it on a finished output returns it without re-embedding anything.
+
+    Args:
+        corpus (Union[Iterable, Dataset]): An iterable (e.g. a generator) or datasets.Dataset of masked texts, or of
+            dicts with a "masked_sentence" key.
+        model (Union[str, SentenceTransformer]): The model identifier used for embedding, or an already-loaded model.
+        output_path (str): Path of the .npy file to write the embeddings to.
+        chunk_size (int): Number of texts encoded and written at a time. Default is 16384.
+        batch_size (int): Batch size used by the sentence model. Default is 512.
+        num_rows (Optional[int]): Number of texts in the corpus. Required if the corpus has no len(), since the
+            output file is preallocated. A ValueError is raised if the corpus has fewer or more texts.
+        cache (Optional[Union[str, EmbeddingCache]]): An on-disk embedding cache, or the path of one, as in embed().
+        device (Optional[str]): The torch device to run the model on, as in embed().
+        torch_dtype (Optional[torch.dtype]): The dtype to run the model in, as in embed().
+        max_batch_tokens (Optional[int]): Token budget for length-bucketed batches within each chunk, as in embed().
+        backend (str): The inference backend of models given by path, as in embed().
+
+    Returns:
+        np.ndarray: The embeddings, memory-mapped read-only from output_path.
+
+    Example:
+        >>> dataset = Dataset.from_dict({'masked_sentence': masked_corpus})
+        >>> embeddings = embed_to_memmap(dataset, same_story_model, 'data/embeddings_1840.npy')
+    """
+    if num_rows is None:
+        if not hasattr(corpus, '__len__'):
+            raise ValueError('num_rows must be given when the corpus is an iterator without a length')
+        num_rows = len(corpus)
+
+    model_id = sentence_model_id(model, torch_dtype, backend)
+    manifest_path = f'{output_path}.meta.json'
+    manifest = None
+    if os.path.exists(output_path) and os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest['model'] != model_id or manifest['shape'][0] != num_rows:
+            raise ValueError(f'{output_path} was written for model {manifest["model"]} and {manifest["shape"][0]} rows, '
+                             f'not model {model_id} and {num_rows} rows. Delete it or pass a different path.')
+        if manifest['rows_written'] == num_rows:
+            return np.load(output_path, mmap_mode = 'r')
+
+    tokenizer, load_sentence_model = resolve_sentence_model(model, device, torch_dtype, backend)
+    mask_tok = find_mask_token(tokenizer)
+    sep_tok = find_sep_token(tokenizer)
+
+    if isinstance(cache, str):
+        cache = EmbeddingCache(cache)
+    sentence_model = load_sentence_model()
+
+    if manifest is None:
+        dim = sentence_model.get_sentence_embedding_dimension()
+        output_dir = os.path.dirname(output_path)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok = True)
+        output = np.lib.format.open_memmap(output_path, mode = 'w+', dtype = np.float32, shape = (num_rows, dim))
+        manifest = {'model': model_id, 'shape': [num_rows, dim], 'dtype': 'float32', 'rows_written': 0}
+    else:
+        output = np.load(output_path, mmap_mode = 'r+')
+        print(f"resuming from row {manifest['rows_written']}")
+
+    if isinstance(corpus, Dataset):
+        # Only materialize one chunk of the dataset at a time
+        corpus = (row for batch in corpus.iter(batch_size = chunk_size) for row in batch["masked_sentence"])
+    texts = iter(corpus_texts(corpus))
+
+    # Skip the rows that were written before an interruption
+    start = manifest['rows_written']
+    for _ in islice(texts, start):
+        pass
+
+    while start < num_rows:
+        data = replace_special_tokens(islice(texts, min(chunk_size, num_rows - start)), mask_tok, sep_tok)
+        if not data:
+            raise ValueError(f'Corpus ended after {start} rows, but num_rows is {num_rows}')
+
+        if cache is not None:
+            output[start:start + len(data)] = encode_with_cache(model_id, data, batch_size, cache, load_sentence_model,
+                                                                max_batch_tokens)
+        else:
+            output[start:start + len(data)] = encode(sentence_model, data, batch_size, max_batch_tokens)
+        output.flush()
+
+        start += len(data)
+        # Checked before the output is marked complete, so that it is not returned as complete by the next call
+        if start == num_rows and next(texts, None) is not None:
+            raise ValueError(f'Corpus has more than num_rows = {num_rows} rows')
+
+        manifest['rows_written'] = start
+        atomic_write(manifest_path, lambda f: json.dump(manifest, f))
+
+    del output
+
+    return np.load(output_path, mmap_mode = 'r')
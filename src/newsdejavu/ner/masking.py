@@ -0,0 +1,128 @@
+'''
+Offset-based entity masking.
+
+mask() without texts rebuilds each article from the words of the NER output, joined by single spaces, which loses the
+article's own spacing and line breaks. splice_masks() instead copies the article and replaces the character span
+('start' to 'end') of every entity to mask with its mask token, in a single pass over the sorted entities. Everything
+outside the masked spans is kept exactly as it was.
+
+It can also return an offset map giving, for every character of the masked text, the position in the source article
+it comes from (the start of the entity for the characters of a mask token), so matches in the masked text can be
+traced back to the article.
+'''
+
+from typing import FrozenSet, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+GENERIC_MASK = '[MASK]'
+
+
+def mask_token(entity_group: str, all_masks_same: bool) -> str:
+    return GENERIC_MASK if all_masks_same else entity_group
+
+
+def splice_masks(text: str, entities: Iterable[dict], desired_labels: FrozenSet[str], all_masks_same: bool = True,
+                 with_offsets: bool = False) -> Tuple[str, Optional[np.ndarray]]:
+    """
+    Replaces the spans of the entities whose 'entity_group' is in desired_labels with mask tokens.
+
+    Returns:
+        Tuple[str, Optional[np.ndarray]]: The masked text, and if with_offsets is True an int32 array with the source
+        position of each of its characters.
+    """
+    pieces, offset_pieces = [], []
+    position = 0
+    for entity in sorted(entities, key = lambda entity: entity['start']):
+        if entity['entity_group'] not in desired_labels:
+            continue
+        start, end = entity['start'], entity['end']
+        if start is None or end is None:
+            raise ValueError('Offset-based masking needs NER outputs with character offsets (a fast tokenizer)')
+        # Entities overlapping an earlier masked one (e.g. from window overlaps) are already covered
+        if start < position:
+            continue
+
+        token = mask_token(entity['entity_group'], all_masks_same)
+        pieces.append(text[position:start])
+        pieces.append(token)
+        if with_offsets:
+            offset_pieces.append(np.arange(position, start, dtype = np.int32))
+            offset_pieces.append(np.full(len(token), start, dtype = np.int32))
+        position = end
+
+    pieces.append(text[position:])
+    if not with_offsets:
+        return ''.join(pieces), None
+
+    offset_pieces.append(np.arange(position, len(text), dtype = np.int32))
+    return ''.join(pieces), np.concatenate(offset_pieces)
+
+
+def splice_masks_batch(texts: Sequence[str], ner_output_list: Sequence[List[dict]],
+                       desired_labels: Iterable[str] = ('PER', 'ORG', 'LOC', 'MISC'), all_masks_same: bool = True,
+                       with_offsets: bool = False) -> Tuple[List[str], Optional[List[np.ndarray]]]:
+    """
+    Applies splice_masks() to every text of a batch with its NER output.
+
+    Returns:
+        Tuple[List[str], Optional[List[np.ndarray]]]: The masked texts, and their offset maps if with_offsets is True
+        (None otherwise).
+    """
+    if len(texts) != len(ner_output_list):
+        raise ValueError(f'Got {len(texts)} texts but {len(ner_output_list)} NER outputs')
+
+    desired_labels = frozenset(desired_labels)
+    masked_texts, offsets = [], []
+    for text, entities in zip(texts, ner_output_list):
+        masked_text, text_offsets = splice_masks(text, entities, desired_labels, all_masks_same, with_offsets)
+        masked_texts.append(masked_text)
+        offsets.append(text_offsets)
+
+    return masked_texts, offsets if with_offsets else None
+
+
+def mask_batch(texts: List[str], ner_output_list: List[List[dict]], masked_column: str, desired_labels: List[str],
+               all_masks_same: bool, with_offsets: bool) -> dict:
+    """
+    Dataset.map() function masking one batch of a text column.
+    """
+    masked_texts, offsets = splice_masks_batch(texts, ner_output_list, desired_labels, all_masks_same, with_offsets)
+    if not with_offsets:
+        return {masked_column: masked_texts}
+
+    return {masked_column: masked_texts, f'{masked_column}_offsets': offsets}
+
+
+def mask_dataset(dataset, ner_column: str = 'ner', column: str = 'article', masked_column: str = 'masked_article',
+                 desired_labels: List[str] = ['PER', 'ORG', 'LOC', 'MISC'], all_masks_same: bool = True,
+                 with_offsets: bool = False, num_proc: Optional[int] = None, batch_size: int = 1000):
+    """
+    Masks a text column of a datasets Dataset using the NER output stored in another column, with a batched
+    Dataset.map().
+
+    Args:
+        dataset (Dataset): The dataset, with a text column and a column of NER outputs (lists of entity dicts with
+            'entity_group', 'start' and 'end').
+        ner_column (str): The column of NER outputs. Defaults to 'ner'.
+        column (str): The text column the NER outputs refer to. Defaults to 'article'.
+        masked_column (str): The column the masked texts are written to. Defaults to 'masked_article'.
+        desired_labels (List[str]): Entity labels to mask. Defaults to ['PER', 'ORG', 'LOC', 'MISC'].
+        all_masks_same (bool): Whether to use a generic mask for all entities or their entity labels. Defaults to True.
+        with_offsets (bool): Whether to also write the offset map of each masked text, to masked_column + '_offsets'.
+            Defaults to False.
+        num_proc (Optional[int]): Number of processes to mask in. Defaults to masking in the calling process.
+        batch_size (int): Number of texts per map batch. Defaults to 1000.
+
+    Returns:
+        Dataset: The dataset with the masked column added.
+
+    Example:
+        >>> corpus = corpus.add_column('ner', ner(corpus, ner_model, stride = 32))
+        >>> corpus = mask_dataset(corpus, with_offsets = True)
+    """
+    return dataset.map(mask_batch, batched = True, batch_size = batch_size, num_proc = num_proc,
+                       input_columns = [column, ner_column],
+                       fn_kwargs = {'masked_column': masked_column, 'desired_labels': list(desired_labels),
+                                    'all_masks_same': all_masks_same, 'with_offsets': with_offsets},
+                       desc = 'Masking entities')
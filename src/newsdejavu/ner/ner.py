@@ -1,54 +1,195 @@
 ###Use NER models on Huggingface/local path to predict entities in the text
 
-from transformers import pipeline, AutoModelForTokenClassification, AutoTokenizer, PreTrainedModel, PreTrainedTokenizer
-from typing import List, Union
+from transformers import PreTrainedModel, PreTrainedTokenizer, Pipeline
+from typing import Iterator, List, Optional, Union
 
+import os
+import math
 import datetime
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 from tqdm import tqdm
 import torch
-from ..utils import clean_ocr_text, get_dataset
+from ..utils import get_dataset
+from ..utils.clean_text import clean_ocr_dataset
+from ..utils.prefetch import prefetch
+from ..utils.registry import get_token_classifier, get_tokenizer, model_name, loaded_model_settings
+from ..embed.cache import embedding_model_id
+from ..utils.batching import token_lengths, token_budget_batches
+from .windows import sliding_windows, merge_window_outputs
+from .masking import splice_masks_batch
 
 
+# Token classification pipeline of a ner() worker process, loaded once per process by init_ner_worker()
+worker_token_classifier = None
+worker_batch_size = 1
+worker_max_batch_tokens = None
+worker_max_length = None
 
+# Number of articles cleaned at a time when preprocess_for_ocr_errors is set
+OCR_CLEANING_SHARD_SIZE = 10000
 
-def ner(dataset, model_path: str, batch_size: int = 1,
+
+def ner_model_id(model: Union[str, Pipeline], torch_dtype: Optional[torch.dtype] = None, backend: str = 'torch') -> str:
+    """
+    Returns the identifier of a NER model run in the given dtype and on the given backend, in the form of
+    embedding_model_id(). The dtype and backend of an already-loaded pipeline are read from the pipeline itself.
+    """
+    if not isinstance(model, str):
+        torch_dtype, backend = loaded_model_settings(model)
+
+    return embedding_model_id(model_name(model), torch_dtype, backend)
+
+
+def run_token_classifier(token_classifier, inputs: List[str], batch_size: int,
+                         max_batch_tokens: Optional[int] = None, max_length: Optional[int] = None) -> List[List[dict]]:
+    """
+    Runs a token classification pipeline over the inputs. If max_batch_tokens is given, inputs are bucketed by
+    tokenized length into batches of at most max_batch_tokens padded tokens, and outputs are returned in input order.
+    Lengths are capped at max_length, the length the pipeline truncates inputs to.
+    """
+    if not max_batch_tokens:
+        return token_classifier(inputs, batch_size = batch_size)
+
+    lengths = token_lengths(token_classifier.tokenizer, inputs, max_length)
+    outputs = [None] * len(inputs)
+    for batch in tqdm(token_budget_batches(lengths, max_batch_tokens)):
+        batch_outputs = token_classifier([inputs[i] for i in batch], batch_size = len(batch))
+        for i, output in zip(batch, batch_outputs):
+            outputs[i] = output
+
+    return outputs
+
+
+def init_ner_worker(model_path: str, batch_size: int, max_length: int, torch_device: str,
+                    torch_dtype: Optional[torch.dtype], max_batch_tokens: Optional[int], num_threads: int,
+                    backend: str = 'torch'):
+    """
+    Initializes a ner() worker process: limits torch to its share of the cores and loads the model once.
+    """
+    global worker_token_classifier, worker_batch_size, worker_max_batch_tokens, worker_max_length
+
+    torch.set_num_threads(num_threads)
+    worker_token_classifier = get_token_classifier(model_path, max_length, torch_device, torch_dtype, backend)
+    worker_batch_size = batch_size
+    worker_max_batch_tokens = max_batch_tokens
+    worker_max_length = max_length
+
+
+def run_ner_worker(inputs: List[str]) -> List[List[dict]]:
+    return run_token_classifier(worker_token_classifier, inputs, worker_batch_size, worker_max_batch_tokens,
+                                worker_max_length)
+
+
+def parallel_ner(inputs: List[str], model_path: str, batch_size: int, max_length: int, torch_device: str,
+                 torch_dtype: Optional[torch.dtype], max_batch_tokens: Optional[int],
+                 num_workers: int, backend: str = 'torch') -> List[List[dict]]:
+    """
+    Runs NER over the inputs in num_workers processes, each using an equal share of the CPU cores, and returns the
+    outputs in the original order.
+    """
+    num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+
+    # Several shards per worker keep all workers busy when articles have very different lengths
+    shard_size = max(batch_size, math.ceil(len(inputs) / (num_workers * 4)))
+    shards = [inputs[start:start + shard_size] for start in range(0, len(inputs), shard_size)]
+
+    # Spawned workers do not inherit the parent's torch thread pool
+    with ProcessPoolExecutor(max_workers = num_workers, mp_context = multiprocessing.get_context("spawn"),
+                             initializer = init_ner_worker,
+                             initargs = (model_path, batch_size, max_length, torch_device, torch_dtype, max_batch_tokens,
+                                         num_threads, backend)) as executor:
+        outputs = []
+        for shard_output in tqdm(executor.map(run_ner_worker, shards), total = len(shards)):
+            outputs.extend(shard_output)
+
+    return outputs
+
+
+def cleaned_shards(dataset, shard_size: int, num_proc: Optional[int]) -> Iterator[List[str]]:
+    """
+    Yields the OCR-cleaned articles of dataset, shard_size at a time.
+    """
+    for start in range(0, len(dataset), shard_size):
+        shard = dataset.select(range(start, min(start + shard_size, len(dataset))))
+        yield list(clean_ocr_dataset(shard, num_proc = num_proc)['article'])
+
+
+def run_ner(inputs: List[str], token_classifier, model_path: Union[str, Pipeline], batch_size: int, max_length: int,
+            torch_device: str, torch_dtype: Optional[torch.dtype], max_batch_tokens: Optional[int],
+            stride: Optional[int], num_workers: int, backend: str = 'torch') -> List[List[dict]]:
+    """
+    Runs NER over a list of articles, in this process with token_classifier or in num_workers processes, windowing
+    long articles if stride is given.
+    """
+    if stride is not None:
+        tokenizer = token_classifier.tokenizer if token_classifier is not None else get_tokenizer(model_name(model_path))
+        articles = inputs
+        inputs, windows = sliding_windows(tokenizer, articles, max_length, stride)
+
+    if num_workers > 1:
+        outputs = parallel_ner(inputs, model_name(model_path), batch_size, max_length, torch_device, torch_dtype,
+                               max_batch_tokens, num_workers, backend)
+    else:
+        # Windows are at most max_length tokens long, so max_length also caps their lengths when stride is given
+        outputs = run_token_classifier(token_classifier, inputs, batch_size, max_batch_tokens, max_length)
+
+    if stride is not None:
+        outputs = merge_window_outputs(outputs, windows, articles)
+
+    return outputs
+
+
+def ner(dataset, model_path: Union[str, Pipeline], batch_size: int = 1,
         max_length: int = 256, torch_device: str = "cuda:0" if torch.cuda.is_available() else "cpu",
-        preprocess_for_ocr_errors: bool = False) -> List[dict]:
+        preprocess_for_ocr_errors: bool = False, num_workers: int = 1,
+        torch_dtype: Optional[torch.dtype] = None, max_batch_tokens: Optional[int] = None,
+        stride: Optional[int] = None, clean_num_proc: Optional[int] = None, backend: str = 'torch') -> List[dict]:
     """
     Processes a list of sentences to identify and tag named entities using a specified model.
 
     Args:
         sentences (List[str]): A list of sentences to process.
-        model_path (str): The file path or model identifier of the pretrained model.
+        model_path (Union[str, Pipeline]): The file path or model identifier of the pretrained model, or an already-loaded token classification pipeline. Models given by path are loaded once per process and reused by later calls (see utils.registry).
         batch_size (int): The number of sentences to process in a single batch. Defaults to 1.
-        max_length (int): The maximum length of the sentences. Sentences longer than this will be truncated. Defaults to 256.
+        max_length (int): The maximum length of the sentences. Sentences longer than this will be truncated, unless stride is given. Defaults to 256.
         torch_device (str): The torch device to use for model inference. Defaults to "cuda:0" if CUDA is available, else "cpu".
+        preprocess_for_ocr_errors (bool): Whether to clean common OCR errors from the sentences first. Cleaning runs as a batched Dataset.map(), cached on disk for datasets loaded from files, and the next shard is cleaned in a background thread while the model runs on the current one. Defaults to False.
+        num_workers (int): The number of processes to run inference in. Each process loads the model once and uses an equal share of the CPU cores, which speeds up NER on CPU-only machines. Defaults to 1.
+        torch_dtype (Optional[torch.dtype]): The dtype to load the model in, e.g. torch.float16 on GPU. Defaults to the model's own dtype.
+        max_batch_tokens (Optional[int]): If provided, sentences are sorted by tokenized length and batched so that each batch holds at most this many tokens including padding, instead of batch_size sentences in corpus order. Outputs keep the input order. Defaults to None.
+        stride (Optional[int]): If provided, sentences longer than max_length tokens are cut into windows of max_length tokens overlapping by stride tokens instead of being truncated. The windows of all sentences are batched together, and their entities are merged back with 'start' and 'end' as character offsets in the sentence. Requires a fast tokenizer. Defaults to None.
+        clean_num_proc (Optional[int]): The number of processes Dataset.map() cleans each shard in, if preprocess_for_ocr_errors is True. Defaults to cleaning in a background thread of this process.
+        backend (str): The inference backend of models given by path: 'torch', or 'onnx' / 'onnx-int8' to run the model on CPU with ONNX Runtime, with float32 or dynamically quantized int8 weights (see newsdejavu.backends). The exported ONNX graphs are cached on disk. Defaults to 'torch'.
 
     Returns:
         List[dict]: A list of dictionaries containing the NER output for each sentence.
     """
     
-    
-    model=AutoModelForTokenClassification.from_pretrained(model_path)
-    print("Loaded ner model")
-
-    tokenizer=AutoTokenizer.from_pretrained(model_path, return_tensors="pt",
-                                            max_length=max_length, truncation=True)
-    print("Loaded tokenizer")
-    token_classifier = pipeline(task="ner" ,
-                                model=model, tokenizer=tokenizer,
-                                aggregation_strategy="max", ignore_labels = [],
-                                batch_size=batch_size, device=torch_device)
-    
 
     dataset = get_dataset(dataset)
-    inputs = dataset['article']
+
+    token_classifier = None
+    if num_workers <= 1:
+        if isinstance(model_path, str):
+            token_classifier = get_token_classifier(model_path, max_length, torch_device, torch_dtype, backend)
+        else:
+            token_classifier = model_path
 
     if preprocess_for_ocr_errors:
-        inputs = [clean_ocr_text(i, True, ["#","/","*","@","~","¢","©","®","°"])[0] for i in inputs]
+        # A single shard for num_workers > 1, which starts its worker processes once per shard
+        shard_size = max(1, len(dataset)) if num_workers > 1 else max(batch_size, OCR_CLEANING_SHARD_SIZE)
+        shards = prefetch(cleaned_shards(dataset, shard_size, clean_num_proc))
+    else:
+        shards = [list(dataset['article'])]
 
-    return token_classifier(inputs)
+    outputs = []
+    for inputs in shards:
+        outputs.extend(run_ner(inputs, token_classifier, model_path, batch_size, max_length, torch_device, torch_dtype,
+                               max_batch_tokens, stride, num_workers, backend))
+
+    return outputs
 
 def handle_punctuation_for_generic_mask(word):
     """If punctuation comes before the word, return it before the mask, ow return it after the mask"""
@@ -94,7 +235,8 @@ def replace_words_with_entity_tokens(ner_output_dict: List[dict],
     return " ".join(new_word_list)
 
 def mask(ner_output_list: List[List[dict]], desired_labels: List[str] = ['PER', 'ORG', 'LOC', 'MISC'],
-                         all_masks_same: bool = True) -> List[str]:
+                         all_masks_same: bool = True, texts: Optional[List[str]] = None,
+                         return_offsets: bool = False) -> List[str]:
     """
     Processes a list of NER outputs, replacing identified entities in each sentence based on the specified labels and masking preferences.
 
@@ -102,30 +244,46 @@ def mask(ner_output_list: List[List[dict]], desired_labels: List[str] = ['PER',
         ner_output_list (List[List[dict]]): A list containing the NER output for multiple sentences.
         desired_labels (List[str]): Entity labels to mask. Defaults to ['PER', 'ORG', 'LOC', 'MISC'].
         all_masks_same (bool): Whether to use a generic mask for all entities or to use specific entity labels. Defaults to True.
+        texts (Optional[List[str]]): The sentences the NER outputs were computed on. If provided, the entity spans are replaced in place using the 'start' and 'end' character offsets (see ner.masking), which keeps the original spacing and punctuation and is faster than rebuilding each sentence from its words. Defaults to None.
+        return_offsets (bool): With texts, also return for each masked sentence an int32 array with the position in the original sentence of each of its characters. Defaults to False.
 
     Returns:
-        List[str]: A list of sentences with entities replaced according to the specified criteria.
+        List[str]: A list of sentences with entities replaced according to the specified criteria (and their offset maps if return_offsets is True).
     """
-    
+    if texts is not None:
+        masked_texts, offsets = splice_masks_batch(texts, ner_output_list, desired_labels, all_masks_same, return_offsets)
+        return (masked_texts, offsets) if return_offsets else masked_texts
+    if return_offsets:
+        raise ValueError('Offsets can only be returned when masking with texts')
+
     return [replace_words_with_entity_tokens(ner_output,desired_labels,all_masks_same) for ner_output in ner_output_list]
 
 
 
-def ner_and_mask(sentences: List[str], model_path: str, batch_size: int = 1, max_length: int = 256,
+def ner_and_mask(sentences: List[str], model_path: Union[str, Pipeline], batch_size: int = 1, max_length: int = 256,
                          torch_device: str = "cuda:0" if torch.cuda.is_available() else "cpu",
                          labels_to_mask: List[str] = ['PER', 'ORG', 'LOC', 'MISC'], all_masks_same: bool = True,
-                         preprocess_for_ocr_errors: bool =False) -> List[str]:
+                         preprocess_for_ocr_errors: bool =False, num_workers: int = 1,
+                         max_batch_tokens: Optional[int] = None, stride: Optional[int] = None,
+                         clean_num_proc: Optional[int] = None, use_offsets: bool = False,
+                         backend: str = 'torch') -> List[str]:
     """
     Obtains masked versions of input sentences by running NER and replacing identified entities based on the specified labels and masking preferences.
 
     Args:
         sentences (List[str]): The input sentences to process.
-        model_path (str): Path or identifier for the pretrained model used for NER.
+        model_path (Union[str, Pipeline]): Path or identifier for the pretrained model used for NER, or an already-loaded token classification pipeline.
         batch_size (int): The number of sentences to process in a single batch. Helps manage memory usage and computational load.
         max_length (int): The maximum allowed length for the sentences. Longer sentences are truncated to this length.
         torch_device (str): The device on which the NER model is executed. Can be a CPU or CUDA-enabled GPU device identifier.
         labels_to_mask (List[str]): A list of entity labels (e.g., 'PER' for person, 'ORG' for organization) that should be masked. Other entities will be left unchanged.
         all_masks_same (bool): Indicates whether to use a generic mask for all entities (True) or to mask entities with their specific label (False).
+        num_workers (int): The number of processes to run NER in. Defaults to 1.
+        max_batch_tokens (Optional[int]): If provided, NER batches are built from sentences of similar length with at most this many padded tokens each. Defaults to None.
+        stride (Optional[int]): If provided, sentences longer than max_length tokens are processed in windows overlapping by this many tokens instead of being truncated. Defaults to None.
+        clean_num_proc (Optional[int]): The number of processes to clean OCR errors in, if preprocess_for_ocr_errors is True. Defaults to None.
+        use_offsets (bool): Whether to mask by replacing entity spans in the sentences (see mask()), keeping their original spacing, instead of rebuilding them from the NER words. With preprocess_for_ocr_errors, the cleaned sentences are masked. Defaults to False.
+        backend (str): The inference backend of models given by path, 'torch', 'onnx' or 'onnx-int8' (see ner()). Defaults to 'torch'.
 
     Returns:
         List[str]: A list of sentences with specified entities masked according to the provided parameters. Each sentence in the list corresponds to an input sentence, transformed based on NER results and masking preferences.
@@ -137,7 +295,19 @@ def ner_and_mask(sentences: List[str], model_path: str, batch_size: int = 1, max
         >>> print(masked_sentences)
         ["[PER] works at [ORG] in [LOC]."]
     """    
-    ner_output_list = ner(sentences, model_path, batch_size, max_length, torch_device, preprocess_for_ocr_errors)
+    if use_offsets:
+        # The entity offsets refer to the text NER saw, so cleaning is done up front
+        dataset = get_dataset(sentences)
+        if preprocess_for_ocr_errors:
+            dataset = clean_ocr_dataset(dataset, num_proc = clean_num_proc)
+        ner_output_list = ner(dataset, model_path, batch_size, max_length, torch_device, False, num_workers,
+                              max_batch_tokens = max_batch_tokens, stride = stride, backend = backend)
+
+        return mask(ner_output_list, labels_to_mask, all_masks_same, texts = dataset['article'])
+
+    ner_output_list = ner(sentences, model_path, batch_size, max_length, torch_device, preprocess_for_ocr_errors, num_workers,
+                          max_batch_tokens = max_batch_tokens, stride = stride, clean_num_proc = clean_num_proc,
+                          backend = backend)
     
     return mask(ner_output_list, labels_to_mask, all_masks_same)
 
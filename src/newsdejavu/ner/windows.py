@@ -0,0 +1,97 @@
+'''
+Sliding-window chunking for NER on long articles.
+
+A token classification model only sees max_length tokens at a time, so without chunking the tail of a long article is
+either truncated away or processed in one oversized pass. sliding_windows() instead cuts every article into windows of
+at most max_length tokens that overlap by stride tokens, using the tokenizer's character offsets so each window is a
+plain substring of the article. All windows of all articles can then be batched through the pipeline together.
+
+merge_window_outputs() maps the entities found in each window back to character offsets in the article. Each window
+owns the characters up to the middle of its overlap with the next window, and only entities starting before that point
+are taken from it, so every part of the article is labelled once, mostly by the window in which it has the most context.
+Groups crossing into characters already labelled by the previous window are trimmed rather than dropped.
+'''
+
+from typing import List, Tuple
+
+
+def sliding_windows(tokenizer, texts: List[str], max_length: int, stride: int,
+                    chunk_size: int = 1000) -> Tuple[List[str], List[List[Tuple[int, int]]]]:
+    """
+    Cuts texts into overlapping windows of at most max_length tokens (including special tokens).
+
+    Args:
+        tokenizer: A fast tokenizer of the NER model (offsets are needed).
+        texts (List[str]): The articles to cut.
+        max_length (int): The maximum number of tokens per window, including special tokens.
+        stride (int): The number of tokens shared by consecutive windows.
+        chunk_size (int): Number of texts tokenized at a time.
+
+    Returns:
+        Tuple[List[str], List[List[Tuple[int, int]]]]: The text of every window, in order, and for each article the
+        (start, end) character span of each of its windows.
+    """
+    window_tokens = max_length - tokenizer.num_special_tokens_to_add(pair = False)
+    if stride < 0 or stride >= window_tokens:
+        raise ValueError(f'stride must be between 0 and {window_tokens - 1} for max_length {max_length}, got {stride}')
+    step = window_tokens - stride
+
+    window_texts = []
+    windows = []
+    for start in range(0, len(texts), chunk_size):
+        chunk = texts[start:start + chunk_size]
+        encoded = tokenizer(chunk, add_special_tokens = False, return_offsets_mapping = True)
+        for text, offsets in zip(chunk, encoded['offset_mapping']):
+            if len(offsets) <= window_tokens:
+                spans = [(0, len(text))]
+            else:
+                spans = []
+                for first in range(0, len(offsets), step):
+                    last = min(first + window_tokens, len(offsets)) - 1
+                    spans.append((offsets[first][0], offsets[last][1]))
+                    if last == len(offsets) - 1:
+                        break
+
+            windows.append(spans)
+            window_texts.extend(text[span_start:span_end] for span_start, span_end in spans)
+
+    return window_texts, windows
+
+
+def merge_window_outputs(window_outputs: List[List[dict]], windows: List[List[Tuple[int, int]]],
+                         texts: List[str]) -> List[List[dict]]:
+    """
+    Merges the pipeline outputs of the windows of each article into one output per article, with 'start' and 'end'
+    shifted to character offsets in the article. A group that starts before the end of the groups already merged (in
+    the overlap with the previous window) is trimmed to the characters after them, and its 'word' is replaced by the
+    remaining article text, so no part of the article is lost at a window boundary.
+    """
+    outputs = []
+    window_index = 0
+    for text, spans in zip(texts, windows):
+        merged = []
+        last_end = 0
+        for i, (span_start, span_end) in enumerate(spans):
+            own_end = span_end if i == len(spans) - 1 else (spans[i + 1][0] + span_end) // 2
+
+            for entity in window_outputs[window_index + i]:
+                start, end = entity['start'] + span_start, entity['end'] + span_start
+                if start >= own_end or end <= last_end:
+                    continue
+
+                entity = {**entity, 'start': start, 'end': end}
+                if start < last_end:
+                    start = last_end
+                    while start < end and text[start].isspace():
+                        start += 1
+                    if start == end:
+                        continue
+                    entity.update(start = start, word = text[start:end])
+
+                merged.append(entity)
+                last_end = end
+
+        outputs.append(merged)
+        window_index += len(spans)
+
+    return outputs
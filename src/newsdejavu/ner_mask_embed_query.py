@@ -1,5 +1,14 @@
+import os
+import json
+import numpy as np
+import pandas as pd
 from typing import List, Dict, Optional, Union, Tuple
 from newsdejavu import ner_and_mask, embed, find_nearest_neighbours
+from newsdejavu.query import CorpusIndex, ShardedCorpusIndex
+from newsdejavu.query.filters import filter_mask
+from newsdejavu.dedup import reprint_clusters
+from newsdejavu.utils.cache import corpus_fingerprint, load_masked_sentences, save_masked_sentences, load_embeddings, save_embeddings, embeddings_saved
+from newsdejavu.utils.query_cache import QueryCache
 
 
 def search_same_story(query_sentences: List[str],
@@ -10,7 +19,15 @@ def search_same_story(query_sentences: List[str],
                          k=1,
                          corpus_ner_mask_path: Optional[str] = None,
                          corpus_embed_path: Optional[str] = None,
-                         corpus_id_map: Optional[Dict[int, str]] = None) -> List[Tuple[str, str]]:
+                         corpus_id_map: Optional[Dict[int, str]] = None,
+                         corpus_index: Optional[Union[CorpusIndex, ShardedCorpusIndex]] = None,
+                         filters: Optional[Dict] = None,
+                         corpus_metadata = None,
+                         dedup_threshold: Optional[float] = None,
+                         query_cache: Optional[QueryCache] = None,
+                         mask_options: Optional[Dict] = None,
+                         index_type: str = 'flat',
+                         **index_kwargs) -> List[Tuple[str, str]]:
     """
     Applies Named Entity Recognition (NER) and masking to a list of query and corpus sentences, embeds them using a specified sentence embedding model, and finds the nearest neighbours for each query sentence in the corpus.
 
@@ -21,15 +38,24 @@ def search_same_story(query_sentences: List[str],
         sentence_model (str): The model identifier for the sentence embedding model to use.
         batch_size (int, optional): The batch size for processing sentences through the NER model. Defaults to 256.
         k (int, optional): The number of nearest neighbours to find for each query sentence. Defaults to 1.
-        corpus_ner_mask_path (Optional[str], optional): If provided, the function will load pre-masked corpus sentences from this path instead of masking them during runtime. Defaults to None.
-        corpus_embed_path (Optional[str], optional): If provided, the function will load pre-computed corpus embeddings from this path instead of embedding them during runtime. Defaults to None.
+        corpus_ner_mask_path (Optional[str], optional): If provided, the function will load pre-masked corpus sentences from this path instead of masking them during runtime. If the file does not exist yet, the masked corpus is written there after masking. Defaults to None.
+        corpus_embed_path (Optional[str], optional): If provided, the function will load pre-computed corpus embeddings (.npy) from this path instead of embedding them during runtime. If the file does not exist yet, the embeddings are written there after embedding. Defaults to None.
         corpus_id_map (Optional[Dict[int, str]], optional): A dictionary mapping sentence indices to their corresponding raw corpus sentences. If not provided, a map is generated within the function.
+        corpus_index (Optional[CorpusIndex], optional): A prebuilt (or loaded) index over the corpus embeddings, possibly sharded by year with ShardedCorpusIndex. If provided, the corpus is not masked, embedded or indexed again, and the index's own id map is used when corpus_id_map is not given. Defaults to None.
+        filters (Optional[Dict], optional): Restricts the search to corpus rows whose metadata satisfies the filters, e.g. {'date': ('1860', '1865'), 'newspaper_name': ['The Sun']} (see newsdejavu.query.filters). Only matching rows are scanned. Defaults to None.
+        corpus_metadata (optional): Per-sentence metadata columns (a pandas DataFrame or a dict of lists) stored in the index built over the corpus, for filters. A corpus_index carries its own metadata. Defaults to None.
+        dedup_threshold (Optional[float], optional): If provided, reprints in the corpus (texts whose word shingles have an estimated Jaccard similarity of at least dedup_threshold, see newsdejavu.dedup) are grouped before masking and embedding. Only the first text of each reprint cluster is masked, embedded and returned, and each output also gets a "reprint_count_list" with the size of each neighbour's cluster. With filters, a cluster is searched if any of its reprints matches, the first matching reprint is returned and only matching reprints are counted. Only applies when corpus_index is not given, and needs corpus_sentences. Defaults to None.
+        query_cache (Optional[QueryCache], optional): An in-memory cache of query masked texts and embeddings (see newsdejavu.utils.query_cache), shared across calls. Queries already in it skip the NER and embedding passes. Defaults to None.
+        mask_options (Optional[Dict], optional): Further keyword arguments of ner_and_mask() used to mask both the queries and the corpus, e.g. {'labels_to_mask': ['PER'], 'all_masks_same': False}. They are part of the query cache key and of the corpus cache metadata. Defaults to None.
+        index_type (str, optional): The type of index built over the corpus embeddings when corpus_index is not given, e.g. 'sq8' or 'binary' to hold the corpus in a quarter or a 32nd of the memory. Further keyword arguments (e.g. rescore = True) are passed to CorpusIndex.build(). Defaults to 'flat'.
 
     Returns:
         List[Tuple[str, str]]: A list of tuples, each containing a query sentence and its closest matching sentence from the corpus based on semantic similarity.
 
     This function processes both query and corpus sentences through NER and masking, then embeds them using the specified sentence model. It finds the nearest neighbour for each query sentence within the corpus and returns these pairs along with their original (raw) form.
 
+    Cached corpus artifacts are stored with the model names and a fingerprint of corpus_sentences, and a ValueError is raised if a cache at corpus_ner_mask_path or corpus_embed_path was written for a different corpus or model.
+
     Example:
         >>> query_sentences_with_entities = ["Elon Musk's SpaceX is leading the private space industry."]
         >>> corpus_sentences_with_entities = ["Jeff Bezos' Blue Origin competes with SpaceX in the commercial space race."]
@@ -39,19 +65,94 @@ def search_same_story(query_sentences: List[str],
         [("Elon Musk's SpaceX is leading the private space industry.", "Jeff Bezos' Blue Origin competes with SpaceX in the commercial space race.")]
     """
 
-
-    if not  corpus_ner_mask_path and not corpus_embed_path:
-        ner_masked_corpus=ner_and_mask(corpus_sentences, ner_model, batch_size = batch_size)
-    if not corpus_embed_path:
-        corpus_embeddings=embed(ner_masked_corpus, sentence_model, save_path=None)
+    if corpus_sentences is None:
+        # The corpus can then only come from a prebuilt index or from the caches, and be reported through an id map
+        has_corpus_cache=bool((corpus_embed_path and embeddings_saved(corpus_embed_path)) or
+                              (corpus_ner_mask_path and os.path.exists(corpus_ner_mask_path)))
+        if corpus_index is None and not has_corpus_cache:
+            raise ValueError('Without corpus_sentences, a corpus_index or an existing cache at corpus_ner_mask_path or '
+                             'corpus_embed_path is needed')
+        if not corpus_id_map and (corpus_index is None or corpus_index.id_map is None):
+            raise ValueError('Without corpus_sentences, a corpus_id_map (or a corpus_index with an id map) is needed to '
+                             'report the neighbours')
+
+    if corpus_index is None:
+        if dedup_threshold is not None and corpus_sentences is None:
+            raise ValueError('dedup_threshold needs corpus_sentences to find the reprints in')
+
+        # Every setting that changes the cached rows is recorded, unset ones included, so that a cache written with
+        # other settings is rejected rather than reused. Without corpus_sentences, the corpus can only be taken from
+        # the caches, and is not checked.
+        # mask_options are normalized to their JSON form, as they are read back from the cache
+        mask_metadata={"ner_model":ner_model, "dedup_threshold":dedup_threshold,
+                       "mask_options":json.loads(json.dumps(mask_options or {}, sort_keys=True))}
+        if corpus_sentences is not None:
+            mask_metadata["corpus_fingerprint"]=corpus_fingerprint(corpus_sentences)
+        embed_metadata={**mask_metadata, "sentence_model":sentence_model}
+
+        # Reprints are masked and embedded once, through the first text of their cluster
+        clusters=reprint_clusters(corpus_sentences, dedup_threshold) if dedup_threshold is not None else None
+        cluster_rows=None
+        if clusters is not None:
+            embedded_sentences=[corpus_sentences[i] for i in clusters.representatives]
+            cluster_rows=clusters.representatives
+            reprint_counts_by_cluster=clusters.counts
+            if filters:
+                # A cluster matches if any of its reprints does, and is then represented by its first matching reprint
+                # and counted by its matching reprints
+                if corpus_metadata is None:
+                    raise ValueError('filters need corpus_metadata to filter on')
+                matching=np.flatnonzero(filter_mask(pd.DataFrame(corpus_metadata).reset_index(drop=True), filters))
+                cluster_numbers=np.searchsorted(clusters.representatives, clusters.labels[matching])
+                reprint_counts_by_cluster=np.bincount(cluster_numbers, minlength=len(clusters))
+                cluster_rows=np.full(len(clusters), len(corpus_sentences))
+                np.minimum.at(cluster_rows, cluster_numbers, matching)
+                corpus_metadata=None
+            elif corpus_metadata is not None:
+                corpus_metadata=pd.DataFrame(corpus_metadata).iloc[clusters.representatives]
+        else:
+            embedded_sentences=corpus_sentences
+
+        if corpus_embed_path and embeddings_saved(corpus_embed_path):
+            corpus_embeddings=load_embeddings(corpus_embed_path, embed_metadata)
+        else:
+            if corpus_ner_mask_path and os.path.exists(corpus_ner_mask_path):
+                ner_masked_corpus=load_masked_sentences(corpus_ner_mask_path, mask_metadata)
+            else:
+                ner_masked_corpus=ner_and_mask(embedded_sentences, ner_model, batch_size = batch_size, **(mask_options or {}))
+                if corpus_ner_mask_path:
+                    save_masked_sentences(corpus_ner_mask_path, ner_masked_corpus, mask_metadata)
+
+            corpus_embeddings=embed(ner_masked_corpus, sentence_model, save_path=None)
+            if corpus_embed_path:
+                save_embeddings(corpus_embed_path, corpus_embeddings, embed_metadata)
+
+        corpus_index=CorpusIndex.build(corpus_embeddings, index_type=index_type, metadata=corpus_metadata, **index_kwargs)
+    else:
+        clusters=None
     
-    ner_masked_queries=ner_and_mask(query_sentences, ner_model, batch_size = batch_size)
-    query_embeddings=embed(ner_masked_queries, sentence_model, save_path=None)
+    if query_cache is not None:
+        ner_masked_queries, query_embeddings=query_cache.mask_and_embed(
+            query_sentences, ner_model, sentence_model,
+            lambda queries: ner_and_mask(queries, ner_model, batch_size = batch_size, **(mask_options or {})),
+            lambda masked_queries: embed(masked_queries, sentence_model, save_path=None),
+            mask_options = mask_options)
+    else:
+        ner_masked_queries=ner_and_mask(query_sentences, ner_model, batch_size = batch_size, **(mask_options or {}))
+        query_embeddings=embed(ner_masked_queries, sentence_model, save_path=None)
     
 
-    dist_list, nn_list=find_nearest_neighbours(query_embeddings, corpus_embeddings, k=k)
+    if clusters is not None and filters:
+        dist_list, nn_list=corpus_index.search_allowed(query_embeddings, k, reprint_counts_by_cluster > 0)
+    else:
+        dist_list, nn_list=find_nearest_neighbours(query_embeddings, corpus_index, k=k, filters=filters)
+    if clusters is not None:
+        reprint_counts=np.where(nn_list >= 0, reprint_counts_by_cluster[np.maximum(nn_list, 0)], 0)
+        nn_list=np.where(nn_list >= 0, cluster_rows[np.maximum(nn_list, 0)], -1)
 
     ###Get corresponding raw sentences - for each query, get the nearest neighbour and return the raw sentences from the corpus
+    if not corpus_id_map:
+        corpus_id_map=corpus_index.id_map
     if not corpus_id_map:
         corpus_id_map={i:corpus_sentences[i] for i in range(len(corpus_sentences))}
         
@@ -59,38 +160,40 @@ def search_same_story(query_sentences: List[str],
     output_dict={}
     for i in range(len(query_sentences)):
         output_dict[i]={"query":query_sentences[i],
-                        "neighbor_list":[corpus_id_map[nn] for nn in nn_list[i]],
-                        "distance_list":[dist for dist in dist_list[i]]}
+                        "neighbor_list":[corpus_id_map[nn] for nn in nn_list[i] if nn >= 0],
+                        "distance_list":[dist for dist, nn in zip(dist_list[i], nn_list[i]) if nn >= 0]}
+        if clusters is not None:
+            output_dict[i]["reprint_count_list"]=[int(count) for count, nn in zip(reprint_counts[i], nn_list[i]) if nn >= 0]
     
     return  output_dict
     
 
 
 
-query_sentences_with_entities = [
-    "Elon Musk's SpaceX is leading the private space industry.",
-    "The United Nations addressed climate change at the conference in Paris.",
-    "Serena Williams triumphed at the Wimbledon Championships."
-]
+if __name__ == '__main__':
+    query_sentences_with_entities = [
+        "Elon Musk's SpaceX is leading the private space industry.",
+        "The United Nations addressed climate change at the conference in Paris.",
+        "Serena Williams triumphed at the Wimbledon Championships."
+    ]
 
-corpus_sentences_with_entities = [
-    "Tesla, founded by Elon Musk, revolutionizes the electric vehicle market.",
-    "The Paris Agreement aims to strengthen the global response to the threat of climate change.",
-    "The FIFA World Cup is watched by millions of fans worldwide.",
-    "Jeff Bezos' Blue Origin competes with SpaceX in the commercial space race.",
-    "The World Health Organization plays a crucial role in managing global health crises.",
-    "Roger Federer is known for his exceptional achievements in tennis.",
-    "The Kyoto Protocol was an earlier international treaty aimed at combating global warming."
-]
+    corpus_sentences_with_entities = [
+        "Tesla, founded by Elon Musk, revolutionizes the electric vehicle market.",
+        "The Paris Agreement aims to strengthen the global response to the threat of climate change.",
+        "The FIFA World Cup is watched by millions of fans worldwide.",
+        "Jeff Bezos' Blue Origin competes with SpaceX in the commercial space race.",
+        "The World Health Organization plays a crucial role in managing global health crises.",
+        "Roger Federer is known for his exceptional achievements in tennis.",
+        "The Kyoto Protocol was an earlier international treaty aimed at combating global warming."
+    ]
 
-ner_model="/mnt/122a7683-fa4b-45dd-9f13-b18cc4f4a187/thisdayinhistory/models"
-sentence_model="/mnt/122a7683-fa4b-45dd-9f13-b18cc4f4a187/thisdayinhistory/same_story_model"
+    ner_model="/mnt/122a7683-fa4b-45dd-9f13-b18cc4f4a187/thisdayinhistory/models"
+    sentence_model="/mnt/122a7683-fa4b-45dd-9f13-b18cc4f4a187/thisdayinhistory/same_story_model"
 
 
 
-print(search_same_story(query_sentences_with_entities,
-                           corpus_sentences_with_entities,
-                           ner_model,
-                           sentence_model,
-                           k=2))
-    
\ No newline at end of file
+    print(search_same_story(query_sentences_with_entities,
+                               corpus_sentences_with_entities,
+                               ner_model,
+                               sentence_model,
+                               k=2))
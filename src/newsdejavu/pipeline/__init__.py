@@ -0,0 +1,2 @@
+from .runner import run_pipeline
+from .streaming import stream_ner_mask_embed
\ No newline at end of file
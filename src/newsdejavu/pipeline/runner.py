@@ -0,0 +1,173 @@
+'''
+Resumable corpus pipeline: download -> NER -> mask -> embed -> index.
+
+The corpus is split into numbered shards of shard_size articles, and each stage writes its output for each shard to
+output_dir as soon as the shard is done:
+
+- ner_{shard}.json: the raw NER output
+- masked_{shard}.json: the masked articles
+- embeddings_{shard}.npy: the normalised embeddings
+
+A manifest.json in output_dir records which stages have completed for which shards, together with the models, shard
+size and a fingerprint of the corpus. If the run crashes, calling run_pipeline() again with the same arguments skips
+every finished shard and stage, so at most one shard of work is lost. Once all shards are embedded, the embeddings are
+combined into a CorpusIndex saved to output_dir/index. The manifest also records the index settings (index type, id and
+metadata columns), and a run with different index settings rebuilds the index from the saved embeddings.
+'''
+
+import os
+import json
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from ..download import download
+from ..ner import ner, mask
+from ..embed import embed
+from ..query import CorpusIndex
+from ..utils import get_dataset
+from ..utils.cache import atomic_write, corpus_fingerprint
+
+MANIFEST_FILE = 'manifest.json'
+INDEX_DIR = 'index'
+STAGES = ['ner', 'mask', 'embed']
+
+
+def shard_path(output_dir: str, stage: str, shard: int) -> str:
+    """
+    Returns the path of the output file of a stage for a shard.
+    """
+    file_names = {'ner': f'ner_{shard:05d}.json', 'mask': f'masked_{shard:05d}.json', 'embed': f'embeddings_{shard:05d}.npy'}
+
+    return os.path.join(output_dir, file_names[stage])
+
+
+def to_json(value):
+    """
+    Converts the numpy scalars in NER output (e.g. float32 scores) to plain Python numbers for JSON.
+    """
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def load_manifest(output_dir: str, settings: Dict) -> Dict:
+    """
+    Loads the manifest of a previous run, or starts a new one. Raises a ValueError if the previous run used different
+    settings, since its shards cannot be reused.
+    """
+    manifest_path = os.path.join(output_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return {**settings, 'shards': {}, 'index': False}
+
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+
+    mismatched = [key for key, value in settings.items() if manifest.get(key) != value]
+    if mismatched:
+        raise ValueError(f'{output_dir} contains a run with different settings ({", ".join(mismatched)}). '
+                         f'Delete it or pass a different output_dir.')
+
+    return manifest
+
+
+def save_manifest(output_dir: str, manifest: Dict):
+    atomic_write(os.path.join(output_dir, MANIFEST_FILE), lambda f: json.dump(manifest, f, indent = 4))
+
+
+def run_pipeline(corpus, ner_model: str, sentence_model: str, output_dir: str, shard_size: int = 10000,
+                 ner_batch_size: int = 256, embed_batch_size: int = 512, id_column: Optional[str] = None,
+                 metadata_columns: Optional[List[str]] = None, index_type: str = 'flat', **index_kwargs) -> CorpusIndex:
+    """
+    Runs NER, masking and embedding over a corpus shard by shard with checkpointing, then builds a corpus index.
+
+    Args:
+        corpus: A download string (e.g. 'american stories:1840-1849'), or any input accepted by get_dataset() with an
+            'article' column.
+        ner_model (str): Path or identifier of the NER model.
+        sentence_model (str): Path or identifier of the sentence embedding model.
+        output_dir (str): Directory for the per-shard outputs, the manifest and the final index.
+        shard_size (int): Number of articles per shard. Defaults to 10000.
+        ner_batch_size (int): Batch size for NER inference. Defaults to 256.
+        embed_batch_size (int): Batch size for embedding. Defaults to 512.
+        id_column (Optional[str]): Column whose values are used as the index's id map (e.g. 'article_id'). If not
+            provided, the index reports row numbers.
+        metadata_columns (Optional[List[str]]): Columns stored with the index for filtered search (e.g. ['date',
+            'newspaper_name']).
+        index_type (str): Index type passed to CorpusIndex.build(), along with any further keyword arguments.
+
+    Returns:
+        CorpusIndex: The index over the whole corpus, also saved to output_dir/index.
+
+    Example:
+        >>> corpus_index = run_pipeline('american stories:1840-1849', ner_model, same_story_model, 'data/pipeline_1840s')
+        >>> dist_list, nn_list = find_nearest_neighbours(query_embeddings, corpus_index, k = 5)
+    """
+    if isinstance(corpus, str) and not os.path.exists(corpus):
+        corpus = download(corpus)
+    dataset = get_dataset(corpus)
+    if len(dataset) == 0:
+        raise ValueError('The corpus has no articles to index')
+
+    os.makedirs(output_dir, exist_ok = True)
+    settings = {'ner_model': ner_model, 'sentence_model': sentence_model, 'shard_size': shard_size,
+                'num_rows': len(dataset),
+                'corpus_fingerprint': corpus_fingerprint(article for batch in dataset.iter(batch_size = shard_size)
+                                                         for article in batch['article'])}
+    manifest = load_manifest(output_dir, settings)
+
+    # Round-tripped through JSON so that it compares equal to the settings stored in the manifest
+    index_settings = json.loads(json.dumps({'index_type': index_type, 'index_kwargs': index_kwargs,
+                                            'id_column': id_column, 'metadata_columns': metadata_columns}))
+    if manifest['index'] == index_settings and os.path.isdir(os.path.join(output_dir, INDEX_DIR)):
+        return CorpusIndex.load(os.path.join(output_dir, INDEX_DIR))
+
+    num_shards = (len(dataset) + shard_size - 1) // shard_size
+    for shard in range(num_shards):
+        completed = manifest['shards'].setdefault(str(shard), [])
+        if len(completed) == len(STAGES):
+            continue
+
+        print(f'processing shard {shard + 1}/{num_shards}')
+        shard_dataset = dataset.select(range(shard * shard_size, min((shard + 1) * shard_size, len(dataset))))
+
+        if 'ner' not in completed:
+            ner_output = ner(shard_dataset, ner_model, batch_size = ner_batch_size)
+            atomic_write(shard_path(output_dir, 'ner', shard), lambda f: json.dump(ner_output, f, default = to_json))
+            completed.append('ner')
+            save_manifest(output_dir, manifest)
+
+        if 'mask' not in completed:
+            with open(shard_path(output_dir, 'ner', shard)) as f:
+                ner_output = json.load(f)
+            masked = mask(ner_output)
+            atomic_write(shard_path(output_dir, 'mask', shard), lambda f: json.dump(masked, f))
+            completed.append('mask')
+            save_manifest(output_dir, manifest)
+
+        if 'embed' not in completed:
+            with open(shard_path(output_dir, 'mask', shard)) as f:
+                masked = json.load(f)
+            embeddings = embed(masked, sentence_model, batch_size = embed_batch_size)
+            atomic_write(shard_path(output_dir, 'embed', shard), lambda f: np.save(f, embeddings), mode = 'wb')
+            completed.append('embed')
+            save_manifest(output_dir, manifest)
+
+    # The saved index is about to be replaced, so it must not be reused if the build is interrupted
+    if manifest['index']:
+        manifest['index'] = False
+        save_manifest(output_dir, manifest)
+
+    print('building index ...')
+    corpus_embeddings = np.concatenate([np.load(shard_path(output_dir, 'embed', shard), mmap_mode = 'r')
+                                        for shard in range(num_shards)])
+    id_map = {i: value for i, value in enumerate(dataset[id_column])} if id_column else None
+    metadata = dataset.select_columns(metadata_columns).to_pandas() if metadata_columns else None
+    corpus_index = CorpusIndex.build(corpus_embeddings, id_map = id_map, index_type = index_type, metadata = metadata,
+                                     **index_kwargs)
+    corpus_index.save(os.path.join(output_dir, INDEX_DIR))
+
+    manifest['index'] = index_settings
+    save_manifest(output_dir, manifest)
+
+    return corpus_index
@@ -0,0 +1,87 @@
+'''
+Streaming NER -> mask -> embed pipeline.
+
+stream_ner_mask_embed() reads the corpus in chunks and passes them through three stages, each running in its own thread
+and connected to the next by a bounded queue (see utils.prefetch):
+
+- reading: slices the next chunk of articles (and their ids) out of the dataset
+- NER and masking: runs the token classifier over the chunk and masks the entities
+- embedding: encodes the masked chunk with the sentence model
+
+Model inference releases the GIL, so NER on one chunk overlaps with embedding of the previous one, and throughput is
+set by the slowest stage. When a stage gets queue_size chunks ahead of the next one it blocks, so at most a few chunks
+are in memory at any time, however large the corpus. Records are yielded one article at a time, in corpus order.
+'''
+
+from typing import Any, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from ..ner import ner, mask
+from ..embed import embed
+from ..utils import get_dataset
+from ..utils.clean_text import clean_ocr_dataset
+from ..utils.prefetch import prefetch
+
+
+def stream_ner_mask_embed(corpus, ner_model, sentence_model, chunk_size: int = 1000, ner_batch_size: int = 256,
+                          embed_batch_size: int = 512, id_column: Optional[str] = None,
+                          labels_to_mask: List[str] = ['PER', 'ORG', 'LOC', 'MISC'], all_masks_same: bool = True,
+                          use_offsets: bool = False, queue_size: int = 2,
+                          **ner_kwargs) -> Iterator[Tuple[Any, str, np.ndarray]]:
+    """
+    Masks and embeds a corpus chunk by chunk, with reading, NER and embedding running concurrently.
+
+    Args:
+        corpus: Any input accepted by get_dataset() with an 'article' column.
+        ner_model: Path or identifier of the NER model, or a loaded token classification pipeline.
+        sentence_model: Path or identifier of the sentence embedding model, or a loaded SentenceTransformer.
+        chunk_size (int): Number of articles that move through the stages together. Defaults to 1000.
+        ner_batch_size (int): Batch size for NER inference. Defaults to 256.
+        embed_batch_size (int): Batch size for embedding. Defaults to 512.
+        id_column (Optional[str]): Column whose values are yielded as the article ids (e.g. 'article_id'). Defaults to
+            the row numbers.
+        labels_to_mask (List[str]): Entity labels to mask. Defaults to ['PER', 'ORG', 'LOC', 'MISC'].
+        all_masks_same (bool): Whether to use a generic mask for all entities or their entity labels. Defaults to True.
+        use_offsets (bool): Whether to mask by replacing entity spans in the articles (see mask()). With
+            preprocess_for_ocr_errors, the cleaned articles are masked, as in ner_and_mask(). Defaults to False.
+        queue_size (int): Number of chunks a stage can get ahead of the next one. Defaults to 2.
+        ner_kwargs: Further keyword arguments for ner(), e.g. torch_device, stride or max_batch_tokens.
+
+    Returns:
+        Iterator[Tuple[Any, str, np.ndarray]]: (id, masked text, normalised embedding) for every article, in order.
+
+    Example:
+        >>> for article_id, masked_article, embedding in stream_ner_mask_embed(corpus, ner_model, same_story_model,
+        ...                                                                    id_column = 'article_id'):
+        ...     writer.write(article_id, embedding)
+    """
+    dataset = get_dataset(corpus)
+
+    # The entity offsets refer to the text NER saw, so with offsets each chunk is cleaned before NER instead of by it
+    clean_chunks = use_offsets and ner_kwargs.get('preprocess_for_ocr_errors', False)
+    if clean_chunks:
+        ner_kwargs = {**ner_kwargs, 'preprocess_for_ocr_errors': False}
+
+    def read_chunks():
+        for start in range(0, len(dataset), chunk_size):
+            chunk = dataset.select(range(start, min(start + chunk_size, len(dataset))))
+            ids = chunk[id_column] if id_column else list(range(start, start + len(chunk)))
+            yield ids, chunk
+
+    def ner_and_mask_chunks(chunks):
+        for ids, chunk in chunks:
+            if clean_chunks:
+                chunk = clean_ocr_dataset(chunk, num_proc = ner_kwargs.get('clean_num_proc'))
+            ner_output = ner(chunk, ner_model, batch_size = ner_batch_size, **ner_kwargs)
+            texts = chunk['article'] if use_offsets else None
+            yield ids, mask(ner_output, labels_to_mask, all_masks_same, texts = texts)
+
+    def embed_chunks(chunks):
+        for ids, masked in chunks:
+            yield ids, masked, embed(masked, sentence_model, batch_size = embed_batch_size)
+
+    chunks = prefetch(read_chunks(), queue_size)
+    chunks = prefetch(ner_and_mask_chunks(chunks), queue_size)
+    for ids, masked, embeddings in prefetch(embed_chunks(chunks), queue_size):
+        yield from zip(ids, masked, embeddings)
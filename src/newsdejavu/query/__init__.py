@@ -1 +1,4 @@
-from .query import find_nearest_neighbours
\ No newline at end of file
+from .query import find_nearest_neighbours
+from .index import CorpusIndex
+from .sharded import ShardedCorpusIndex
+from .incremental import IncrementalCorpusIndex
\ No newline at end of file
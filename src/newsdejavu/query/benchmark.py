@@ -0,0 +1,117 @@
+'''
+Recall-vs-exact benchmark for approximate nearest neighbour indexes.
+
+Each configuration is built over the same corpus embeddings and searched with the same queries, and its top-k results
+are compared with exact brute-force search. The report gives build time, index size, search latency and recall@k for
+every configuration, so the speed/memory/recall tradeoff can be chosen with real data in hand.
+
+Can also be run as a script on embeddings saved with np.save:
+
+    python -m newsdejavu.query.benchmark corpus_embeddings.npy query_embeddings.npy --k 10
+'''
+
+import time
+import argparse
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from .index import CorpusIndex, DEFAULT_RESCORE_FACTOR, as_faiss_array
+from .factory import index_bytes
+
+DEFAULT_CONFIGS = [
+    {'index_type': 'ivf_flat', 'nprobe': 1},
+    {'index_type': 'ivf_flat', 'nprobe': 8},
+    {'index_type': 'ivf_flat', 'nprobe': 32},
+    {'index_type': 'ivf_pq', 'nprobe': 8},
+    {'index_type': 'ivf_pq', 'nprobe': 32},
+    {'index_type': 'hnsw', 'ef_search': 16},
+    {'index_type': 'hnsw', 'ef_search': 64},
+    {'index_type': 'hnsw', 'ef_search': 256},
+    {'index_type': 'sq_fp16'},
+    {'index_type': 'sq8'},
+    {'index_type': 'sq8', 'rescore': True},
+    {'index_type': 'binary', 'rescore_factor': 8},
+    {'index_type': 'binary', 'rescore_factor': 32},
+]
+
+
+def recall_at_k(exact_nn: np.ndarray, approx_nn: np.ndarray) -> float:
+    """
+    Returns the fraction of the exact top-k neighbours that were also returned by the approximate search. Padding (-1)
+    entries, for queries with fewer than k results, are neither neighbours nor matches. With no exact neighbours at
+    all, the recall is 1.
+    """
+    hits = sum(len(np.intersect1d(exact_row[exact_row >= 0], approx_row[approx_row >= 0]))
+               for exact_row, approx_row in zip(exact_nn, approx_nn))
+    num_neighbours = int(np.sum(exact_nn >= 0))
+
+    return hits / num_neighbours if num_neighbours else 1.0
+
+
+def recall_benchmark(query_embeddings, corpus_embeddings, k: int = 10,
+                     configs: Optional[List[Dict]] = None) -> List[Dict]:
+    """
+    Measures build time, search latency and recall@k of approximate index configurations against exact search.
+
+    Args:
+        query_embeddings: Normalised query embeddings.
+        corpus_embeddings: Normalised corpus embeddings.
+        k (int): Number of neighbours retrieved per query. Defaults to 10.
+        configs (Optional[List[Dict]]): Index configurations to compare. Each is a dict with an 'index_type', optional
+            'nprobe' / 'ef_search' / 'rescore_factor' search knobs and any CorpusIndex.build() keyword arguments.
+            Defaults to a sweep over IVF-Flat, IVF-PQ, HNSW and the compact index types.
+
+    Returns:
+        List[Dict]: One row per configuration (plus the exact baseline) with the configuration, 'build_seconds',
+        'index_bytes', 'search_ms_per_query' and 'recall'.
+    """
+    query_embeddings = as_faiss_array(query_embeddings)
+    corpus_embeddings = as_faiss_array(corpus_embeddings)
+
+    results = []
+    exact_nn = None
+    built_indexes = {}
+    for config in [{'index_type': 'flat'}] + list(configs or DEFAULT_CONFIGS):
+        index_kwargs = dict(config)
+        nprobe = index_kwargs.pop('nprobe', None)
+        ef_search = index_kwargs.pop('ef_search', None)
+        rescore_factor = index_kwargs.pop('rescore_factor', DEFAULT_RESCORE_FACTOR)
+
+        # Configurations that only differ in their search knobs share one index
+        build_key = tuple(sorted(index_kwargs.items()))
+        if build_key not in built_indexes:
+            start = time.perf_counter()
+            built_indexes[build_key] = (CorpusIndex.build(corpus_embeddings, **index_kwargs), time.perf_counter() - start)
+        corpus_index, build_seconds = built_indexes[build_key]
+
+        start = time.perf_counter()
+        _, nn_list = corpus_index.search(query_embeddings, k, nprobe = nprobe, ef_search = ef_search,
+                                         rescore_factor = rescore_factor)
+        search_seconds = time.perf_counter() - start
+
+        if exact_nn is None:
+            exact_nn = nn_list
+
+        results.append({**config,
+                        'build_seconds': build_seconds,
+                        'index_bytes': index_bytes(corpus_index.index),
+                        'search_ms_per_query': 1000 * search_seconds / len(query_embeddings),
+                        'recall': recall_at_k(exact_nn, nn_list)})
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Compare approximate nearest neighbour indexes against exact search.')
+    parser.add_argument('corpus_embeddings', help = 'Path to a .npy file of corpus embeddings')
+    parser.add_argument('query_embeddings', help = 'Path to a .npy file of query embeddings')
+    parser.add_argument('--k', type = int, default = 10)
+    args = parser.parse_args()
+
+    for row in recall_benchmark(np.load(args.query_embeddings), np.load(args.corpus_embeddings, mmap_mode = 'r'), args.k):
+        knobs = ', '.join(f'{key}={value}' for key, value in row.items()
+                          if key not in ['build_seconds', 'index_bytes', 'search_ms_per_query', 'recall'])
+        print(f"{knobs:<40} build {row['build_seconds']:8.2f}s  size {row['index_bytes'] / 2 ** 20:9.1f}MB  "
+              f"search {row['search_ms_per_query']:8.3f}ms/query  "
+              f"recall@{args.k} {row['recall']:.4f}")
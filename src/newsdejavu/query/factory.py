@@ -0,0 +1,152 @@
+'''
+Index factory for exact and approximate nearest neighbour search.
+
+The following index types can be built from corpus embeddings:
+
+- 'flat': exact brute-force inner-product search (the default)
+- 'ivf_flat': inverted file index that only scans the nprobe closest of nlist clusters
+- 'ivf_pq': inverted file index whose vectors are compressed with product quantization
+- 'hnsw': hierarchical navigable small world graph, searched with a beam of width ef_search
+- 'sq_fp16': exact scan over embeddings stored as float16 (half the memory of 'flat')
+- 'sq8': exact scan over embeddings scalar-quantized to 8 bits per dimension (a quarter of the memory of 'flat')
+- 'binary': Hamming-distance scan over the sign bits of the embeddings (1/32 of the memory of 'flat'), meant as a first
+  pass whose candidates are rescored with the float32 embeddings (see CorpusIndex)
+
+Approximate indexes that need training (the IVF variants) are trained on a random sample of the corpus rather than on
+the whole corpus, which keeps the build time manageable for corpora with tens of millions of articles.
+'''
+
+import math
+from typing import Optional
+
+import numpy as np
+import faiss
+
+INDEX_TYPES = ['flat', 'ivf_flat', 'ivf_pq', 'hnsw', 'sq_fp16', 'sq8', 'binary']
+
+
+def default_nlist(num_vectors: int) -> int:
+    """
+    Returns the usual rule-of-thumb number of IVF clusters (4 * sqrt(n)) for a corpus of num_vectors embeddings.
+    """
+    return max(1, min(num_vectors, int(4 * math.sqrt(num_vectors))))
+
+
+def default_pq_m(dim: int) -> int:
+    """
+    Returns the largest number of PQ sub-quantizers that divides dim and is at most 64.
+    """
+    return max(m for m in range(1, min(dim, 64) + 1) if dim % m == 0)
+
+
+def index_factory_string(index_type: str, dim: int, num_vectors: int, nlist: Optional[int] = None,
+                         pq_m: Optional[int] = None, pq_nbits: int = 8, hnsw_m: int = 32) -> str:
+    """
+    Translates an index type and its parameters into a faiss index_factory description string.
+    """
+    if index_type == 'flat':
+        return 'Flat'
+    elif index_type == 'ivf_flat':
+        return f'IVF{nlist or default_nlist(num_vectors)},Flat'
+    elif index_type == 'ivf_pq':
+        return f'IVF{nlist or default_nlist(num_vectors)},PQ{pq_m or default_pq_m(dim)}x{pq_nbits}'
+    elif index_type == 'hnsw':
+        return f'HNSW{hnsw_m}'
+    elif index_type == 'sq_fp16':
+        return 'SQfp16'
+    elif index_type == 'sq8':
+        return 'SQ8'
+    elif index_type == 'binary':
+        return 'BFlat'
+    else:
+        raise ValueError(f'Unrecognized index type: {index_type}. Must be one of {INDEX_TYPES}')
+
+
+def binary_codes(embeddings: np.ndarray) -> np.ndarray:
+    """
+    Returns the sign bits of embeddings packed into bytes, the input of a binary index. For normalised embeddings, the
+    Hamming distance between codes approximates the angle between the embeddings.
+    """
+    return np.packbits(embeddings > 0, axis = 1)
+
+
+def index_bytes(index) -> int:
+    """
+    Returns the size of a faiss index when serialised, which is close to its memory footprint.
+    """
+    if isinstance(index, faiss.IndexBinary):
+        return faiss.serialize_index_binary(index).nbytes
+
+    return faiss.serialize_index(index).nbytes
+
+
+def build_faiss_index(corpus_embeddings: np.ndarray, index_type: str = 'flat', nlist: Optional[int] = None,
+                      pq_m: Optional[int] = None, pq_nbits: int = 8, hnsw_m: int = 32, ef_construction: int = 40,
+                      train_size: Optional[int] = None, seed: int = 0):
+    """
+    Builds and populates an inner-product faiss index of the given type over the corpus embeddings.
+
+    Args:
+        corpus_embeddings (np.ndarray): A float32 array of normalised corpus embeddings.
+        index_type (str): One of 'flat', 'ivf_flat', 'ivf_pq', 'hnsw', 'sq_fp16', 'sq8' or 'binary'. Defaults to 'flat'.
+        nlist (Optional[int]): Number of IVF clusters. Defaults to 4 * sqrt(corpus size).
+        pq_m (Optional[int]): Number of PQ sub-quantizers for 'ivf_pq'. Must divide the embedding dimension.
+        pq_nbits (int): Bits per PQ sub-quantizer code for 'ivf_pq'. Defaults to 8.
+        hnsw_m (int): Number of graph neighbours per node for 'hnsw'. Defaults to 32.
+        ef_construction (int): Beam width used while building the 'hnsw' graph. Defaults to 40.
+        train_size (Optional[int]): Number of embeddings sampled to train IVF and 'sq8' indexes. Defaults to 256 per
+            IVF cluster (or 65536 for 'sq8'), capped at the corpus size.
+        seed (int): Random seed for the training sample. Defaults to 0.
+
+    Returns:
+        Union[faiss.Index, faiss.IndexBinary]: The trained index with all corpus embeddings added.
+    """
+    num_vectors, dim = corpus_embeddings.shape
+    description = index_factory_string(index_type, dim, num_vectors, nlist, pq_m, pq_nbits, hnsw_m)
+
+    if index_type == 'binary':
+        if dim % 8:
+            raise ValueError(f'Binary indexes need an embedding dimension divisible by 8, got {dim}')
+        index = faiss.index_binary_factory(dim, description)
+        index.add(binary_codes(corpus_embeddings))
+        return index
+
+    index = faiss.index_factory(dim, description, faiss.METRIC_INNER_PRODUCT)
+
+    if index_type == 'hnsw':
+        index.hnsw.efConstruction = ef_construction
+
+    if not index.is_trained:
+        ivf = faiss.try_extract_index_ivf(index)
+        train_size = min(num_vectors, train_size or (256 * ivf.nlist if ivf is not None else 65536))
+        if train_size < num_vectors:
+            sample = np.random.default_rng(seed).choice(num_vectors, size = train_size, replace = False)
+            training_embeddings = corpus_embeddings[np.sort(sample)]
+        else:
+            training_embeddings = corpus_embeddings
+        index.train(training_embeddings)
+
+    index.add(corpus_embeddings)
+
+    return index
+
+
+def search_parameters(index, nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                      selector: Optional[faiss.IDSelector] = None) -> Optional[faiss.SearchParameters]:
+    """
+    Returns per-search faiss parameters for the given index, or None if no knob applies. nprobe is the number of IVF
+    clusters scanned per query and ef_search is the HNSW beam width; higher values trade speed for recall. selector
+    restricts the search to the rows it selects.
+    """
+    if isinstance(index, faiss.IndexBinary):
+        return faiss.SearchParameters(sel = selector) if selector is not None else None
+    # Parameter objects replace the index's own settings, so unset knobs keep the index's values
+    ivf = faiss.try_extract_index_ivf(index)
+    if (nprobe is not None or selector is not None) and isinstance(ivf, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(nprobe = nprobe or ivf.nprobe, sel = selector)
+    if (ef_search is not None or selector is not None) and isinstance(index, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(efSearch = ef_search or index.hnsw.efSearch, sel = selector)
+    if selector is not None:
+        return faiss.SearchParameters(sel = selector)
+
+    return None
@@ -0,0 +1,63 @@
+'''
+Metadata filters for corpus index search.
+
+A filter is a dict from metadata column to condition:
+
+- a (low, high) tuple keeps rows whose value lies in the inclusive range; either bound can be None. For string columns
+  such as ISO dates, a high bound also includes the values it prefixes, so ('1860', '1865') covers all of 1865. Rows
+  with a missing value are never in a range
+- a list or set keeps rows whose value is one of its elements
+- any other value keeps rows equal to it
+
+Conditions on different columns must all hold, e.g. {'date': ('1860', '1865'), 'newspaper_name': ['The Sun']}.
+'''
+
+from typing import Any, Dict
+
+import numpy as np
+import pandas as pd
+import faiss
+from pandas.api.types import is_string_dtype
+
+
+def filter_mask(metadata: pd.DataFrame, filters: Dict[str, Any]) -> np.ndarray:
+    """
+    Returns a boolean array marking the metadata rows that satisfy every filter condition.
+    """
+    mask = np.ones(len(metadata), dtype = bool)
+    for column, condition in filters.items():
+        if column not in metadata.columns:
+            raise ValueError(f'Cannot filter on {column}, the index metadata only has columns {list(metadata.columns)}')
+
+        values = metadata[column]
+        if isinstance(condition, tuple):
+            if len(condition) != 2:
+                raise ValueError(f'Range filter on {column} must be a (low, high) tuple, got {condition}')
+            # Missing values are never in a range, and are left out of the comparisons, which they can break
+            present = values.notna().to_numpy()
+            values = values[present]
+            in_range = np.ones(len(values), dtype = bool)
+            low, high = condition
+            if low is not None:
+                in_range &= (values >= low).to_numpy(dtype = bool)
+            if high is not None:
+                in_range &= ((values <= high) | (values.str.startswith(high) if isinstance(high, str) and
+                                                 is_string_dtype(values) else False)).to_numpy(dtype = bool)
+            mask[~present] = False
+            mask[present] &= in_range
+        elif isinstance(condition, (list, set, frozenset)):
+            mask &= values.isin(list(condition)).to_numpy()
+        else:
+            mask &= (values == condition).to_numpy()
+
+    return mask
+
+
+class RowSelector:
+    """
+    A faiss ID selector over the rows marked in a boolean mask. The bitmap backing the selector is kept alive with it.
+    """
+
+    def __init__(self, mask: np.ndarray):
+        self.bitmap = np.packbits(mask, bitorder = 'little')
+        self.selector = faiss.IDSelectorBitmap(len(mask), faiss.swig_ptr(self.bitmap))
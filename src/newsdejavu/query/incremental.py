@@ -0,0 +1,245 @@
+'''
+Corpus index that can be updated article by article.
+
+An IncrementalCorpusIndex is a sharded index whose first shard, the base, holds the bulk of the corpus in any index
+type, and whose other shards are small exact append segments. Articles are identified by stable ids (e.g. article ids)
+rather than by row numbers:
+
+- add() writes new articles to a new segment, so ingesting a day of newly digitized pages costs O(new articles)
+- remove() marks the rows of retracted articles as deleted (tombstones), which searches skip
+- adding an article id that is already indexed replaces the article
+
+save() only writes the segments created since the last save and the list of shards with their tombstones, which is
+written last and atomically, so an interrupted save leaves the previous state intact. compact() rebuilds the base from
+all live rows, dropping the segments and tombstones; compact_if_needed() does so once there are too many segments or
+deleted rows.
+'''
+
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .index import CorpusIndex
+from .filters import filter_mask
+from .sharded import ShardedCorpusIndex, Shard
+
+# compact_if_needed() compacts once there are more segments than this ...
+MAX_SEGMENTS = 32
+# ... or once this fraction of the rows are deleted
+MAX_DELETED_FRACTION = 0.2
+
+
+class IncrementalCorpusIndex(ShardedCorpusIndex):
+    """
+    A corpus index supporting additions and removals by stable article id.
+
+    Example:
+        >>> corpus_index = IncrementalCorpusIndex.build(embeddings, article_ids, metadata = {'date': dates})
+        >>> corpus_index.save('data/index')
+        >>> corpus_index = IncrementalCorpusIndex.load('data/index')
+        >>> corpus_index.add(new_embeddings, new_article_ids, metadata = {'date': new_dates})
+        >>> corpus_index.remove(['bad_ocr_article_id'])
+        >>> corpus_index.compact_if_needed()
+        >>> corpus_index.save('data/index')
+    """
+
+    def __init__(self, index_type: str = 'flat', rescore: Optional[bool] = None,
+                 index_kwargs: Optional[Dict] = None, num_workers: Optional[int] = None):
+        self.index_type = index_type
+        self.rescore = rescore
+        self.index_kwargs = index_kwargs or {}
+        self.generation = 0
+        self.next_segment = 1
+        self.deleted: List[np.ndarray] = []
+        self._positions: Optional[Dict[Any, int]] = None
+        super().__init__(num_workers = num_workers)
+
+    @classmethod
+    def build(cls, corpus_embeddings, ids: Sequence, metadata = None, index_type: str = 'flat',
+              rescore: Optional[bool] = None, num_workers: Optional[int] = None,
+              **index_kwargs) -> 'IncrementalCorpusIndex':
+        """
+        Builds the base of the index over corpus embeddings with one stable id per row. index_type, rescore and any
+        further keyword arguments are passed to CorpusIndex.build(), and are reused when the base is rebuilt by
+        compact().
+        """
+        ids = list(ids)
+        check_unique(ids)
+
+        incremental_index = cls(index_type, rescore, index_kwargs, num_workers)
+        incremental_index.append(Shard(incremental_index.base_name(), corpus_index = CorpusIndex.build(
+            corpus_embeddings, id_map = dict(enumerate(ids)), index_type = index_type, rescore = rescore,
+            metadata = metadata, **index_kwargs)))
+
+        return incremental_index
+
+    def base_name(self) -> str:
+        return f'base_{self.generation:05d}'
+
+    def append(self, shard: Shard):
+        super().append(shard)
+        self.deleted.append(np.zeros(shard.size, dtype = bool))
+
+    @property
+    def positions(self) -> Dict[Any, int]:
+        """
+        The global row number of every live article id, built from the shards' id maps the first time it is needed.
+        """
+        if self._positions is None:
+            positions = {}
+            for offset, shard, deleted in zip(self.offsets, self.shards, self.deleted):
+                for row, article_id in shard.corpus_index.id_map.items():
+                    if not deleted[row]:
+                        positions[article_id] = offset + row
+            self._positions = positions
+
+        return self._positions
+
+    @property
+    def num_articles(self) -> int:
+        """
+        The number of live (not deleted) articles.
+        """
+        return len(self) - sum(int(deleted.sum()) for deleted in self.deleted)
+
+    def __contains__(self, article_id) -> bool:
+        return article_id in self.positions
+
+    def add(self, embeddings, ids: Sequence, metadata = None):
+        """
+        Adds articles to a new append segment. Articles whose id is already in the index replace the indexed ones.
+        If the base has metadata, metadata must give the same columns for the new articles.
+        """
+        ids = list(ids)
+        check_unique(ids)
+        if not ids:
+            return
+
+        base = self.shards[0].corpus_index
+        if len(embeddings) != len(ids):
+            raise ValueError(f'Got {len(embeddings)} embeddings but {len(ids)} ids')
+        if np.shape(embeddings)[1] != base.dim:
+            raise ValueError(f'The embeddings have dimension {np.shape(embeddings)[1]}, but the index has {base.dim}')
+
+        if base.metadata is not None:
+            if metadata is None:
+                raise ValueError(f'The index has metadata columns {list(base.metadata.columns)}, pass them for the '
+                                 f'added articles')
+            metadata = pd.DataFrame(metadata).reset_index(drop = True)
+            if list(metadata.columns) != list(base.metadata.columns):
+                raise ValueError(f'The metadata has columns {list(metadata.columns)}, but the index has '
+                                 f'{list(base.metadata.columns)}')
+        elif metadata is not None:
+            raise ValueError('The index has no metadata, it cannot be added to later')
+
+        segment = CorpusIndex.build(embeddings, id_map = dict(enumerate(ids)), metadata = metadata)
+        self.remove([article_id for article_id in ids if article_id in self.positions])
+
+        offset = len(self)
+        self.append(Shard(f'segment_{self.next_segment:05d}', corpus_index = segment))
+        self.next_segment += 1
+        self.positions.update({article_id: offset + row for row, article_id in enumerate(ids)})
+
+    def remove(self, ids: Sequence):
+        """
+        Marks the articles with the given ids as deleted. Their rows are dropped from the index by compact().
+        """
+        ids = list(dict.fromkeys(ids))
+        unknown = [article_id for article_id in ids if article_id not in self.positions]
+        if unknown:
+            raise ValueError(f'Cannot remove articles that are not in the index: {unknown[:10]}')
+
+        for article_id in ids:
+            shard, row = self.locate(self.positions.pop(article_id))
+            self.deleted[self.shards.index(shard)][row] = True
+
+    def search_shard(self, shard_number: int, query_embeddings: np.ndarray, k: int, nprobe: Optional[int],
+                     ef_search: Optional[int], rescore_factor: int,
+                     filters: Optional[Dict[str, Any]]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Searches one shard, skipping its deleted rows.
+        """
+        deleted = self.deleted[shard_number]
+        if not deleted.any():
+            return super().search_shard(shard_number, query_embeddings, k, nprobe, ef_search, rescore_factor, filters)
+
+        corpus_index = self.shards[shard_number].corpus_index
+        allowed = ~deleted
+        if filters:
+            if corpus_index.metadata is None:
+                raise ValueError('This index has no metadata to filter on. Pass metadata to build().')
+            allowed &= filter_mask(corpus_index.metadata, filters)
+
+        return corpus_index.search_allowed(query_embeddings, k, allowed, nprobe, ef_search, rescore_factor)
+
+    def needs_compaction(self, max_segments: int = MAX_SEGMENTS,
+                         max_deleted_fraction: float = MAX_DELETED_FRACTION) -> bool:
+        return len(self.shards) - 1 > max_segments or len(self) - self.num_articles > max_deleted_fraction * len(self)
+
+    def compact(self):
+        """
+        Rebuilds the base from the live rows of all shards, in order, dropping the append segments and the deleted
+        rows. Indexes that need training are retrained. The base is rebuilt from its rescoring embeddings if it keeps
+        them, and otherwise from the vectors decoded from it, which are approximate for compressed index types.
+        """
+        embeddings, ids, metadata = [], [], []
+        for shard, deleted in zip(self.shards, self.deleted):
+            corpus_index = shard.corpus_index
+            live = np.flatnonzero(~deleted)
+            embeddings.append(corpus_index.embeddings()[live])
+            ids.extend(corpus_index.id_map[row] for row in live)
+            if corpus_index.metadata is not None:
+                metadata.append(corpus_index.metadata.iloc[live])
+
+        base = CorpusIndex.build(np.concatenate(embeddings), id_map = dict(enumerate(ids)),
+                                 index_type = self.index_type, rescore = self.rescore,
+                                 metadata = pd.concat(metadata) if metadata else None, **self.index_kwargs)
+
+        self.generation += 1
+        self.shards, self.offsets, self.deleted = [], [], []
+        self._positions = None
+        self.append(Shard(self.base_name(), corpus_index = base))
+
+    def compact_if_needed(self, max_segments: int = MAX_SEGMENTS,
+                          max_deleted_fraction: float = MAX_DELETED_FRACTION) -> bool:
+        """
+        Compacts the index if it has more than max_segments append segments or more than max_deleted_fraction of its
+        rows are deleted, and returns whether it did.
+        """
+        if not self.needs_compaction(max_segments, max_deleted_fraction):
+            return False
+
+        self.compact()
+        return True
+
+    def manifest(self) -> Dict:
+        manifest = super().manifest()
+        for entry, deleted in zip(manifest['shards'], self.deleted):
+            entry['deleted'] = np.flatnonzero(deleted).tolist()
+
+        return {**manifest, 'index_type': self.index_type, 'rescore': self.rescore, 'index_kwargs': self.index_kwargs,
+                'generation': self.generation, 'next_segment': self.next_segment}
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True, num_workers: Optional[int] = None) -> 'IncrementalCorpusIndex':
+        """
+        Opens an index saved with save(). The shards are only read when a search, addition or removal needs them.
+        """
+        incremental_index = super().load(path, mmap, num_workers)
+        manifest = incremental_index.read_manifest(path)
+
+        incremental_index.index_type = manifest['index_type']
+        incremental_index.rescore = manifest['rescore']
+        incremental_index.index_kwargs = manifest['index_kwargs']
+        incremental_index.generation = manifest['generation']
+        incremental_index.next_segment = manifest['next_segment']
+        for entry, deleted in zip(manifest['shards'], incremental_index.deleted):
+            deleted[entry['deleted']] = True
+
+        return incremental_index
+
+
+def check_unique(ids: List):
+    if len(set(ids)) != len(ids):
+        raise ValueError('Article ids must be unique')
@@ -0,0 +1,322 @@
+'''
+Persistent corpus index for nearest neighbour search.
+
+A CorpusIndex wraps a faiss index built from the output of embed() together with the id map that translates faiss row
+numbers back into corpus identifiers (article ids, raw sentences, ...). It is built once, saved to a directory and
+memory-mapped when loaded, so repeated queries against the same corpus do not pay the cost of rebuilding the index.
+
+The on-disk layout of a saved index is:
+
+- index.faiss: the serialised faiss index (index.binary.faiss for binary indexes)
+- id_map.json: the mapping from faiss row number to corpus identifier (absent if the index has no id map)
+- embeddings.npy: the float32 embeddings used to rescore candidates (absent if the index does not rescore)
+- metadata.parquet: per-row metadata columns (date, newspaper, ...) that searches can filter on (absent if none)
+
+Compact indexes ('sq_fp16', 'sq8' and especially 'binary') can keep the float32 embeddings outside the index, on disk
+or memory-mapped, and rescore their top candidates exactly. The index then only needs RAM for the compact codes, while
+the final scores and order are those of exact search over the candidates.
+
+Searches can be restricted to rows whose metadata satisfies a filter (see query.filters). Selective filters are applied
+inside faiss with an ID selector, so only matching rows are scored. Filters that keep most of the corpus are applied
+after the search instead, fetching more neighbours than requested until k matching ones are found.
+'''
+
+import os
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import faiss
+
+from .factory import build_faiss_index, search_parameters, binary_codes
+from .filters import filter_mask, RowSelector
+
+INDEX_FILE = 'index.faiss'
+BINARY_INDEX_FILE = 'index.binary.faiss'
+ID_MAP_FILE = 'id_map.json'
+EMBEDDINGS_FILE = 'embeddings.npy'
+METADATA_FILE = 'metadata.parquet'
+
+# Filters keeping at least this fraction of the corpus are applied after the search rather than inside faiss
+POST_FILTER_MIN_FRACTION = 0.5
+
+# Number of candidates retrieved per requested neighbour when rescoring
+DEFAULT_RESCORE_FACTOR = 8
+
+# Score and row number faiss reports for missing inner-product results
+MISSING_SCORE = -np.finfo(np.float32).max
+
+# IO_FLAG_MMAP only memory-maps IVF inverted lists. From faiss 1.10, IO_FLAG_MMAP_IFC also maps the codes of flat, SQ
+# and binary flat indexes without copying them, but IVF indexes cannot be read with it.
+FLAT_MMAP_IO_FLAGS = faiss.IO_FLAG_MMAP | getattr(faiss, 'IO_FLAG_MMAP_IFC', 0)
+
+
+def read_faiss_index(path: str, binary: bool, mmap: bool):
+    """
+    Reads a faiss index written by CorpusIndex.save(), memory-mapping as much of it as the index type allows if mmap.
+    """
+    read_index = faiss.read_index_binary if binary else faiss.read_index
+    if not mmap:
+        return read_index(path, 0)
+
+    if FLAT_MMAP_IO_FLAGS != faiss.IO_FLAG_MMAP:
+        try:
+            return read_index(path, FLAT_MMAP_IO_FLAGS)
+        except RuntimeError:
+            # IVF indexes only support IO_FLAG_MMAP
+            pass
+
+    return read_index(path, faiss.IO_FLAG_MMAP)
+
+
+def as_faiss_array(embeddings) -> np.ndarray:
+    """
+    Returns embeddings as a C-contiguous float32 array, which is the only layout faiss accepts.
+    """
+    return np.ascontiguousarray(embeddings, dtype = np.float32)
+
+
+def rescore(query_embeddings: np.ndarray, candidates: np.ndarray, corpus_embeddings: np.ndarray,
+            k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Scores candidate rows against the queries with exact float32 inner products and keeps the k best of each query.
+    Only the candidate rows of corpus_embeddings are read, so it can be a memory-mapped array.
+    """
+    dist_list = np.full((len(candidates), k), MISSING_SCORE, dtype = np.float32)
+    nn_list = np.full((len(candidates), k), -1, dtype = np.int64)
+
+    for i, (query, row) in enumerate(zip(query_embeddings, candidates)):
+        # Sorted rows read a memory-mapped array sequentially
+        rows = np.sort(row[row >= 0])
+        scores = as_faiss_array(corpus_embeddings[rows]) @ query
+        order = np.argsort(-scores, kind = 'stable')[:k]
+        dist_list[i, :len(order)] = scores[order]
+        nn_list[i, :len(order)] = rows[order]
+
+    return dist_list, nn_list
+
+
+class CorpusIndex:
+    """
+    A reusable inner-product index over a corpus of embeddings.
+
+    Args:
+        index (faiss.Index): The faiss index holding the corpus embeddings.
+        id_map (Optional[Dict[int, Any]]): A mapping from faiss row number to corpus identifier. If not provided,
+            results are reported as row numbers.
+        rescore_embeddings (Optional[np.ndarray]): The float32 corpus embeddings, e.g. memory-mapped from disk. If
+            provided, search() retrieves more candidates than requested from the index and rescores them exactly.
+        metadata (Optional[pd.DataFrame]): One row of metadata per faiss row, used to filter searches.
+
+    Example:
+        >>> corpus_index = CorpusIndex.build(corpus_embeddings, id_map = {i: s for i, s in enumerate(corpus)})
+        >>> corpus_index.save('data/index_1840')
+        >>> corpus_index = CorpusIndex.load('data/index_1840')
+        >>> dist_list, nn_list = corpus_index.search(query_embeddings, k = 5)
+    """
+
+    def __init__(self, index: faiss.Index, id_map: Optional[Dict[int, Any]] = None,
+                 rescore_embeddings: Optional[np.ndarray] = None, metadata: Optional[pd.DataFrame] = None):
+        if metadata is not None and len(metadata) != index.ntotal:
+            raise ValueError(f'The metadata has {len(metadata)} rows but the index has {index.ntotal}')
+
+        self.index = index
+        self.id_map = id_map
+        self.rescore_embeddings = rescore_embeddings
+        self.metadata = metadata
+
+    @classmethod
+    def build(cls, corpus_embeddings, id_map: Optional[Dict[int, Any]] = None, index_type: str = 'flat',
+              rescore: Optional[bool] = None, metadata = None, **index_kwargs) -> 'CorpusIndex':
+        """
+        Builds an inner-product index from an array of (normalised) corpus embeddings, as returned by embed().
+
+        index_type selects exact ('flat'), approximate ('ivf_flat', 'ivf_pq', 'hnsw') or compact ('sq_fp16', 'sq8',
+        'binary') search, and any further keyword arguments are passed to build_faiss_index(). If rescore is True,
+        corpus_embeddings is kept (not copied, if it is already a float32 memmap) to rescore candidates exactly. It
+        defaults to True for 'binary' indexes, whose Hamming distances are not similarity scores, and False otherwise.
+        metadata (anything pd.DataFrame() accepts, e.g. a dict of columns) holds one row per embedding to filter on.
+        """
+        corpus_embeddings = as_faiss_array(corpus_embeddings)
+        index = build_faiss_index(corpus_embeddings, index_type, **index_kwargs)
+
+        if rescore is None:
+            rescore = index_type == 'binary'
+        elif not rescore and index_type == 'binary':
+            raise ValueError('Binary indexes must rescore their candidates')
+
+        if metadata is not None:
+            metadata = pd.DataFrame(metadata).reset_index(drop = True)
+
+        return cls(index, id_map, corpus_embeddings if rescore else None, metadata)
+
+    @property
+    def dim(self) -> int:
+        return self.index.d
+
+    def __len__(self) -> int:
+        return self.index.ntotal
+
+    def search(self, query_embeddings, k: int = 1, nprobe: Optional[int] = None,
+               ef_search: Optional[int] = None, rescore_factor: int = DEFAULT_RESCORE_FACTOR,
+               filters: Optional[Dict[str, Any]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the k nearest neighbours of each query embedding. nprobe (IVF indexes) and ef_search (HNSW indexes) tune
+        the speed/recall tradeoff of approximate indexes and are ignored by exact ones. If the index rescores, the
+        rescore_factor * k best candidates of the index are rescored exactly and the k best are returned. If filters
+        are given (see query.filters), only rows whose metadata satisfies them are returned.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The similarity scores and the faiss row numbers of the neighbours, each of
+            shape (num_queries, k). Rows with fewer than k results are padded with -1.
+
+        Example:
+            >>> dist_list, nn_list = corpus_index.search(query_embeddings, k = 5, filters = {'date': ('1860', '1865')})
+        """
+        query_embeddings = as_faiss_array(query_embeddings)
+        if not filters:
+            return self.search_rows(query_embeddings, k, nprobe, ef_search, rescore_factor)
+
+        if self.metadata is None:
+            raise ValueError('This index has no metadata to filter on. Pass metadata to CorpusIndex.build().')
+
+        return self.search_allowed(query_embeddings, k, filter_mask(self.metadata, filters), nprobe, ef_search,
+                                   rescore_factor)
+
+    def search_allowed(self, query_embeddings: np.ndarray, k: int, allowed: np.ndarray, nprobe: Optional[int] = None,
+                       ef_search: Optional[int] = None,
+                       rescore_factor: int = DEFAULT_RESCORE_FACTOR) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Searches only the rows marked in the boolean array allowed, inside faiss if few rows are allowed and by
+        filtering the results of a larger search otherwise.
+        """
+        fraction = allowed.mean() if len(allowed) else 0
+        if fraction >= POST_FILTER_MIN_FRACTION:
+            return self.post_filtered_search(query_embeddings, k, allowed, nprobe, ef_search, rescore_factor)
+
+        row_selector = RowSelector(allowed)
+        return self.search_rows(query_embeddings, k, nprobe, ef_search, rescore_factor, row_selector.selector)
+
+    def search_rows(self, query_embeddings: np.ndarray, k: int, nprobe: Optional[int], ef_search: Optional[int],
+                    rescore_factor: int, selector: Optional[faiss.IDSelector] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Searches the index, restricted to the rows chosen by selector if given, and rescores the candidates.
+        """
+        params = search_parameters(self.index, nprobe, ef_search, selector)
+        num_candidates = k * rescore_factor if self.rescore_embeddings is not None else k
+
+        if isinstance(self.index, faiss.IndexBinary):
+            dist_list, nn_list = self.index.search(binary_codes(query_embeddings), num_candidates, params = params)
+        else:
+            dist_list, nn_list = self.index.search(query_embeddings, num_candidates, params = params)
+
+        if self.rescore_embeddings is None:
+            return dist_list, nn_list
+
+        return rescore(query_embeddings, nn_list, self.rescore_embeddings, k)
+
+    def post_filtered_search(self, query_embeddings: np.ndarray, k: int, allowed: np.ndarray,
+                             nprobe: Optional[int], ef_search: Optional[int],
+                             rescore_factor: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Searches without a selector and drops rows that are not allowed, fetching twice as many neighbours as the
+        filter is expected to need, and more until every query has k allowed neighbours or the whole index is fetched.
+        """
+        num_fetched = min(len(self), int(np.ceil(2 * k / allowed.mean())))
+        while True:
+            dist_list, nn_list = self.search_rows(query_embeddings, num_fetched, nprobe, ef_search, rescore_factor)
+            keep = (nn_list >= 0) & allowed[np.maximum(nn_list, 0)]
+            if keep.sum(axis = 1).min() >= k or num_fetched >= len(self):
+                break
+            num_fetched = min(len(self), 2 * num_fetched)
+
+        filtered_dist = np.full((len(query_embeddings), k), MISSING_SCORE, dtype = np.float32)
+        filtered_nn = np.full((len(query_embeddings), k), -1, dtype = np.int64)
+        for i in range(len(query_embeddings)):
+            kept = np.flatnonzero(keep[i])[:k]
+            filtered_dist[i, :len(kept)] = dist_list[i, kept]
+            filtered_nn[i, :len(kept)] = nn_list[i, kept]
+
+        return filtered_dist, filtered_nn
+
+    def embeddings(self) -> np.ndarray:
+        """
+        Returns the corpus embeddings of the index, one row per faiss row. These are the rescoring embeddings if the
+        index keeps them, and otherwise the vectors decoded from the index, which are approximate for compressed
+        indexes ('ivf_pq', 'sq8', ...).
+        """
+        if self.rescore_embeddings is not None:
+            return as_faiss_array(self.rescore_embeddings)
+        if isinstance(self.index, faiss.IndexBinary):
+            raise ValueError('Binary indexes without rescoring embeddings cannot reconstruct their embeddings')
+
+        ivf = faiss.try_extract_index_ivf(self.index)
+        if ivf is not None:
+            ivf.make_direct_map()
+
+        return self.index.reconstruct_n(0, self.index.ntotal)
+
+    def lookup(self, nn_list) -> List[List[Any]]:
+        """
+        Translates the row numbers returned by search() into corpus identifiers using the id map. Padding (-1) entries
+        are dropped.
+        """
+        if self.id_map is None:
+            return [[int(nn) for nn in row if nn >= 0] for row in nn_list]
+
+        return [[self.id_map[int(nn)] for nn in row if nn >= 0] for row in nn_list]
+
+    def save(self, path: str):
+        """
+        Saves the index and its id map to the directory at path.
+        """
+        os.makedirs(path, exist_ok = True)
+        for file_name in [INDEX_FILE, BINARY_INDEX_FILE, EMBEDDINGS_FILE, METADATA_FILE]:
+            if os.path.exists(os.path.join(path, file_name)):
+                os.remove(os.path.join(path, file_name))
+
+        if isinstance(self.index, faiss.IndexBinary):
+            faiss.write_index_binary(self.index, os.path.join(path, BINARY_INDEX_FILE))
+        else:
+            faiss.write_index(self.index, os.path.join(path, INDEX_FILE))
+
+        if self.rescore_embeddings is not None:
+            np.save(os.path.join(path, EMBEDDINGS_FILE), self.rescore_embeddings)
+        if self.metadata is not None:
+            self.metadata.to_parquet(os.path.join(path, METADATA_FILE), index = False)
+
+        id_map_path = os.path.join(path, ID_MAP_FILE)
+        if self.id_map is not None:
+            with open(id_map_path, 'w') as f:
+                json.dump({str(i): v for i, v in self.id_map.items()}, f)
+        elif os.path.exists(id_map_path):
+            os.remove(id_map_path)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> 'CorpusIndex':
+        """
+        Loads an index saved with save(). By default the index data and rescoring embeddings are memory-mapped rather
+        than read into RAM, so loading is fast and several processes can share the same pages. Before faiss 1.10 only
+        the inverted lists of IVF indexes can be memory-mapped, and the codes of other indexes are read into RAM.
+        """
+        if os.path.exists(os.path.join(path, BINARY_INDEX_FILE)):
+            index = read_faiss_index(os.path.join(path, BINARY_INDEX_FILE), True, mmap)
+        else:
+            index = read_faiss_index(os.path.join(path, INDEX_FILE), False, mmap)
+
+        rescore_embeddings = None
+        if os.path.exists(os.path.join(path, EMBEDDINGS_FILE)):
+            rescore_embeddings = np.load(os.path.join(path, EMBEDDINGS_FILE), mmap_mode = 'r' if mmap else None)
+
+        id_map = None
+        id_map_path = os.path.join(path, ID_MAP_FILE)
+        if os.path.exists(id_map_path):
+            with open(id_map_path) as f:
+                id_map = {int(i): v for i, v in json.load(f).items()}
+
+        metadata = None
+        if os.path.exists(os.path.join(path, METADATA_FILE)):
+            metadata = pd.read_parquet(os.path.join(path, METADATA_FILE), memory_map = mmap)
+
+        return cls(index, id_map, rescore_embeddings, metadata)
@@ -1,25 +1,39 @@
 import torch
 from glob import glob 
-import faiss
 
+from .index import CorpusIndex
+from .sharded import ShardedCorpusIndex
 
-def find_nearest_neighbours(query_embeddings, corpus_embeddings, k=1):
+
+def find_nearest_neighbours(query_embeddings, corpus_embeddings, k=1, index_type='flat', nprobe=None, ef_search=None,
+                            filters=None, **index_kwargs):
 
     """
     Takes list of queries and finds k nearest neighbours among a list of embeddings
     Nearest neighbours and distances are saved.
+
+    corpus_embeddings can also be a prebuilt CorpusIndex or ShardedCorpusIndex, in which case it is searched directly
+    instead of building a new index from scratch.
+
+    index_type selects exact ('flat', the default) or approximate ('ivf_flat', 'ivf_pq', 'hnsw') search; further
+    keyword arguments are passed to the index factory. nprobe and ef_search tune the speed/recall tradeoff of IVF and
+    HNSW indexes respectively.
+
+    filters restricts the search to corpus rows whose metadata satisfies them, e.g. {'date': ('1860', '1865')} (see
+    query.filters). The metadata comes from the CorpusIndex, or from a metadata keyword argument when the index is
+    built here.
     """
 
+    if isinstance(corpus_embeddings, (CorpusIndex, ShardedCorpusIndex)):
+        return corpus_embeddings.search(query_embeddings, k, nprobe=nprobe, ef_search=ef_search, filters=filters)
+
     # Initialise faiss
     # res = faiss.StandardGpuResources()
-    d=len(corpus_embeddings[0])
-
     # index = faiss.GpuIndexFlatIP(res, d)
-    index=faiss.IndexFlatIP(d)
-    index.add(corpus_embeddings)
+    index = CorpusIndex.build(corpus_embeddings, index_type=index_type, **index_kwargs)
 
     # Find k nearest neighbours
-    dist_list, nn_list = index.search(query_embeddings, k)
+    dist_list, nn_list = index.search(query_embeddings, k, nprobe=nprobe, ef_search=ef_search, filters=filters)
 
     return dist_list, nn_list
 
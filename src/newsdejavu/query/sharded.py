@@ -0,0 +1,300 @@
+'''
+Sharded corpus index, with one CorpusIndex per year (or decade, newspaper, ...).
+
+A ShardedCorpusIndex searches the shards concurrently in a thread pool (faiss releases the GIL while it searches) and
+merges the per-shard top-k results into a global top-k. Rows are numbered globally in shard order: shard i holds the
+rows that follow those of the shards before it. Results can be used exactly like those of a single CorpusIndex.
+
+Saved shards are loaded lazily, the first time a search needs them, and new shards can be added at any time without
+touching the existing ones. The on-disk layout of a saved sharded index is:
+
+- shards.json: the name, size and whether it has an id map of each shard, in order
+- one directory per shard, named after the shard, holding a saved CorpusIndex
+'''
+
+import os
+import json
+import bisect
+import shutil
+import threading
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+
+from .index import CorpusIndex, DEFAULT_RESCORE_FACTOR, MISSING_SCORE, as_faiss_array
+from ..utils.cache import atomic_write
+
+SHARDS_FILE = 'shards.json'
+
+
+class Shard:
+    """
+    One shard of a ShardedCorpusIndex: a CorpusIndex, or the directory of a saved one that is loaded on first use.
+    """
+
+    def __init__(self, name: str, corpus_index: Optional[CorpusIndex] = None, path: Optional[str] = None,
+                 size: Optional[int] = None, has_id_map: Optional[bool] = None, mmap: bool = True):
+        self.name = name
+        self.path = path
+        self.mmap = mmap
+        self._corpus_index = corpus_index
+        self._lock = threading.Lock()
+
+        # Without a recorded size, a saved shard is loaded now to find it
+        if corpus_index is None and (size is None or has_id_map is None):
+            corpus_index = self.corpus_index
+        if corpus_index is not None:
+            size, has_id_map = len(corpus_index), corpus_index.id_map is not None
+
+        self.size = size
+        self.has_id_map = has_id_map
+
+    @property
+    def loaded(self) -> bool:
+        return self._corpus_index is not None
+
+    @property
+    def corpus_index(self) -> CorpusIndex:
+        with self._lock:
+            if self._corpus_index is None:
+                self._corpus_index = CorpusIndex.load(self.path, mmap = self.mmap)
+            return self._corpus_index
+
+
+class ShardedIdMap(Mapping):
+    """
+    The id map of a sharded index, translating global row numbers through the id map of the shard holding the row.
+    Rows of shards without an id map translate to their global row number.
+    """
+
+    def __init__(self, sharded_index: 'ShardedCorpusIndex'):
+        self.sharded_index = sharded_index
+
+    def __getitem__(self, row: int) -> Any:
+        shard, local_row = self.sharded_index.locate(row)
+        if not shard.has_id_map:
+            return row
+        return shard.corpus_index.id_map[local_row]
+
+    def __iter__(self):
+        return iter(range(len(self)))
+
+    def __len__(self) -> int:
+        return len(self.sharded_index)
+
+
+def merge_top_k(results: List[Tuple[np.ndarray, np.ndarray]], k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Merges the (scores, global row numbers) results of several shards into the k best of each query. Ties keep shard
+    order, and rows with fewer than k results are padded with -1.
+    """
+    dist_list = np.concatenate([dist for dist, _ in results], axis = 1)
+    nn_list = np.concatenate([nn for _, nn in results], axis = 1)
+    dist_list = np.where(nn_list >= 0, dist_list, MISSING_SCORE)
+
+    order = np.argsort(-dist_list, axis = 1, kind = 'stable')[:, :k]
+    dist_list = np.take_along_axis(dist_list, order, axis = 1)
+    nn_list = np.take_along_axis(nn_list, order, axis = 1)
+
+    if nn_list.shape[1] < k:
+        padding = k - nn_list.shape[1]
+        dist_list = np.pad(dist_list, ((0, 0), (0, padding)), constant_values = MISSING_SCORE)
+        nn_list = np.pad(nn_list, ((0, 0), (0, padding)), constant_values = -1)
+
+    return dist_list, nn_list
+
+
+class ShardedCorpusIndex:
+    """
+    A corpus index split into named shards that are searched in parallel.
+
+    Example:
+        >>> sharded_index = ShardedCorpusIndex.build({year: embeddings[year] for year in range(1850, 1861)})
+        >>> sharded_index.save('data/index_1850s')
+        >>> sharded_index = ShardedCorpusIndex.load('data/index_1850s')
+        >>> dist_list, nn_list = sharded_index.search(query_embeddings, k = 5, shards = ['1855', '1856'])
+    """
+
+    def __init__(self, shards: Optional[Dict[Any, Union[CorpusIndex, str]]] = None, num_workers: Optional[int] = None):
+        self.shards: List[Shard] = []
+        self.offsets: List[int] = []
+        self.num_workers = num_workers or os.cpu_count() or 1
+
+        for name, shard in (shards or {}).items():
+            self.add_shard(name, shard)
+
+    @classmethod
+    def build(cls, shard_embeddings: Dict[Any, Any], id_maps: Optional[Dict[Any, Dict[int, Any]]] = None,
+              metadata: Optional[Dict[Any, Any]] = None, num_workers: Optional[int] = None,
+              **index_kwargs) -> 'ShardedCorpusIndex':
+        """
+        Builds one CorpusIndex per shard from a dict of shard name to corpus embeddings (e.g. one entry per year).
+        id_maps and metadata optionally give the id map and metadata of each shard, keyed by the same names, and
+        further keyword arguments are passed to CorpusIndex.build().
+        """
+        id_maps, metadata = id_maps or {}, metadata or {}
+        return cls({name: CorpusIndex.build(embeddings, id_map = id_maps.get(name), metadata = metadata.get(name),
+                                            **index_kwargs)
+                    for name, embeddings in shard_embeddings.items()}, num_workers)
+
+    def add_shard(self, name, shard: Union[CorpusIndex, str]):
+        """
+        Appends a shard, given as a CorpusIndex or the directory of a saved one. Its rows are numbered after those of
+        the existing shards.
+        """
+        name = str(name)
+        if name in self.shard_names:
+            raise ValueError(f'The index already has a shard named {name}')
+
+        if isinstance(shard, CorpusIndex):
+            dims = {other.corpus_index.dim for other in self.shards if other.loaded}
+            if dims and shard.dim not in dims:
+                raise ValueError(f'Shard {name} has dimension {shard.dim}, but the index has dimension {dims.pop()}')
+            shard = Shard(name, corpus_index = shard)
+        else:
+            shard = Shard(name, path = shard)
+
+        self.append(shard)
+
+    def append(self, shard: Shard):
+        self.offsets.append(len(self))
+        self.shards.append(shard)
+
+    @property
+    def shard_names(self) -> List[str]:
+        return [shard.name for shard in self.shards]
+
+    def __len__(self) -> int:
+        return self.offsets[-1] + self.shards[-1].size if self.shards else 0
+
+    @property
+    def id_map(self) -> Optional[ShardedIdMap]:
+        """
+        The id map translating global row numbers into corpus identifiers, or None if no shard has an id map.
+        """
+        if not any(shard.has_id_map for shard in self.shards):
+            return None
+        return ShardedIdMap(self)
+
+    def locate(self, row: int) -> Tuple[Shard, int]:
+        """
+        Returns the shard holding a global row number and the row's number within the shard.
+        """
+        if not 0 <= row < len(self):
+            raise KeyError(row)
+
+        shard_number = bisect.bisect_right(self.offsets, row) - 1
+        return self.shards[shard_number], row - self.offsets[shard_number]
+
+    def search(self, query_embeddings, k: int = 1, nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+               rescore_factor: int = DEFAULT_RESCORE_FACTOR, filters: Optional[Dict[str, Any]] = None,
+               shards: Optional[Iterable] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the k nearest neighbours of each query embedding across all shards, or only the named shards. The search
+        options are those of CorpusIndex.search() and apply to every shard.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The similarity scores and the global row numbers of the neighbours, each of
+            shape (num_queries, k). Rows with fewer than k results are padded with -1.
+        """
+        query_embeddings = as_faiss_array(query_embeddings)
+        selected = self.select(shards)
+        if not selected:
+            return merge_top_k([(np.empty((len(query_embeddings), 0), dtype = np.float32),
+                                 np.empty((len(query_embeddings), 0), dtype = np.int64))], k)
+
+        def search_shard(shard_number: int) -> Tuple[np.ndarray, np.ndarray]:
+            dist_list, nn_list = self.search_shard(shard_number, query_embeddings, k, nprobe, ef_search,
+                                                   rescore_factor, filters)
+            return dist_list, np.where(nn_list >= 0, nn_list + self.offsets[shard_number], -1)
+
+        if len(selected) == 1 or self.num_workers == 1:
+            results = [search_shard(shard_number) for shard_number in selected]
+        else:
+            with ThreadPoolExecutor(max_workers = min(self.num_workers, len(selected))) as executor:
+                results = list(executor.map(search_shard, selected))
+
+        return merge_top_k(results, k)
+
+    def search_shard(self, shard_number: int, query_embeddings: np.ndarray, k: int, nprobe: Optional[int],
+                     ef_search: Optional[int], rescore_factor: int,
+                     filters: Optional[Dict[str, Any]]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Searches one shard, returning the row numbers within the shard.
+        """
+        return self.shards[shard_number].corpus_index.search(query_embeddings, k, nprobe = nprobe,
+                                                             ef_search = ef_search, rescore_factor = rescore_factor,
+                                                             filters = filters)
+
+    def select(self, shards: Optional[Iterable]) -> List[int]:
+        """
+        Returns the positions of the named shards, or of all shards if shards is None.
+        """
+        if shards is None:
+            return list(range(len(self.shards)))
+
+        positions = {name: i for i, name in enumerate(self.shard_names)}
+        unknown = [str(name) for name in shards if str(name) not in positions]
+        if unknown:
+            raise ValueError(f'Unknown shards {unknown}, the index has shards {self.shard_names}')
+
+        return sorted({positions[str(name)] for name in shards})
+
+    def lookup(self, nn_list) -> List[List[Any]]:
+        """
+        Translates the global row numbers returned by search() into corpus identifiers, like CorpusIndex.lookup().
+        """
+        id_map = self.id_map
+        if id_map is None:
+            return [[int(nn) for nn in row if nn >= 0] for row in nn_list]
+
+        return [[id_map[int(nn)] for nn in row if nn >= 0] for row in nn_list]
+
+    def manifest(self) -> Dict:
+        return {'shards': [{'name': shard.name, 'size': shard.size, 'has_id_map': shard.has_id_map}
+                           for shard in self.shards]}
+
+    @staticmethod
+    def read_manifest(path: str) -> Dict:
+        with open(os.path.join(path, SHARDS_FILE)) as f:
+            return json.load(f)
+
+    def save(self, path: str):
+        """
+        Saves every shard to its own directory under path, along with the list of shards. Shards that were loaded from
+        this directory are not written again, and the directories of shards that were dropped since the last save
+        (e.g. by compaction) are removed once the new list of shards is in place.
+        """
+        os.makedirs(path, exist_ok = True)
+        manifest_path = os.path.join(path, SHARDS_FILE)
+        previous_names = []
+        if os.path.exists(manifest_path):
+            previous_names = [entry['name'] for entry in self.read_manifest(path)['shards']]
+
+        for shard in self.shards:
+            shard_path = os.path.join(path, shard.name)
+            if shard.path is None or os.path.abspath(shard.path) != os.path.abspath(shard_path):
+                shard.corpus_index.save(shard_path)
+                shard.path = shard_path
+
+        manifest = self.manifest()
+        atomic_write(manifest_path, lambda f: json.dump(manifest, f, indent = 4))
+
+        for name in set(previous_names) - set(self.shard_names):
+            shutil.rmtree(os.path.join(path, name), ignore_errors = True)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True, num_workers: Optional[int] = None) -> 'ShardedCorpusIndex':
+        """
+        Opens a sharded index saved with save(). No shard is read until a search or lookup needs it.
+        """
+        manifest = cls.read_manifest(path)
+
+        sharded_index = cls(num_workers = num_workers)
+        for entry in manifest['shards']:
+            sharded_index.append(Shard(entry['name'], path = os.path.join(path, entry['name']), size = entry['size'],
+                                       has_id_map = entry['has_id_map'], mmap = mmap))
+
+        return sharded_index
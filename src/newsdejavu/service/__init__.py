@@ -0,0 +1 @@
+from .server import SearchService, serve, load_corpus_index
\ No newline at end of file
@@ -0,0 +1,51 @@
+'''
+Latency, batching and queue depth metrics of the search service.
+'''
+
+from collections import deque
+from typing import Dict
+
+import numpy as np
+
+# Number of most recent requests and batches the percentiles and averages are computed over
+METRICS_WINDOW = 10000
+
+
+class ServiceMetrics:
+    """
+    Running counters and a sliding window of recent request latencies and batch sizes.
+    """
+
+    def __init__(self, window: int = METRICS_WINDOW):
+        self.latencies = deque(maxlen = window)
+        self.batch_sizes = deque(maxlen = window)
+        self.num_requests = 0
+        self.num_errors = 0
+        self.num_batches = 0
+        self.max_queue_depth = 0
+
+    def record_queue_depth(self, queue_depth: int):
+        self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+
+    def record_batch(self, batch_size: int):
+        self.num_batches += 1
+        self.batch_sizes.append(batch_size)
+
+    def record_request(self, latency: float, error: bool = False):
+        self.num_requests += 1
+        self.num_errors += error
+        self.latencies.append(latency)
+
+    def snapshot(self, queue_depth: int) -> Dict:
+        """
+        Returns the current metrics, with latencies in milliseconds.
+        """
+        latencies = 1000 * np.array(self.latencies) if self.latencies else np.zeros(1)
+        return {'requests': self.num_requests,
+                'errors': self.num_errors,
+                'batches': self.num_batches,
+                'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0,
+                'latency_p50_ms': float(np.percentile(latencies, 50)),
+                'latency_p99_ms': float(np.percentile(latencies, 99)),
+                'queue_depth': queue_depth,
+                'max_queue_depth': self.max_queue_depth}
@@ -0,0 +1,355 @@
+'''
+Long-lived same-story search service.
+
+A SearchService keeps the NER model, the sentence model and the corpus index loaded, and answers queries from an
+asyncio event loop. Queries that arrive close together are coalesced into micro-batches: the first query of a batch
+waits at most batch_window_ms for others to join it (up to max_batch_size), and the whole batch is masked, embedded and
+searched in one pass on a worker thread. While a batch runs, new queries queue up and form the next batch, so batches
+grow with the load and the models run at batch efficiency instead of once per query.
+
+serve() exposes a service over TCP or a Unix socket with a JSON lines protocol. Each request is one line:
+
+- {"id": 1, "query": "...", "k": 5, "filters": {...}}, answered with {"id": 1, "query": "...", "neighbor_list": [...],
+  "distance_list": [...]} (or {"id": 1, "error": "..."}). The filters are those of find_nearest_neighbours(): a scalar
+  keeps the rows equal to it and a list the rows equal to any of its values. JSON has no tuples, so an inclusive range
+  is sent as {"range": [low, high]}, e.g. "filters": {"year": {"range": [1856, 1859]}}.
+- {"id": 2, "metrics": true}, answered with the request count, p50/p99 latency, batch sizes and queue depth (and the
+  hit rates of the query cache, if the service has one)
+
+Responses carry the request id and are written as soon as they are ready, so a client can send many requests on one
+connection without waiting for each answer.
+
+Can also be run as a script:
+
+    python -m newsdejavu.service --ner-model ner_model --sentence-model same_story_model --index data/index --port 8765
+'''
+
+import os
+import json
+import time
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from ..ner import ner_and_mask
+from ..embed import embed
+from ..query import find_nearest_neighbours, CorpusIndex, ShardedCorpusIndex, IncrementalCorpusIndex
+from ..query.sharded import SHARDS_FILE
+from ..utils.registry import get_token_classifier, get_sentence_model
+from ..backends.onnx_runtime import BACKENDS
+from ..utils.query_cache import QueryCache
+from .metrics import ServiceMetrics
+
+DEFAULT_BATCH_WINDOW_MS = 5
+DEFAULT_MAX_BATCH_SIZE = 64
+
+
+def load_corpus_index(path: str, mmap: bool = True):
+    """
+    Loads a saved CorpusIndex, ShardedCorpusIndex or IncrementalCorpusIndex, whichever is saved at path.
+    """
+    if not os.path.exists(os.path.join(path, SHARDS_FILE)):
+        return CorpusIndex.load(path, mmap = mmap)
+
+    if 'generation' in ShardedCorpusIndex.read_manifest(path):
+        return IncrementalCorpusIndex.load(path, mmap = mmap)
+
+    return ShardedCorpusIndex.load(path, mmap = mmap)
+
+
+def decode_filters(filters: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    Turns the filters of a JSON lines request into find_nearest_neighbours() filters: a {"range": [low, high]}
+    condition becomes the (low, high) tuple of an inclusive range, and other conditions are kept as they are.
+    """
+    if filters is None:
+        return None
+    if not isinstance(filters, dict):
+        raise ValueError('"filters" must be an object mapping columns to conditions')
+
+    decoded = {}
+    for column, condition in filters.items():
+        if isinstance(condition, dict):
+            if set(condition) != {'range'} or not isinstance(condition['range'], list) or len(condition['range']) != 2:
+                raise ValueError(f'The condition on {column} must be a value, a list of values or '
+                                 f'{{"range": [low, high]}}, got {condition}')
+            condition = tuple(condition['range'])
+        decoded[column] = condition
+
+    return decoded
+
+
+def fail_stopped(batch: List[Tuple]):
+    for _, _, _, future, _ in batch:
+        if not future.done():
+            future.set_exception(RuntimeError('The search service was stopped'))
+
+
+class SearchService:
+    """
+    Answers same-story queries against a resident corpus index, batching concurrent queries.
+
+    Example:
+        >>> service = SearchService(ner_model, same_story_model, CorpusIndex.load('data/index_1840'))
+        >>> result = await service.search('The Paris Agreement aims to strengthen the global response.', k = 5)
+    """
+
+    def __init__(self, ner_model, sentence_model, corpus_index, corpus_sentences: Optional[List[str]] = None,
+                 batch_window_ms: float = DEFAULT_BATCH_WINDOW_MS, max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+                 ner_batch_size: int = 256, query_cache: Optional[QueryCache] = None,
+                 mask_options: Optional[Dict[str, Any]] = None):
+        self.ner_model = ner_model
+        self.sentence_model = sentence_model
+        self.corpus_index = corpus_index
+        self.corpus_sentences = corpus_sentences
+        self.batch_window = batch_window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.ner_batch_size = ner_batch_size
+        self.query_cache = query_cache
+        # Further ner_and_mask() keyword arguments, e.g. labels_to_mask, which are also part of the query cache key
+        self.mask_options = mask_options or {}
+
+        self.metrics = ServiceMetrics()
+        self.queue: Optional[asyncio.Queue] = None
+        self.batcher: Optional[asyncio.Task] = None
+        # Batches run one at a time, on a thread of their own, so the event loop keeps accepting queries. Created by
+        # start(), so a stopped service can be started again.
+        self.executor: Optional[ThreadPoolExecutor] = None
+
+    def start(self):
+        """
+        Starts the batching task on the running event loop. Called by search() if needed.
+        """
+        if self.batcher is None:
+            self.executor = ThreadPoolExecutor(max_workers = 1)
+            self.queue = asyncio.Queue()
+            self.batcher = asyncio.get_running_loop().create_task(self.run_batches())
+
+    async def stop(self):
+        """
+        Stops the batching task and its worker thread. Queries still waiting for a batch fail; a later search() starts
+        the service again.
+        """
+        if self.batcher is None:
+            return
+
+        self.batcher.cancel()
+        try:
+            await self.batcher
+        except asyncio.CancelledError:
+            pass
+        self.batcher = None
+        self.executor.shutdown(wait = False)
+        self.executor = None
+
+        while not self.queue.empty():
+            fail_stopped([self.queue.get_nowait()])
+
+    async def search(self, query: str, k: int = 1, filters: Optional[Dict[str, Any]] = None) -> Dict:
+        """
+        Finds the k nearest neighbours of a query sentence, as one entry of search_same_story()'s output.
+        """
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((query, k, filters, future, time.perf_counter()))
+        self.metrics.record_queue_depth(self.queue.qsize())
+
+        return await future
+
+    def metrics_snapshot(self) -> Dict:
+        snapshot = self.metrics.snapshot(self.queue.qsize() if self.queue is not None else 0)
+        if self.query_cache is not None:
+            snapshot['query_cache'] = self.query_cache.stats()
+
+        return snapshot
+
+    async def next_batch(self) -> List[Tuple]:
+        """
+        Waits for a query, then for more queries until the batch window closes or the batch is full.
+        """
+        batch = [await self.queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.batch_window
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0 and self.queue.empty():
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), max(timeout, 0)))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def run_batches(self):
+        loop = asyncio.get_running_loop()
+        batch = []
+        try:
+            while True:
+                batch = await self.next_batch()
+                self.metrics.record_batch(len(batch))
+                requests = [(query, k, filters) for query, k, filters, _, _ in batch]
+                try:
+                    results = await loop.run_in_executor(self.executor, self.process_batch, requests)
+                except Exception as error:
+                    results = [error] * len(batch)
+
+                for (_, _, _, future, enqueued), result in zip(batch, results):
+                    failed = isinstance(result, Exception)
+                    self.metrics.record_request(time.perf_counter() - enqueued, failed)
+                    if future.done():
+                        continue
+                    if failed:
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+        except asyncio.CancelledError:
+            fail_stopped(batch)
+            raise
+
+    def process_batch(self, requests: List[Tuple[str, int, Optional[Dict]]]) -> List[Union[Dict, Exception]]:
+        """
+        Masks and embeds the queries of a batch together, then searches them in groups sharing the same filters. A
+        group whose search fails (e.g. on a filter column the index does not have) gets its exception in place of its
+        results, so only the queries of that group fail.
+        """
+        queries = [query for query, _, _ in requests]
+        if self.query_cache is not None:
+            _, query_embeddings = self.query_cache.mask_and_embed(
+                queries, self.ner_model, self.sentence_model,
+                lambda queries: self.mask(queries),
+                lambda masked_queries: embed(masked_queries, self.sentence_model),
+                mask_options = self.mask_options)
+        else:
+            masked_queries = self.mask(queries)
+            query_embeddings = embed(masked_queries, self.sentence_model)
+
+        # repr keeps tuples (ranges) and lists (values) apart, which JSON would not
+        groups = {}
+        for i, (_, _, filters) in enumerate(requests):
+            groups.setdefault(repr(sorted(filters.items())) if filters else None, []).append(i)
+
+        results = [None] * len(requests)
+        for rows in groups.values():
+            filters = requests[rows[0]][2]
+            k = max(requests[i][1] for i in rows)
+            try:
+                dist_list, nn_list = find_nearest_neighbours(query_embeddings[rows], self.corpus_index, k = k,
+                                                             filters = filters)
+            except Exception as error:
+                for i in rows:
+                    results[i] = error
+                continue
+
+            for i, dist_row, nn_row in zip(rows, dist_list, nn_list):
+                results[i] = self.result(queries[i], dist_row[:requests[i][1]], nn_row[:requests[i][1]])
+
+        return results
+
+    def mask(self, queries: List[str]) -> List[str]:
+        return ner_and_mask(queries, self.ner_model, batch_size = self.ner_batch_size, **self.mask_options)
+
+    def result(self, query: str, dist_row: np.ndarray, nn_row: np.ndarray) -> Dict:
+        id_map = self.corpus_index.id_map
+        neighbours = []
+        for nn in nn_row[nn_row >= 0]:
+            if id_map is not None:
+                neighbours.append(id_map[int(nn)])
+            elif self.corpus_sentences is not None:
+                neighbours.append(self.corpus_sentences[int(nn)])
+            else:
+                neighbours.append(int(nn))
+
+        return {'query': query, 'neighbor_list': neighbours,
+                'distance_list': [float(dist) for dist in dist_row[nn_row >= 0]]}
+
+    async def respond(self, line: bytes) -> Dict:
+        """
+        Answers one JSON lines request.
+        """
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get('id')
+            if request.get('metrics'):
+                return {'id': request_id, 'metrics': self.metrics_snapshot()}
+            if not isinstance(request.get('query'), str):
+                raise ValueError('Requests need a "query" string')
+
+            result = await self.search(request['query'], int(request.get('k', 1)),
+                                       decode_filters(request.get('filters')))
+            return {'id': request_id, **result}
+        except Exception as error:
+            return {'id': request_id, 'error': f'{type(error).__name__}: {error}'}
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        write_lock = asyncio.Lock()
+        pending = set()
+
+        async def answer(line: bytes):
+            response = await self.respond(line)
+            async with write_lock:
+                writer.write(json.dumps(response).encode('utf-8') + b'\n')
+                await writer.drain()
+
+        try:
+            async for line in reader:
+                if line.strip():
+                    task = asyncio.create_task(answer(line))
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+            if pending:
+                await asyncio.gather(*pending)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(service: SearchService, host: str = '127.0.0.1', port: Optional[int] = 8765,
+                path: Optional[str] = None) -> asyncio.AbstractServer:
+    """
+    Starts serving a SearchService on a Unix socket at path if given, and on host:port otherwise. Returns the started
+    asyncio server; await its serve_forever() to keep serving.
+    """
+    service.start()
+    if path is not None:
+        return await asyncio.start_unix_server(service.handle_connection, path = path)
+
+    return await asyncio.start_server(service.handle_connection, host, port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Serve same-story search over a saved corpus index.')
+    parser.add_argument('--ner-model', required = True, help = 'Path or identifier of the NER model')
+    parser.add_argument('--sentence-model', required = True, help = 'Path or identifier of the sentence model')
+    parser.add_argument('--index', required = True, help = 'Directory of a saved (sharded or incremental) index')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8765)
+    parser.add_argument('--socket', help = 'Path of a Unix socket to serve on instead of TCP')
+    parser.add_argument('--batch-window-ms', type = float, default = DEFAULT_BATCH_WINDOW_MS)
+    parser.add_argument('--max-batch-size', type = int, default = DEFAULT_MAX_BATCH_SIZE)
+    parser.add_argument('--query-cache-size', type = int, default = 0,
+                        help = 'Number of query masked texts and embeddings to cache, 0 to disable the cache')
+    parser.add_argument('--query-cache-ttl', type = float, help = 'Seconds after which cached queries expire')
+    parser.add_argument('--backend', choices = BACKENDS, default = 'torch',
+                        help = 'Inference backend of the models, onnx and onnx-int8 run them with ONNX Runtime on CPU')
+    args = parser.parse_args()
+
+    # Loaded up front, so the first queries do not wait for the models
+    ner_model = get_token_classifier(args.ner_model, backend = args.backend)
+    sentence_model = get_sentence_model(args.sentence_model, backend = args.backend)
+    service = SearchService(ner_model, sentence_model, load_corpus_index(args.index),
+                            batch_window_ms = args.batch_window_ms, max_batch_size = args.max_batch_size,
+                            query_cache = QueryCache(args.query_cache_size, args.query_cache_ttl)
+                            if args.query_cache_size > 0 else None)
+
+    async def run():
+        server = await serve(service, args.host, args.port, args.socket)
+        print(f'serving on {args.socket or f"{args.host}:{args.port}"}')
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(run())
@@ -1,2 +1,2 @@
-from .clean_text import clean_ocr_text
+from .clean_text import clean_ocr_text, clean_ocr_texts
 from .dataset import get_dataset
\ No newline at end of file
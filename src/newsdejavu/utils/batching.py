@@ -0,0 +1,61 @@
+'''
+Length-bucketed dynamic batching.
+
+Newspaper articles range from one-line notices to multi-column features. When they are batched in corpus order, every
+batch is padded to its longest member and most of the compute goes into padding. token_budget_batches() instead sorts
+the inputs by tokenized length and cuts the sorted order into batches whose padded size (number of items times the
+longest item) stays within a token budget, so short articles are batched many at a time and long ones a few at a time.
+Callers run the batches and write each output back to its original position.
+'''
+
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+
+def token_lengths(tokenizer, texts: Sequence[str], max_length: Optional[int] = None, chunk_size: int = 10000) -> np.ndarray:
+    """
+    Returns the number of tokens (including special tokens) of each text, capped at max_length if given.
+    """
+    lengths = np.empty(len(texts), dtype = np.int64)
+    for start in range(0, len(texts), chunk_size):
+        encoded = tokenizer(list(texts[start:start + chunk_size]), add_special_tokens = True)
+        lengths[start:start + chunk_size] = [len(ids) for ids in encoded['input_ids']]
+
+    if max_length is not None:
+        np.minimum(lengths, max_length, out = lengths)
+
+    return lengths
+
+
+def token_budget_batches(lengths: Sequence[int], max_batch_tokens: int,
+                         max_batch_size: Optional[int] = None) -> List[List[int]]:
+    """
+    Groups item indices into batches of similar length whose padded size is at most max_batch_tokens.
+
+    Args:
+        lengths (Sequence[int]): The tokenized length of each item.
+        max_batch_tokens (int): The maximum number of items times the longest item length in a batch. An item longer
+            than the budget on its own gets a batch to itself.
+        max_batch_size (Optional[int]): An optional cap on the number of items per batch.
+
+    Returns:
+        List[List[int]]: Batches of indices into lengths, in increasing order of length.
+    """
+    lengths = np.asarray(lengths)
+    order = np.argsort(lengths, kind = 'stable')
+
+    batches = []
+    batch = []
+    for index in order:
+        # Items arrive sorted, so the newest item is always the longest in the batch
+        padded_size = (len(batch) + 1) * int(lengths[index])
+        if batch and (padded_size > max_batch_tokens or (max_batch_size and len(batch) >= max_batch_size)):
+            batches.append(batch)
+            batch = []
+        batch.append(int(index))
+
+    if batch:
+        batches.append(batch)
+
+    return batches
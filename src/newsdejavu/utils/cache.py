@@ -0,0 +1,124 @@
+'''
+Helpers to cache expensive corpus artifacts (masked sentences and embeddings) on disk.
+
+Every cached artifact is stored with metadata describing how it was produced (model names and a fingerprint of the
+corpus). When an artifact is loaded, its metadata is checked against the expected values so that a cache written for a
+different corpus or model is never silently reused.
+
+- masked sentences are stored as a JSON file: {"metadata": {...}, "masked_sentences": [...]}
+- embeddings are stored as a .npy file with a sidecar '{path}.meta.json' metadata file, and loaded memory-mapped
+'''
+
+import os
+import json
+import hashlib
+from typing import Dict, List, Optional
+
+import numpy as np
+
+
+def corpus_fingerprint(sentences: List[str]) -> str:
+    """
+    Returns a SHA-256 fingerprint of an ordered list of sentences. Each sentence is length-prefixed so that different
+    splits of the same characters produce different fingerprints.
+    """
+    digest = hashlib.sha256()
+    for sentence in sentences:
+        encoded = sentence.encode('utf-8')
+        digest.update(len(encoded).to_bytes(8, 'little'))
+        digest.update(encoded)
+
+    return digest.hexdigest()
+
+
+def file_sha256(path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    Returns the SHA-256 hex digest of a file's contents.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def check_metadata(path: str, found: Dict, expected: Dict):
+    """
+    Raises a ValueError if any expected metadata value differs from the value stored with the artifact. None is
+    compared like any other value, and a key missing from the stored metadata is a mismatch, so an artifact written
+    with different settings (or before a setting was recorded) is never reused.
+    """
+    missing = object()
+    mismatched = [key for key, value in expected.items() if found.get(key, missing) != value]
+    if mismatched:
+        details = ', '.join(f'{key}: cached {found.get(key, "nothing")!r}, expected {expected[key]!r}'
+                            for key in mismatched)
+        raise ValueError(f'Cached artifact at {path} does not match this corpus/model ({details}). '
+                         f'Delete it or pass a different path.')
+
+
+def atomic_write(path: str, write_function, mode: str = 'w'):
+    """
+    Writes a file through a temporary file and renames it into place, so an interrupted write never leaves a truncated
+    artifact behind.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok = True)
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, mode) as f:
+        write_function(f)
+    os.replace(tmp_path, path)
+
+
+def save_masked_sentences(path: str, masked_sentences: List[str], metadata: Dict):
+    """
+    Saves masked sentences with their metadata to a JSON file.
+    """
+    atomic_write(path, lambda f: json.dump({'metadata': metadata, 'masked_sentences': list(masked_sentences)}, f))
+
+
+def load_masked_sentences(path: str, expected_metadata: Optional[Dict] = None) -> List[str]:
+    """
+    Loads masked sentences saved with save_masked_sentences(), validating their metadata.
+    """
+    with open(path) as f:
+        cached = json.load(f)
+
+    check_metadata(path, cached['metadata'], expected_metadata or {})
+
+    return cached['masked_sentences']
+
+
+def save_embeddings(path: str, embeddings: np.ndarray, metadata: Dict):
+    """
+    Saves embeddings to a .npy file at exactly path, with their metadata in a sidecar '{path}.meta.json' file. The
+    sidecar is written last, so an interrupted save never leaves a .npy next to metadata it does not match.
+    """
+    meta_path = f'{path}.meta.json'
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+    atomic_write(path, lambda f: np.save(f, embeddings), mode = 'wb')
+    atomic_write(meta_path, lambda f: json.dump({**metadata, 'shape': list(embeddings.shape)}, f))
+
+
+def embeddings_saved(path: str) -> bool:
+    """
+    Returns whether save_embeddings() completed at path. A .npy without its sidecar is from an interrupted save.
+    """
+    return os.path.exists(path) and os.path.exists(f'{path}.meta.json')
+
+
+def load_embeddings(path: str, expected_metadata: Optional[Dict] = None, mmap: bool = True) -> np.ndarray:
+    """
+    Loads embeddings saved with save_embeddings(), validating their metadata. By default the array is memory-mapped.
+    """
+    with open(f'{path}.meta.json') as f:
+        metadata = json.load(f)
+
+    check_metadata(path, metadata, expected_metadata or {})
+
+    return np.load(path, mmap_mode = 'r' if mmap else None)
@@ -1,64 +1,164 @@
-def clean_ocr_text(text, basic, remove_list):
+import re
+from functools import lru_cache
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+NEWLINE_RUN_REGEX = re.compile(r'\n+')
+LIGATURES = ("ﬁ", "ﬂ")
+
+# Characters that are mostly OCR noise in historical newspaper scans
+OCR_ERROR_CHARACTERS = ["#","/","*","@","~","¢","©","®","°"]
+
+
+@lru_cache(maxsize = 32)
+def translate_table(remove: Tuple[str, ...]) -> dict:
+    """
+    Returns the str.translate() table deleting the given characters, built once per remove list.
+    """
+    return {ord(x): '' for x in remove}
+
+
+def replace_newline_run(match) -> str:
+    """
+    Keeps pairs of consecutive newlines (paragraph boundaries) and turns a leftover single newline into a space. An odd
+    run of three or more newlines at the very end of the text, or a text that is just one newline, is left unchanged.
+    """
+    run = match.group()
+    if len(run) % 2 == 0:
+        return run
+
+    at_end = match.end() == len(match.string)
+    if at_end and (len(run) > 1 or match.start() == 0):
+        return run
+
+    return run[:-1] + " "
+
+
+def clean_text(text: str, basic: bool, remove_list: List[str]) -> str:
     """
-    Given 
+    Returns the cleaned text of clean_ocr_text(), without the offsets.
+    """
+    # Code to deal with unwanted symbols
+    cleaned_text = text.replace("-\n", "")
+    if not basic:
+        cleaned_text = cleaned_text.replace("é", "e").replace("ï", "i").replace("ﬁ", "fi").replace("ﬂ", "fl")
+        cleaned_text = cleaned_text.translate(translate_table(tuple(remove_list)))
+
+    # Code to deal with newline and double newline
+    return NEWLINE_RUN_REGEX.sub(replace_newline_run, cleaned_text)
+
+
+def clean_offsets(text: str, basic: bool, remove_list: List[str]) -> np.ndarray:
+    """
+    Returns the offsets of clean_ocr_text() as an int32 array: for each character of text, the number of characters
+    removed (or, for ligatures, minus the number added) before it.
+    """
+    codes = np.frombuffer(text.encode('utf-32-le'), dtype = np.uint32)
+
+    # Both characters of each hyphen-newline are removed
+    removed = np.zeros(len(codes), dtype = np.int32)
+    hyphen_starts = np.flatnonzero((codes[:-1] == ord("-")) & (codes[1:] == ord("\n")))
+    removed[hyphen_starts] = 1
+    removed[hyphen_starts + 1] = 1
+
+    if not basic:
+        ligatures = np.isin(codes, [ord(x) for x in LIGATURES])
+        removed += np.isin(codes, [ord(x) for x in remove_list]) & ~ligatures
+        removed -= ligatures
+
+    offsets = np.zeros(len(codes), dtype = np.int32)
+    np.cumsum(removed[:-1], out = offsets[1:])
+
+    return offsets
+
+
+def clean_ocr_text(text, basic, remove_list, return_array = False):
+    """
+    Given
     - string of text,
     - whether (True/False) to do only basic newline cleaning, and
     - the list of characters to remove (if basic=False),
     returns a tuple containing
     (1) the text after applying the desired cleaning operations, and
     (2) a list of integers indicating, for each character in original text,
-        how many positions to the left that character is offset to arrive at cleaned text.
+        how many positions to the left that character is offset to arrive at cleaned text
+        (an int32 numpy array instead if return_array is True).
     When basic is False, also replaces 'é', 'ï', 'ﬁ', and 'ﬂ'.
     In all cases, hyphen-newline ("-\n") sequences are removed, lone newlines are
     converted to spaces, and sequences of consecutive newlines are kept unchanged
     in order to indicate paragraph boundaries.
+    Runs in time linear in the length of the text.
     """
-    # Code to deal with unwanted symbols
-    cleaned_text = text.replace("-\n", "")
-    if not basic:
-      cleaned_text = cleaned_text.replace("é", "e").replace("ï", "i").replace("ﬁ", "fi").replace("ﬂ", "fl")
-      cleaned_text = cleaned_text.translate({ord(x): '' for x in remove_list})
-      
-    # Code to deal with newline and double newline
-    z = 0
-    while z < (len(cleaned_text)-1):  # Check from the first to before last index
-          if cleaned_text[z] == "\n" and cleaned_text[z+1] == "\n":
-              z += 2
-          elif cleaned_text[z] == "\n" and cleaned_text[z+1] != "\n":
-              temp = list(cleaned_text)
-              temp[z] = " "
-              cleaned_text = "".join(temp)
-              z += 1
-          else:
-              z += 1
-    if cleaned_text[len(cleaned_text)-1] == "\n" and cleaned_text[len(cleaned_text)-2] != "\n":  # Check if the last index is a new line
-      temp = list(cleaned_text)
-      temp[len(cleaned_text)-1] = " "
-      cleaned_text = "".join(temp)  
-
-    # Code to adjust offsets  
-    offsets = []
-    cur_offset = 0
-    i = 0
-      
-    while i < len(text):
-      if i+1 < len(text) and text[i:i+2] == '-\n':  # Found removed hyphen-newline
-        offsets.extend([cur_offset, cur_offset + 1])  # Make removed characters correspond with next character
-        cur_offset += 2  # Update offset for subsequent characters
-        i += 2  # Push forward beyond removed characters
-      else:
-        offsets.append(cur_offset)  # Record offset of non-removed character
-        i += 1  # Process next character
-    
-    if not basic:            
-      for j in range(len(text)):
-        if text[j] == "ﬁ" or text[j] == "ﬂ": 
-            for a in range(j+1,len(text)):
-                offsets[a] = offsets[a] - 1  # Negative offsets for every char after a char replaced with two chars
-        elif text[j] in remove_list:
-            for a in range(j+1,len(text)):  # Positive offsets for every char after a removed char
-                offsets[a] = offsets[a] + 1
-        else:
-            j += 1
-          
-    return cleaned_text, offsets
\ No newline at end of file
+    cleaned_text = clean_text(text, basic, remove_list)
+    offsets = clean_offsets(text, basic, remove_list)
+
+    return cleaned_text, offsets if return_array else offsets.tolist()
+
+
+def clean_ocr_texts(texts: Iterable[str], basic: bool, remove_list: List[str], with_offsets: bool = True,
+                    return_array: bool = False) -> Tuple[List[str], Optional[List]]:
+    """
+    Applies clean_ocr_text() to every text of a batch, e.g. a datasets column.
+
+    Args:
+        texts (Iterable[str]): The texts to clean.
+        basic (bool): Whether to do only basic newline cleaning.
+        remove_list (List[str]): Characters to remove if basic is False.
+        with_offsets (bool): Whether to compute the offsets. Skipping them is faster when only the text is needed.
+        return_array (bool): Whether to return each offsets as an int32 numpy array instead of a list.
+
+    Returns:
+        Tuple[List[str], Optional[List]]: The cleaned texts, and the offsets of each text (None if with_offsets is
+        False).
+
+    Example:
+        >>> cleaned_texts, _ = clean_ocr_texts(dataset['article'], True, [], with_offsets = False)
+    """
+    if not with_offsets:
+        return [clean_text(text, basic, remove_list) for text in texts], None
+
+    cleaned_texts, offsets = [], []
+    for text in texts:
+        cleaned_text, text_offsets = clean_ocr_text(text, basic, remove_list, return_array)
+        cleaned_texts.append(cleaned_text)
+        offsets.append(text_offsets)
+
+    return cleaned_texts, offsets
+
+
+def clean_ocr_batch(texts: List[str], column: str, basic: bool, remove_list: List[str]) -> dict:
+    """
+    Dataset.map() function cleaning one batch of a text column.
+    """
+    cleaned_texts, _ = clean_ocr_texts(texts, basic, remove_list, with_offsets = False)
+    return {column: cleaned_texts}
+
+
+def clean_ocr_dataset(dataset, column: str = 'article', basic: bool = True,
+                      remove_list: List[str] = OCR_ERROR_CHARACTERS, num_proc: Optional[int] = None,
+                      batch_size: int = 1000):
+    """
+    Cleans a text column of a datasets Dataset with a batched Dataset.map().
+
+    For a dataset loaded from files (e.g. a downloaded year), the cleaned column is cached as Arrow next to the
+    dataset's own cache files, so cleaning the same dataset again reuses it instead of recomputing it.
+
+    Args:
+        dataset (Dataset): The dataset to clean.
+        column (str): The text column to clean. Defaults to 'article'.
+        basic (bool): Whether to do only basic newline cleaning. Defaults to True.
+        remove_list (List[str]): Characters to remove if basic is False. Defaults to OCR_ERROR_CHARACTERS.
+        num_proc (Optional[int]): Number of processes to clean in. Defaults to cleaning in the calling process.
+        batch_size (int): Number of texts per map batch. Defaults to 1000.
+
+    Returns:
+        Dataset: The dataset with the column cleaned.
+
+    Example:
+        >>> corpus = clean_ocr_dataset(download('american stories:1840'), num_proc = 8)
+    """
+    return dataset.map(clean_ocr_batch, batched = True, batch_size = batch_size, num_proc = num_proc,
+                       input_columns = [column],
+                       fn_kwargs = {'column': column, 'basic': basic, 'remove_list': list(remove_list)},
+                       desc = 'Cleaning OCR text')
@@ -10,19 +10,77 @@ The following kinds of data objects can be passed into the create_dataset functi
     - pandas series
 
 And the behavior will 
+
+Files are loaded with the datasets library's Arrow builders (text, JSON lines and Parquet), which write them to Arrow
+files in the datasets cache and memory-map them, so large corpora are never materialized as Python lists. A .txt file
+holds one article, and JSON lines and Parquet files hold one article per row.
 '''
 
 import os
 import json
+from itertools import islice
+from typing import List, Optional
 
 import pandas as pd
-from datasets import Dataset, load_dataset
+from datasets import Dataset, concatenate_datasets, load_dataset
+
+# The datasets builder that loads each supported file extension
+FILE_BUILDERS = {
+    '.txt': 'text',
+    '.json': 'json',
+    '.jsonl': 'json',
+    '.parquet': 'parquet',
+}
+
+# Number of list elements inspected to decide what kind of list get_dataset() was given
+TYPE_SAMPLE_SIZE = 100
+
+
+def file_builder(file_path: str) -> str:
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension not in FILE_BUILDERS:
+        raise ValueError(f'Unsupported file type {extension} for {file_path}, must be one of {", ".join(FILE_BUILDERS)}')
+
+    return FILE_BUILDERS[extension]
+
+
+def load_files(builder: str, file_paths: List[str], columns: Optional[List[str]] = None) -> Dataset:
+    '''
+    Load files of one type into a memory-mapped dataset, keeping only the given columns.
+    '''
+    if builder == 'text':
+        dataset = load_dataset('text', data_files = file_paths, sample_by = 'document')['train']
+        dataset = dataset.rename_column('text', 'article')
+    elif builder == 'parquet' and columns is not None:
+        # Parquet is columnar, so unused columns are never read
+        dataset = load_dataset('parquet', data_files = file_paths, columns = columns)['train']
+    else:
+        dataset = load_dataset(builder, data_files = file_paths)['train']
+
+    if columns is not None:
+        dataset = dataset.select_columns(columns)
 
-def create_dataset_from_list_of_file_paths(file_paths: list) -> Dataset:
+    return dataset
+
+
+def create_dataset_from_list_of_file_paths(file_paths: list, columns: Optional[List[str]] = None) -> Dataset:
     '''
-    Create a huggingface dataset from a list of file paths.
+    Create a huggingface dataset from a list of file paths (.txt, .json, .jsonl or .parquet). Files of different types
+    are loaded separately and concatenated in the order of their first file.
     '''
-    pass
+    file_paths = [str(file_path) for file_path in file_paths]
+    grouped = {}
+    for file_path in file_paths:
+        grouped.setdefault(file_builder(file_path), []).append(file_path)
+
+    datasets = [load_files(builder, paths, columns) for builder, paths in grouped.items()]
+    if len(datasets) == 1:
+        return datasets[0]
+
+    # Builders may infer different types for the same column (e.g. JSON dates as timestamps)
+    features = datasets[0].features
+    return concatenate_datasets([dataset if dataset.features == features else dataset.cast(features)
+                                 for dataset in datasets])
 
 def create_dataset_from_list_of_dicts(dicts: list) -> Dataset:
     '''
@@ -36,11 +94,21 @@ def create_dataset_from_list_of_texts(texts: list) -> Dataset:
     '''
     return Dataset.from_dict({'article': texts})
 
-def create_dataset_from_directory(directory: str) -> Dataset:
+def create_dataset_from_directory(directory: str, columns: Optional[List[str]] = None) -> Dataset:
     '''
-    Create a huggingface dataset from a directory of files.
+    Create a huggingface dataset from a directory of files, including its subdirectories. Files of unsupported types
+    are skipped.
     '''
-    pass
+    file_paths = []
+    for root, directories, files in os.walk(directory):
+        directories.sort()
+        file_paths.extend(os.path.join(root, f) for f in sorted(files)
+                          if os.path.splitext(f)[1].lower() in FILE_BUILDERS)
+
+    if not file_paths:
+        raise ValueError(f'No {", ".join(FILE_BUILDERS)} files found in {directory}')
+
+    return create_dataset_from_list_of_file_paths(file_paths, columns)
 
 def create_dataset_from_series(series: pd.Series) -> Dataset:
     '''
@@ -49,7 +117,7 @@ def create_dataset_from_series(series: pd.Series) -> Dataset:
     if series.name == 'text':
         return Dataset.from_pandas(series)
     elif series.name == 'files':
-        return create_dataset_from_list_of_file_paths(series)
+        return create_dataset_from_list_of_file_paths(series.tolist())
     else:
         raise ValueError('Unrecognized pandas series type, must be named "text" or "files"')
     
@@ -65,25 +133,42 @@ def create_dataset_from_dataframe(dataframe: pd.DataFrame) -> Dataset:
         raise ValueError('Unrecognized pandas dataframe type, must contain a column named "text" or "files"')
 
 
-def get_dataset(dataset):
+def sample(items: list) -> list:
+    '''
+    Returns up to TYPE_SAMPLE_SIZE elements spread evenly over a list.
+    '''
+    step = max(1, len(items) // TYPE_SAMPLE_SIZE)
+    return list(islice(items, 0, None, step))[:TYPE_SAMPLE_SIZE]
+
+
+def get_dataset(dataset, columns: Optional[List[str]] = None):
     '''
     Create a huggingface dataset from a variety of input types.
+
+    The kind of a list (texts, file paths or dictionaries) is decided from a sample of its elements rather than by
+    checking every element. If columns is given, only those columns are loaded from files.
     '''
     
     if isinstance(dataset, str):
         if os.path.isdir(dataset):
-            return create_dataset_from_directory(dataset)
+            return create_dataset_from_directory(dataset, columns)
+        elif os.path.isfile(dataset):
+            return create_dataset_from_list_of_file_paths([dataset], columns)
         else:
             raise ValueError('Unrecognized string input type')
     
     elif isinstance(dataset, list):
-        if all([isinstance(x, str) for x in dataset]):
-            if all([os.path.isfile(x) for x in dataset]):
-                return create_dataset_from_list_of_file_paths(dataset)
+        if not dataset:
+            return create_dataset_from_list_of_texts(dataset)
+
+        sampled = sample(dataset)
+        if all(isinstance(x, str) for x in sampled):
+            if all(os.path.isfile(x) for x in sampled):
+                return create_dataset_from_list_of_file_paths(dataset, columns)
             else:
                 return create_dataset_from_list_of_texts(dataset)
 
-        elif all([isinstance(x, dict) for x in dataset]):
+        elif all(isinstance(x, dict) for x in sampled):
             return create_dataset_from_list_of_dicts(dataset)
         else:
             raise ValueError('Unrecognized list input type')
@@ -0,0 +1,59 @@
+'''
+Background prefetching of an iterable.
+
+prefetch() consumes an iterable in a background thread and hands its items over through a bounded queue, so producing
+the next item (e.g. cleaning the next shard of articles) overlaps with whatever the caller does with the current one
+(e.g. model inference, which releases the GIL). At most buffer_size items are produced ahead of the caller.
+'''
+
+import queue
+import threading
+from typing import Iterable, Iterator, TypeVar
+
+T = TypeVar('T')
+
+# Marks the end of the iterable in the queue
+END = object()
+
+
+def prefetch(iterable: Iterable[T], buffer_size: int = 1) -> Iterator[T]:
+    """
+    Yields the items of iterable, producing up to buffer_size items ahead in a background thread. An exception raised
+    while producing an item is raised again in the caller.
+    """
+    items = queue.Queue(maxsize = buffer_size)
+    stopped = threading.Event()
+
+    def put(item) -> bool:
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout = 0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except BaseException as error:
+            put((END, error))
+            return
+        put((END, None))
+
+    thread = threading.Thread(target = produce, daemon = True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is END:
+                return
+            yield item
+    finally:
+        # Lets the producer exit if the caller stops early
+        stopped.set()
+        thread.join()
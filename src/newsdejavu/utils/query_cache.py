@@ -0,0 +1,181 @@
+'''
+In-memory cache of the masked text and embedding of query sentences.
+
+The same queries (e.g. the headlines of trending stories) reach a search service again and again. A QueryCache keeps
+the chain query text -> masked text -> embedding in two bounded LRU caches, so a repeated query skips both the NER and
+the embedding pass and goes straight to the index search:
+
+- masked texts are keyed on the NER model, its backend, the masking options and the query text
+- embeddings are keyed on the sentence model, its dtype and backend (as in the on-disk embedding cache) and the masked
+  text, so queries that only differ in the entities they name (and thus mask to the same text) share one embedding
+
+Entries can optionally expire after a time to live, and both caches count their hits, misses and evictions.
+'''
+
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+
+from ..embed.embed import sentence_model_id
+from ..ner.ner import ner_model_id
+
+DEFAULT_MAX_QUERIES = 10000
+
+
+class LRUCache:
+    """
+    A thread-safe LRU cache holding at most max_size entries, each expiring ttl seconds after it was stored if ttl is
+    given.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_MAX_QUERIES, ttl: Optional[float] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        if max_size < 1:
+            raise ValueError(f'max_size must be at least 1, got {max_size}')
+        if ttl is not None and ttl <= 0:
+            raise ValueError(f'ttl must be positive, got {ttl}')
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        Returns the value stored for key and marks it as recently used, or None if it is missing or expired.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None and entry[1] <= self.clock():
+                del self.entries[key]
+                self.expirations += 1
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any):
+        """
+        Stores a value, evicting the least recently used entries if the cache is full.
+        """
+        expiry = self.clock() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.entries[key] = (value, expiry)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last = False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {'size': len(self.entries), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0, 'evictions': self.evictions,
+                'expirations': self.expirations}
+
+
+class QueryCache:
+    """
+    Caches the masked text and the embedding of query sentences, per NER and sentence model.
+
+    Args:
+        max_size (int): Maximum number of masked texts, and of embeddings, kept. Defaults to 10000.
+        ttl (Optional[float]): Number of seconds after which entries expire, e.g. so that queries are masked again by
+            a retrained model deployed under the same path. Defaults to never.
+
+    Example:
+        >>> query_cache = QueryCache(max_size = 50000, ttl = 3600)
+        >>> results = search_same_story(queries, None, ner_model, same_story_model, corpus_index = corpus_index,
+        ...                             query_cache = query_cache)
+        >>> query_cache.stats()
+    """
+
+    def __init__(self, max_size: int = DEFAULT_MAX_QUERIES, ttl: Optional[float] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.masked_texts = LRUCache(max_size, ttl, clock)
+        self.embeddings = LRUCache(max_size, ttl, clock)
+
+    def mask_and_embed(self, queries: Sequence[str], ner_model, sentence_model,
+                       mask_function: Callable[[List[str]], List[str]],
+                       embed_function: Callable[[List[str]], np.ndarray],
+                       mask_options: Optional[Dict] = None, torch_dtype: Optional[torch.dtype] = None,
+                       backend: str = 'torch') -> Tuple[List[str], np.ndarray]:
+        """
+        Returns the masked texts and embeddings of the queries, running mask_function and embed_function only on the
+        distinct queries, and then masked texts, that are not cached.
+
+        Args:
+            queries (Sequence[str]): The query sentences.
+            ner_model: The NER model (path or pipeline) mask_function uses, part of the cache key.
+            sentence_model: The sentence model (path or SentenceTransformer) embed_function uses, part of the cache key.
+            mask_function (Callable): Masks a list of queries, e.g. a call to ner_and_mask().
+            embed_function (Callable): Embeds a list of masked texts, e.g. a call to embed().
+            mask_options (Optional[Dict]): Options of mask_function that change the masked text (labels to mask, ...),
+                part of the cache key. Its 'backend' is the backend of a NER model given by path.
+            torch_dtype (Optional[torch.dtype]): The dtype embed_function runs a sentence model given by path in.
+            backend (str): The backend embed_function runs a sentence model given by path on. Models already loaded
+                are keyed on their own dtype and backend.
+
+        Returns:
+            Tuple[List[str], np.ndarray]: The masked queries and their float32 embeddings.
+        """
+        options = tuple(sorted((name, repr(value)) for name, value in (mask_options or {}).items()))
+        ner_id = ner_model_id(ner_model, backend = (mask_options or {}).get('backend', 'torch'))
+        sentence_id = sentence_model_id(sentence_model, torch_dtype, backend)
+
+        mask_keys = [(ner_id, options, query) for query in queries]
+        masked_queries = [self.masked_texts.get(key) for key in mask_keys]
+        missing = list(dict.fromkeys(query for query, masked in zip(queries, masked_queries) if masked is None))
+        if missing:
+            new_masked = dict(zip(missing, mask_function(missing)))
+            for key in dict.fromkeys(mask_keys):
+                if key[2] in new_masked:
+                    self.masked_texts.put(key, new_masked[key[2]])
+            masked_queries = [new_masked[query] if masked is None else masked
+                              for query, masked in zip(queries, masked_queries)]
+
+        embed_keys = [(sentence_id, masked) for masked in masked_queries]
+        embeddings = [self.embeddings.get(key) for key in embed_keys]
+        missing = list(dict.fromkeys(masked for masked, embedding in zip(masked_queries, embeddings)
+                                     if embedding is None))
+        if missing:
+            new_embeddings = dict(zip(missing, np.asarray(embed_function(missing), dtype = np.float32)))
+            for masked, embedding in new_embeddings.items():
+                self.embeddings.put((sentence_id, masked), embedding)
+            embeddings = [new_embeddings[masked] if embedding is None else embedding
+                          for masked, embedding in zip(masked_queries, embeddings)]
+
+        if not embeddings:
+            return masked_queries, np.zeros((0, 0), dtype = np.float32)
+
+        return masked_queries, np.stack(embeddings)
+
+    def clear(self):
+        self.masked_texts.clear()
+        self.embeddings.clear()
+
+    def stats(self) -> Dict:
+        """
+        Returns the size, hits, misses, hit rate, evictions and expirations of the masked text and embedding caches.
+        """
+        return {'masked_texts': self.masked_texts.stats(), 'embeddings': self.embeddings.stats()}
@@ -0,0 +1,183 @@
+'''
+Process-wide registry of loaded models.
+
+Loading a NER model or a sentence-transformer from disk (or from the Hugging Face hub) takes far longer than running it
+on a handful of queries. ner() and embed() therefore fetch their models from this registry, which loads each model once
+per (path, device, dtype, backend) and hands the same object back on every later call. A long-lived process can load
+its models up front with warmup() and free them again with release().
+
+Besides eager PyTorch ('torch'), models can run on ONNX Runtime ('onnx', or 'onnx-int8' with int8 weights) on CPU, see
+newsdejavu.backends.
+'''
+
+import gc
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+from transformers import pipeline, AutoModelForTokenClassification, AutoTokenizer
+from sentence_transformers import SentenceTransformer
+
+DEFAULT_DEVICE = "cuda:0" if torch.cuda.is_available() else "cpu"
+
+loaded_models: Dict[Tuple, Any] = {}
+registry_lock = threading.Lock()
+
+
+def dtype_name(torch_dtype: Optional[torch.dtype]) -> Optional[str]:
+    return str(torch_dtype) if torch_dtype is not None else None
+
+
+def get_or_load(key: Tuple, load_function):
+    """
+    Returns the registered object for key, loading and registering it first if needed.
+    """
+    with registry_lock:
+        if key not in loaded_models:
+            loaded_models[key] = load_function()
+        return loaded_models[key]
+
+
+def model_name(model) -> str:
+    """
+    Returns the path or identifier of a model given either as a string or as an already-loaded pipeline or
+    SentenceTransformer.
+    """
+    if isinstance(model, str):
+        return model
+
+    return model.tokenizer.name_or_path
+
+
+def loaded_model_settings(model) -> Tuple[Optional[torch.dtype], str]:
+    """
+    Returns the dtype and backend an already-loaded model runs in. model is a torch module (e.g. a SentenceTransformer)
+    or a pipeline holding one.
+    """
+    from ..backends.onnx_runtime import OnnxModel
+
+    network = model if isinstance(model, torch.nn.Module) else getattr(model, 'model', None)
+    torch_dtype, backend = None, 'torch'
+    for module in network.modules() if isinstance(network, torch.nn.Module) else []:
+        if isinstance(module, OnnxModel):
+            backend = 'onnx-int8' if module.path.endswith('_int8.onnx') else 'onnx'
+    for parameter in network.parameters() if isinstance(network, torch.nn.Module) else []:
+        if parameter.is_floating_point():
+            torch_dtype = parameter.dtype
+            break
+
+    return torch_dtype, backend
+
+
+def check_onnx_options(backend: str, torch_dtype: Optional[torch.dtype]):
+    from ..backends.onnx_runtime import check_backend
+
+    check_backend(backend)
+    if backend != 'torch' and torch_dtype is not None:
+        raise ValueError(f'torch_dtype cannot be used with the {backend} backend')
+
+
+def get_token_classifier(model_path: str, max_length: int = 256, torch_device: str = DEFAULT_DEVICE,
+                         torch_dtype: Optional[torch.dtype] = None, backend: str = 'torch'):
+    """
+    Returns a NER token classification pipeline for model_path, loading it on first use. The ONNX backends run on CPU
+    whatever torch_device is.
+    """
+    check_onnx_options(backend, torch_dtype)
+    if backend != 'torch':
+        torch_device = 'cpu'
+
+    def load():
+        model=AutoModelForTokenClassification.from_pretrained(model_path)
+        if torch_dtype is not None:
+            model = model.to(torch_dtype)
+        print("Loaded ner model")
+
+        tokenizer=AutoTokenizer.from_pretrained(model_path, return_tensors="pt",
+                                                max_length=max_length, truncation=True)
+        print("Loaded tokenizer")
+        token_classifier = pipeline(task="ner" ,
+                        model=model, tokenizer=tokenizer,
+                        aggregation_strategy="max", ignore_labels = [],
+                        device=torch_device)
+        if backend != 'torch':
+            from ..backends.onnx_runtime import onnx_token_classifier
+            token_classifier = onnx_token_classifier(token_classifier, model_path, quantize = backend == 'onnx-int8')
+        return token_classifier
+
+    return get_or_load(('ner', model_path, max_length, str(torch_device), dtype_name(torch_dtype), backend), load)
+
+
+def get_tokenizer(model: str):
+    """
+    Returns the tokenizer of a sentence model, loading it on first use. If no organization is provided in the model
+    repo, tries dell-research-harvard > sentence-transformers > throws error.
+    """
+    def load():
+        try:
+            tokenizer = AutoTokenizer.from_pretrained(model)
+        except:
+            try:
+                tokenizer = AutoTokenizer.from_pretrained(f"dell-research-harvard/{model}")
+            except:
+                tokenizer = AutoTokenizer.from_pretrained(f"sentence-transformers/{model}")
+        return tokenizer
+
+    return get_or_load(('tokenizer', model), load)
+
+
+def get_sentence_model(model: str, device: Optional[str] = None, torch_dtype: Optional[torch.dtype] = None,
+                       backend: str = 'torch') -> SentenceTransformer:
+    """
+    Returns a SentenceTransformer for model, loading it on first use. The ONNX backends run on CPU whatever device is.
+    """
+    check_onnx_options(backend, torch_dtype)
+    if backend != 'torch':
+        device = 'cpu'
+
+    def load():
+        sentence_model = SentenceTransformer(model, device = device)
+        if torch_dtype is not None:
+            sentence_model = sentence_model.to(torch_dtype)
+        if backend != 'torch':
+            from ..backends.onnx_runtime import onnx_sentence_model
+            sentence_model = onnx_sentence_model(sentence_model, model, quantize = backend == 'onnx-int8')
+        return sentence_model
+
+    return get_or_load(('sentence', model, device, dtype_name(torch_dtype), backend), load)
+
+
+def warmup(ner_model: Optional[str] = None, sentence_model: Optional[str] = None, torch_device: str = DEFAULT_DEVICE,
+           sentence_device: Optional[str] = None, torch_dtype: Optional[torch.dtype] = None, max_length: int = 256,
+           backend: str = 'torch'):
+    """
+    Loads the given models into the registry ahead of the first request. The arguments should match those later passed
+    to ner() and embed(), since models are registered per device, dtype and backend.
+    """
+    if ner_model:
+        get_token_classifier(ner_model, max_length, torch_device, torch_dtype, backend)
+    if sentence_model:
+        get_tokenizer(sentence_model)
+        get_sentence_model(sentence_model, sentence_device, torch_dtype, backend)
+
+
+def release(model: Optional[str] = None):
+    """
+    Removes a model (all devices and dtypes), or every model if none is given, from the registry and frees its memory.
+    """
+    with registry_lock:
+        for key in list(loaded_models):
+            if model is None or key[1] == model:
+                del loaded_models[key]
+
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def registered_models() -> List[Tuple]:
+    """
+    Returns the keys of the models currently held by the registry.
+    """
+    with registry_lock:
+        return list(loaded_models)
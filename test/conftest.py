@@ -0,0 +1,76 @@
+'''
+Fixtures shared by the unit tests: tiny randomly initialised models that can be built offline, and a fake embed() for
+tests that only exercise the logic around the models.
+'''
+
+import numpy as np
+import pytest
+import torch
+
+
+tiny_vocabulary = ['i', 'am', 'john', 'doe', 'and', 'live', 'in', 'new', 'york', 'work', 'at', 'google', 'a', '.', ',']
+
+
+def save_tiny_model(model_dir, model_class, **config_kwargs) -> str:
+    """Saves a randomly initialised one-layer BERT model of model_class and its tokenizer to model_dir."""
+    from transformers import BertConfig, BertTokenizerFast
+
+    with open(model_dir / 'vocab.txt', 'w') as f:
+        f.write('\n'.join(['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + tiny_vocabulary))
+
+    config = BertConfig(vocab_size = 20, hidden_size = 16, num_hidden_layers = 1, num_attention_heads = 2,
+                        intermediate_size = 32, max_position_embeddings = 512, **config_kwargs)
+    torch.manual_seed(0)
+    model_class(config).save_pretrained(model_dir)
+    BertTokenizerFast(vocab_file = str(model_dir / 'vocab.txt')).save_pretrained(model_dir)
+
+    return str(model_dir)
+
+
+@pytest.fixture(scope = 'session')
+def tiny_ner_model(tmp_path_factory):
+    """A randomly initialised token classification model small enough to build offline."""
+    from transformers import BertForTokenClassification
+
+    labels = ['O', 'B-PER', 'I-PER', 'B-ORG', 'I-ORG', 'B-LOC', 'I-LOC', 'B-MISC', 'I-MISC']
+    return save_tiny_model(tmp_path_factory.mktemp('tiny_ner_model'), BertForTokenClassification,
+                           id2label = dict(enumerate(labels)), label2id = {label: i for i, label in enumerate(labels)})
+
+
+@pytest.fixture(scope = 'session')
+def tiny_sentence_model(tmp_path_factory):
+    """A randomly initialised sentence model small enough to build offline."""
+    from transformers import BertModel
+
+    return save_tiny_model(tmp_path_factory.mktemp('tiny_sentence_model'), BertModel)
+
+
+class FakeEmbed:
+    """
+    A cheap deterministic stand-in for embed(). Each text is embedded as the normalised vector [length, number of
+    'e's, number of 'a's, 1], and the texts of every call are recorded in calls.
+    """
+
+    def __init__(self, monkeypatch):
+        self.monkeypatch = monkeypatch
+        self.calls = []
+
+    @staticmethod
+    def embeddings(texts) -> np.ndarray:
+        embeddings = np.array([[len(text), text.count('e'), text.count('a'), 1.0] for text in texts], dtype = np.float32)
+        return embeddings / np.linalg.norm(embeddings, axis = 1, keepdims = True)
+
+    def __call__(self, corpus, model = None, batch_size = 512, save_path = None, **kwargs) -> np.ndarray:
+        corpus = list(corpus)
+        self.calls.append(corpus)
+        return self.embeddings(corpus)
+
+    def install(self, module):
+        """Replaces the embed() used by module with this fake."""
+        self.monkeypatch.setattr(module, 'embed', self)
+        return self
+
+
+@pytest.fixture
+def fake_embed(monkeypatch):
+    return FakeEmbed(monkeypatch)
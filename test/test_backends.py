@@ -0,0 +1,93 @@
+'''
+Parity tests of the ONNX Runtime backends against PyTorch, on small randomly initialised models that can be built
+offline.
+'''
+
+import importlib
+
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip('onnxruntime')
+
+from newsdejavu import ner, ner_and_mask, embed
+from newsdejavu.backends.benchmark import backend_benchmark
+
+registry = importlib.import_module('newsdejavu.utils.registry')
+onnx_runtime = importlib.import_module('newsdejavu.backends.onnx_runtime')
+
+
+sentences = ['i am john doe and i live in new york .', 'i work at google', 'john doe , new york , google and a doe',
+             'a doe']
+
+
+@pytest.fixture(autouse = True)
+def onnx_cache(tmp_path_factory, monkeypatch):
+    cache_dir = tmp_path_factory.getbasetemp() / 'onnx_cache'
+    monkeypatch.setenv(onnx_runtime.ONNX_CACHE_ENV, str(cache_dir))
+    return cache_dir
+
+
+class TestOnnxBackends:
+
+    def test_ner_parity(self, tiny_ner_model):
+        expected = ner(sentences, tiny_ner_model, batch_size = 2, torch_device = 'cpu')
+        output = ner(sentences, tiny_ner_model, batch_size = 2, torch_device = 'cpu', backend = 'onnx')
+
+        for expected_entities, entities in zip(expected, output):
+            assert [(entity['entity_group'], entity['start'], entity['end']) for entity in entities] == \
+                   [(entity['entity_group'], entity['start'], entity['end']) for entity in expected_entities]
+            np.testing.assert_allclose([entity['score'] for entity in entities],
+                                       [entity['score'] for entity in expected_entities], atol = 1e-4)
+
+        for use_offsets in [False, True]:
+            assert ner_and_mask(sentences, tiny_ner_model, batch_size = 2, torch_device = 'cpu', backend = 'onnx',
+                                use_offsets = use_offsets) == \
+                   ner_and_mask(sentences, tiny_ner_model, batch_size = 2, torch_device = 'cpu',
+                                use_offsets = use_offsets)
+
+    def test_int8_ner_mostly_agrees(self, tiny_ner_model):
+        # Quantization error can flip the near-uniform predictions of a random model, so only most outputs must agree
+        for use_offsets in [False, True]:
+            expected = ner_and_mask(sentences, tiny_ner_model, batch_size = 2, torch_device = 'cpu',
+                                    use_offsets = use_offsets)
+            output = ner_and_mask(sentences, tiny_ner_model, batch_size = 2, torch_device = 'cpu',
+                                  backend = 'onnx-int8', use_offsets = use_offsets)
+
+            assert len(output) == len(expected)
+            assert np.mean([masked == expected_masked for masked, expected_masked in zip(output, expected)]) >= 0.5
+
+    @pytest.mark.parametrize('backend, min_cosine', [('onnx', 0.99999), ('onnx-int8', 0.99)])
+    def test_embedding_parity(self, tiny_sentence_model, backend, min_cosine):
+        expected = embed(sentences, tiny_sentence_model, batch_size = 2, device = 'cpu')
+        output = embed(sentences, tiny_sentence_model, batch_size = 2, backend = backend)
+
+        assert output.shape == expected.shape
+        assert np.min(np.sum(output * expected, axis = 1)) > min_cosine
+
+    def test_reuses_exported_graph(self, tiny_ner_model, onnx_cache, monkeypatch):
+        registry.release(tiny_ner_model)
+        ner(sentences, tiny_ner_model, torch_device = 'cpu', backend = 'onnx')
+        registry.release(tiny_ner_model)
+
+        def fail_export(*args, **kwargs):
+            raise AssertionError('The cached graph should be used')
+
+        monkeypatch.setattr(onnx_runtime, 'export_onnx', fail_export)
+        ner(sentences, tiny_ner_model, torch_device = 'cpu', backend = 'onnx')
+        assert any(path.name == 'model.onnx' for path in onnx_cache.rglob('*'))
+
+    def test_rejects_unknown_backend_and_dtype(self, tiny_ner_model):
+        with pytest.raises(ValueError):
+            ner(sentences, tiny_ner_model, torch_device = 'cpu', backend = 'tensorrt')
+        with pytest.raises(ValueError):
+            ner(sentences, tiny_ner_model, torch_device = 'cpu', backend = 'onnx', torch_dtype = torch.float16)
+
+    def test_benchmark(self, tiny_ner_model, tiny_sentence_model):
+        results = backend_benchmark(sentences, tiny_ner_model, tiny_sentence_model, backends = ['onnx'], repeats = 1)
+
+        assert [row['backend'] for row in results] == ['onnx']
+        assert results[0]['masked_text_agreement'] == 1.0
+        assert results[0]['min_embedding_cosine'] > 0.99999
+        assert results[0]['ner_texts_per_second'] > 0 and results[0]['embed_speedup'] > 0
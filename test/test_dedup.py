@@ -0,0 +1,80 @@
+'''
+Unit tests for MinHash/LSH reprint detection.
+'''
+
+import random
+
+import numpy as np
+import pytest
+
+from newsdejavu import reprint_clusters
+from newsdejavu.dedup.minhash import minhash_signatures, lsh_bands, shingle_hashes, universal_hashes
+
+
+def reprinted_corpus(num_stories = 20, num_reprints = 3, num_errors = 5, seed = 0):
+    rng = random.Random(seed)
+    vocabulary = [f'word{i}' for i in range(5000)]
+    texts, stories = [], []
+    for story in range(num_stories):
+        words = rng.choices(vocabulary, k = 150)
+        texts.append(' '.join(words))
+        stories.append(story)
+        for _ in range(num_reprints):
+            # OCR errors in a few words of each reprint
+            reprint = list(words)
+            for position in rng.sample(range(len(reprint)), num_errors):
+                reprint[position] = reprint[position][::-1]
+            texts.append(' '.join(reprint))
+            stories.append(story)
+
+    return texts, stories
+
+
+class TestMinHash:
+
+    def test_signatures_estimate_jaccard(self):
+        first = ' '.join(f'word{i}' for i in range(200))
+        second = ' '.join(f'word{i}' for i in range(100, 300))
+        signatures = minhash_signatures([first, second], num_perm = 512)
+
+        estimate = (signatures[0] == signatures[1]).mean()
+        assert abs(estimate - 98 / 302) < 0.08
+
+    def test_universal_hashes_do_not_overflow(self):
+        prime = (1 << 61) - 1
+        rng = np.random.default_rng(0)
+        a = np.append(rng.integers(1, prime, size = 50, dtype = np.uint64), prime - 1).astype(np.uint64)[:, None]
+        b = np.append(rng.integers(0, prime, size = 50, dtype = np.uint64), prime - 1).astype(np.uint64)[:, None]
+        hashes = np.append(rng.integers(0, 1 << 32, size = 20, dtype = np.uint64), (1 << 32) - 1).astype(np.uint64)
+
+        expected = [[(int(a_i) * int(h) + int(b_i)) % prime for h in hashes] for a_i, b_i in zip(a[:, 0], b[:, 0])]
+        assert universal_hashes(a, b, hashes).tolist() == expected
+
+    def test_shingles_ignore_case_punctuation_and_hyphenation(self):
+        assert np.array_equal(np.sort(shingle_hashes('The Wire Story, as re-\nprinted.')),
+                              np.sort(shingle_hashes('the wire story as reprinted')))
+
+    def test_lsh_bands(self):
+        bands, rows = lsh_bands(0.5, 128)
+        assert bands * rows == 128
+        assert (1 / bands) ** (1 / rows) <= 0.5
+
+
+class TestReprintClusters:
+
+    def test_groups_reprints(self):
+        texts, stories = reprinted_corpus()
+        clusters = reprint_clusters(texts)
+
+        assert len(clusters) == 20
+        assert list(clusters.representatives) == list(range(0, 80, 4))
+        assert list(clusters.counts) == [4] * 20
+        assert all(stories[i] == stories[label] for i, label in enumerate(clusters.labels))
+        assert clusters.members(4) == [4, 5, 6, 7]
+
+    def test_threshold(self):
+        texts, _ = reprinted_corpus(num_stories = 5, num_errors = 60)
+
+        assert len(reprint_clusters(texts, threshold = 0.9)) == 20
+        with pytest.raises(ValueError):
+            reprint_clusters(texts, threshold = 0)
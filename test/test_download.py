@@ -3,12 +3,30 @@ Unit tests for download functions.
 '''
 
 import os
+import importlib
+import numpy as np
 import pytest
 import shutil
 from datasets import Dataset
 
 
 from newsdejavu import download, parse_download_string
+from newsdejavu.download.embeddings import embedding_matrix
+
+@pytest.fixture
+def fake_embedding_models(monkeypatch, fake_embed):
+    '''
+    Replaces NER and embedding in the embeddings download with fast fakes, recording the masked texts embedded
+    '''
+    embeddings_module = importlib.import_module('newsdejavu.download.embeddings')
+
+    def fake_ner_and_mask(articles, ner_model, batch_size = 1):
+        return [article.replace('The', '[MASK]') for article in articles['article']]
+
+    monkeypatch.setattr(embeddings_module, 'ner_and_mask', fake_ner_and_mask)
+    fake_embed.install(embeddings_module)
+    return fake_embed
+
 
 class TestParseDownloadStringAmericanStories:
     '''
@@ -77,15 +95,16 @@ class TestDownloadsAmericanStories:
     Covering most cases of download for American Stories, including errors
     '''
 
-    def test_1(self):
+    def test_1(self, tmp_path, fake_embedding_models):
         download_string = 'american stories:1798:embeddings'
-        with pytest.raises(NotImplementedError):
-            download(download_string)
+        dataset = download(download_string, save_folder = str(tmp_path), fetch_year = FakeAmericanStories())
+        assert dataset.column_names == ['article_id', 'article', 'newspaper_name', 'masked_article', 'embedding']
+        assert len(dataset) == 3
 
-    def test_2(self):
+    def test_2(self, tmp_path):
         download_string = 'american stories:embeddings'
-        with pytest.raises(NotImplementedError):
-            download(download_string)
+        with pytest.raises(ValueError):
+            download(download_string, save_folder = str(tmp_path))
 
     def test_3(self):
         download_string = 'american stories:1870'
@@ -105,3 +124,107 @@ class TestDownloadsAmericanStories:
     #     download(download_string)
     #     assert os.path.isdir('data/american_stories_1798-1799')
     #     shutil.rmtree('data/american_stories_1798-1799')
+
+
+class FakeAmericanStories:
+    '''
+    Local stand-in for the American Stories hub repository, recording which years were fetched
+    '''
+    def __init__(self):
+        self.fetched = []
+
+    def __call__(self, year):
+        self.fetched.append(year)
+        return Dataset.from_dict({'article_id': [f'{year}_{i}' for i in range(3)],
+                                  'article': [f'An article from {year}, number {i}.' for i in range(3)],
+                                  'newspaper_name': ['The Daily Fake'] * 3})
+
+
+class TestIncrementalDownloadAmericanStories:
+
+    def test_downloads_years_as_parquet(self, tmp_path):
+        fetch_year = FakeAmericanStories()
+        dataset = download('american stories:1850-1852', save_folder = str(tmp_path), fetch_year = fetch_year)
+
+        assert sorted(fetch_year.fetched) == [1850, 1851, 1852]
+        assert list(dataset['article_id']) == [f'{year}_{i}' for year in range(1850, 1853) for i in range(3)]
+        assert sorted(os.listdir(tmp_path)) == ['checksums.json'] + [f'dataset_{year}.parquet' for year in range(1850, 1853)]
+
+    def test_returns_cached_and_new_years(self, tmp_path):
+        fetch_year = FakeAmericanStories()
+        download('american stories:1850,1851', save_folder = str(tmp_path), fetch_year = fetch_year)
+        dataset = download('american stories:1850-1852', save_folder = str(tmp_path), fetch_year = fetch_year,
+                           columns = ['article_id'])
+
+        assert fetch_year.fetched.count(1850) == 1 and fetch_year.fetched.count(1851) == 1
+        assert dataset.column_names == ['article_id']
+        assert len(dataset) == 9
+
+    def test_refetches_corrupted_years(self, tmp_path):
+        fetch_year = FakeAmericanStories()
+        download('american stories:1850', save_folder = str(tmp_path), fetch_year = fetch_year)
+        with open(tmp_path / 'dataset_1850.parquet', 'ab') as f:
+            f.write(b'garbage')
+
+        dataset = download('american stories:1850', save_folder = str(tmp_path), fetch_year = fetch_year)
+
+        assert fetch_year.fetched == [1850, 1850]
+        assert len(dataset) == 3
+
+    def test_converts_json_downloads(self, tmp_path):
+        FakeAmericanStories()(1850).to_json(str(tmp_path / 'dataset_1850.json'))
+        fetch_year = FakeAmericanStories()
+
+        dataset = download('american stories:1850', save_folder = str(tmp_path), fetch_year = fetch_year)
+
+        assert fetch_year.fetched == []
+        assert list(dataset['article_id']) == ['1850_0', '1850_1', '1850_2']
+
+
+class TestEmbeddingsDownloadAmericanStories:
+
+    def test_embeddings_are_stored_per_year(self, tmp_path, fake_embedding_models):
+        dataset = download('american stories:1850-1851:embeddings', save_folder = str(tmp_path),
+                           fetch_year = FakeAmericanStories())
+        embeddings = embedding_matrix(dataset)
+
+        assert embeddings.shape == (6, 4) and embeddings.dtype == np.float32
+        np.testing.assert_allclose(np.linalg.norm(embeddings, axis = 1), 1, atol = 1e-3)
+        assert {'embeddings_1850.parquet', 'embeddings_1851.parquet', 'embeddings_manifest.json'} <= set(os.listdir(tmp_path))
+
+        download('american stories:1850-1851:embeddings', save_folder = str(tmp_path), fetch_year = FakeAmericanStories())
+        assert sum(len(texts) for texts in fake_embedding_models.calls) == 6
+
+    def test_embeddings_with_other_columns(self, tmp_path, fake_embedding_models):
+        dataset = download('american stories:1850:embeddings', save_folder = str(tmp_path),
+                           fetch_year = FakeAmericanStories(), columns = ['article_id'])
+
+        assert dataset.column_names == ['article_id', 'masked_article', 'embedding']
+        assert len(dataset) == 3
+
+    def test_int8_embeddings(self, tmp_path, fake_embedding_models):
+        float16 = download('american stories:1850:embeddings', save_folder = str(tmp_path / 'float16'),
+                           fetch_year = FakeAmericanStories())
+        int8 = download('american stories:1850:embeddings', save_folder = str(tmp_path / 'int8'),
+                        fetch_year = FakeAmericanStories(), embeddings_options = {'dtype': 'int8'})
+
+        assert int8.features['embedding'].feature.dtype == 'int8'
+        np.testing.assert_allclose(embedding_matrix(int8), embedding_matrix(float16), atol = 0.01)
+
+    def test_copies_from_mirror(self, tmp_path, fake_embedding_models):
+        mirror = str(tmp_path / 'mirror')
+        expected = download('american stories:1850:embeddings', save_folder = mirror, fetch_year = FakeAmericanStories())
+
+        dataset = download('american stories:1850:embeddings', save_folder = str(tmp_path / 'local'),
+                           fetch_year = FakeAmericanStories(), embeddings_options = {'mirror': mirror})
+
+        assert sum(len(texts) for texts in fake_embedding_models.calls) == 3
+        np.testing.assert_array_equal(embedding_matrix(dataset), embedding_matrix(expected))
+        assert list(dataset['masked_article']) == list(expected['masked_article'])
+
+    def test_rejects_different_models(self, tmp_path, fake_embedding_models):
+        download('american stories:1850:embeddings', save_folder = str(tmp_path), fetch_year = FakeAmericanStories())
+
+        with pytest.raises(ValueError):
+            download('american stories:1850:embeddings', save_folder = str(tmp_path), fetch_year = FakeAmericanStories(),
+                     embeddings_options = {'sentence_model': 'another-model'})
@@ -1,4 +1,17 @@
-from newsdejavu import embed, find_nearest_neighbours
+import importlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+import torch
+
+from datasets import Dataset
+
+from newsdejavu import embed, embed_to_memmap, find_nearest_neighbours, EmbeddingCache
+from newsdejavu.embed.cache import embedding_cache_key, embedding_model_id
+
+registry = importlib.import_module('newsdejavu.utils.registry')
+embed_module = importlib.import_module('newsdejavu.embed.embed')
 
 
 class TestEmbed:
@@ -14,4 +27,182 @@ class TestEmbed:
             save_path=None
         )
 
-        assert embeddings.shape[0] == len(corpus_dict)
\ No newline at end of file
+        assert embeddings.shape[0] == len(corpus_dict)
+
+
+class FakeTokenizer:
+    special_tokens_map = {'mask_token': '[MASK]', 'sep_token': '[SEP]'}
+    name_or_path = 'model'
+
+    def __call__(self, texts, add_special_tokens = True):
+        return {'input_ids': [text.split() for text in texts]}
+
+
+class FakeSentenceTransformer:
+    """Embeds a text as simple character statistics and records every text it encodes."""
+    encoded = []
+
+    def __init__(self, model, device = None):
+        self.model = model
+
+    def get_sentence_embedding_dimension(self):
+        return 4
+
+    max_seq_length = 128
+
+    tokenizer = FakeTokenizer()
+
+    def encode(self, data, show_progress_bar = False, batch_size = 32):
+        FakeSentenceTransformer.encoded.extend(data)
+        return np.array([[len(text), text.count('a'), text.count('e'), 1.0] for text in data], dtype = np.float32)
+
+
+@pytest.fixture
+def fake_models(monkeypatch):
+    FakeSentenceTransformer.encoded = []
+    monkeypatch.setattr(registry.AutoTokenizer, 'from_pretrained', lambda *args, **kwargs: FakeTokenizer())
+    monkeypatch.setattr(registry, 'SentenceTransformer', FakeSentenceTransformer)
+    registry.release()
+    yield FakeSentenceTransformer
+    registry.release()
+
+
+class TestEmbeddingCache:
+
+    def test_key_normalises_whitespace(self):
+        assert embedding_cache_key('model', ' a  [MASK]\nb ') == embedding_cache_key('model', 'a [MASK] b')
+        assert embedding_cache_key('model', 'a [MASK] b') != embedding_cache_key('other-model', 'a [MASK] b')
+
+    def test_only_misses_are_encoded(self, tmp_path, fake_models):
+        cache_path = str(tmp_path / 'cache.sqlite')
+        corpus = ['a wire story', 'a wire story', 'another article']
+
+        first = embed(corpus, 'model', cache = cache_path)
+        assert fake_models.encoded == ['a wire story', 'another article']
+
+        second = embed(corpus + ['one more year'], 'model', cache = cache_path)
+        assert fake_models.encoded == ['a wire story', 'another article', 'one more year']
+        assert np.allclose(second[:3], first)
+        assert np.allclose(first, embed(corpus, 'model'))
+
+    def test_precisions_are_cached_apart(self, tmp_path, fake_models, monkeypatch):
+        # The fake model stands in for every dtype and backend
+        monkeypatch.setattr(embed_module, 'get_sentence_model', lambda model, *args: FakeSentenceTransformer(model))
+        cache_path = str(tmp_path / 'cache.sqlite')
+        corpus = ['a wire story', 'another article']
+
+        embed(corpus, 'model', cache = cache_path)
+        embed(corpus, 'model', cache = cache_path, torch_dtype = torch.float32)
+        embed(corpus, 'model', cache = cache_path, backend = 'onnx-int8')
+        embed(corpus, 'model', cache = cache_path, backend = 'onnx-int8')
+        embed(corpus, 'model', cache = cache_path, torch_dtype = torch.float16)
+
+        assert fake_models.encoded == corpus * 3
+        assert embedding_model_id('model') == embedding_model_id('model', torch.float32) == 'model'
+        assert embedding_model_id('model', torch.bfloat16) == 'model (torch.bfloat16)'
+
+    def test_lru_eviction(self, tmp_path):
+        cache = EmbeddingCache(str(tmp_path / 'cache.sqlite'), max_bytes = 3 * 16)
+        cache.put_many(['a', 'b', 'c'], np.ones((3, 4), dtype = np.float32))
+        cache.get_many(['a'])
+        cache.put_many(['d'], np.ones((1, 4), dtype = np.float32))
+
+        assert len(cache) == 3
+        assert set(cache.get_many(['a', 'b', 'c', 'd'])) == {'a', 'c', 'd'}
+        assert cache.total_bytes == 3 * 16
+
+    def test_shared_across_threads(self, tmp_path):
+        cache = EmbeddingCache(str(tmp_path / 'cache.sqlite'), max_bytes = 40 * 16)
+
+        def put(thread):
+            keys = [f'{thread}_{i}' for i in range(20)]
+            cache.put_many(keys, np.full((20, 4), thread, dtype = np.float32))
+            cache.get_many(keys)
+
+        with ThreadPoolExecutor(max_workers = 4) as executor:
+            list(executor.map(put, range(4)))
+
+        assert len(cache) == 40
+        assert cache.total_bytes == 40 * 16
+
+
+class TestEmbedToMemmap:
+
+    corpus = [f'article number {i} about [MASK] and a wire story' + ' e' * i for i in range(10)]
+
+    def test_matches_embed(self, tmp_path, fake_models):
+        output_path = str(tmp_path / 'out' / 'embeddings.npy')
+        embeddings = embed_to_memmap(iter(self.corpus), 'model', output_path, chunk_size = 3, num_rows = len(self.corpus))
+
+        assert isinstance(embeddings, np.memmap)
+        assert np.allclose(embeddings, embed(self.corpus, 'model'))
+
+    def test_dataset_input(self, tmp_path, fake_models):
+        dataset = Dataset.from_dict({'masked_sentence': self.corpus})
+        embeddings = embed_to_memmap(dataset, 'model', str(tmp_path / 'embeddings.npy'), chunk_size = 4)
+
+        assert np.allclose(embeddings, embed(self.corpus, 'model'))
+
+    def test_requires_num_rows_for_iterators(self, tmp_path, fake_models):
+        with pytest.raises(ValueError):
+            embed_to_memmap(iter(self.corpus), 'model', str(tmp_path / 'embeddings.npy'))
+
+    def test_rejects_corpus_longer_than_num_rows(self, tmp_path, fake_models):
+        output_path = str(tmp_path / 'embeddings.npy')
+        with pytest.raises(ValueError, match = 'more than num_rows'):
+            embed_to_memmap(iter(self.corpus), 'model', output_path, chunk_size = 3, num_rows = 8)
+        # The output is not marked complete, so the next call does not return it
+        with pytest.raises(ValueError, match = 'more than num_rows'):
+            embed_to_memmap(iter(self.corpus), 'model', output_path, chunk_size = 3, num_rows = 8)
+
+        assert np.allclose(np.load(output_path), embed(self.corpus[:8], 'model'))
+
+    def test_resumes_after_interruption(self, tmp_path, fake_models):
+        output_path = str(tmp_path / 'embeddings.npy')
+
+        def crashing_corpus():
+            yield from self.corpus[:6]
+            raise RuntimeError('worker died')
+
+        with pytest.raises(RuntimeError):
+            embed_to_memmap(crashing_corpus(), 'model', output_path, chunk_size = 3, num_rows = len(self.corpus))
+
+        fake_models.encoded = []
+        embeddings = embed_to_memmap(iter(self.corpus), 'model', output_path, chunk_size = 3, num_rows = len(self.corpus))
+
+        assert fake_models.encoded == self.corpus[6:]
+        assert np.allclose(embeddings, embed(self.corpus, 'model'))
+
+
+class TestModelRegistry:
+
+    def test_models_are_loaded_once(self, fake_models):
+        embed(['a wire story'], 'model')
+        sentence_model = registry.get_sentence_model('model')
+        embed(['another article'], 'model')
+
+        assert registry.get_sentence_model('model') is sentence_model
+        assert ('sentence', 'model', None, None, 'torch') in registry.registered_models()
+
+        registry.release('model')
+        assert registry.registered_models() == []
+
+    def test_accepts_loaded_model(self, fake_models):
+        sentence_model = FakeSentenceTransformer('model')
+        embeddings = embed(['a wire story', 'another article'], sentence_model)
+
+        assert embeddings.shape == (2, 4)
+        assert registry.registered_models() == []
+
+
+class TestLengthBucketing:
+
+    def test_matches_unbucketed(self, fake_models):
+        corpus = ['short', 'a much longer article ' * 20, 'medium length article here', 'tiny', 'another long one ' * 10]
+        expected = embed(corpus, 'model')
+        fake_models.encoded = []
+        embeddings = embed(corpus, 'model', max_batch_tokens = 64)
+
+        assert np.allclose(embeddings, expected)
+        # Texts are encoded shortest first
+        assert fake_models.encoded[:2] == ['short', 'tiny']
@@ -2,6 +2,7 @@
 
 
 import os
+import importlib
 import pytest
 import shutil
 import json
@@ -158,4 +159,164 @@ class TestQueryPipeline:
         assert len(results_dict) == len(sample_query_sentences)
 
         with open('data/test_data/query_results_1840.json', 'w') as f:
-            json.dump(results_dict, f, indent = 4, default=str)
\ No newline at end of file
+            json.dump(results_dict, f, indent = 4, default=str)
+
+
+class TestParallelNER:
+
+    def test_matches_single_process(self, sample_sentences, tiny_ner_model):
+        sentences = [f'{sentence} {"a " * i}' for i, sentence in enumerate(sample_sentences)]
+        expected = ner(sentences, tiny_ner_model, batch_size = 2, torch_device = 'cpu')
+        output = ner(sentences, tiny_ner_model, batch_size = 2, torch_device = 'cpu', num_workers = 2)
+
+        assert [[(e['word'], e['entity_group']) for e in o] for o in output] == \
+               [[(e['word'], e['entity_group']) for e in o] for o in expected]
+
+
+class TestLengthBucketedNER:
+
+    def test_matches_unbucketed(self, sample_sentences, tiny_ner_model):
+        sentences = [f'{sentence} {"a " * (7 * i % 5)}' for i, sentence in enumerate(sample_sentences)]
+        expected = ner(sentences, tiny_ner_model, batch_size = 2, torch_device = 'cpu')
+        output = ner(sentences, tiny_ner_model, torch_device = 'cpu', max_batch_tokens = 64)
+
+        assert [[(e['word'], e['entity_group']) for e in o] for o in output] == \
+               [[(e['word'], e['entity_group']) for e in o] for o in expected]
+
+    def test_budgets_truncated_lengths(self, sample_sentences, tiny_ner_model, monkeypatch):
+        ner_module = importlib.import_module('newsdejavu.ner.ner')
+        budgeted = []
+
+        def recording_batches(lengths, max_batch_tokens):
+            budgeted.extend(lengths)
+            return token_budget_batches(lengths, max_batch_tokens)
+
+        token_budget_batches = ner_module.token_budget_batches
+        monkeypatch.setattr(ner_module, 'token_budget_batches', recording_batches)
+        ner([sample_sentences[0] * 20], tiny_ner_model, max_length = 32, torch_device = 'cpu', max_batch_tokens = 64)
+
+        assert budgeted == [32]
+
+
+class TestSlidingWindowNER:
+
+    def test_merge_keeps_each_entity_once(self):
+        from newsdejavu.ner.windows import merge_window_outputs
+
+        # 'john doe' (characters 10-18) lies in the overlap of both windows
+        windows = [[(0, 20), (8, 30)]]
+        window_outputs = [
+            [{'entity_group': 'O', 'word': 'i am', 'start': 0, 'end': 4},
+             {'entity_group': 'PER', 'word': 'john doe', 'start': 10, 'end': 18}],
+            [{'entity_group': 'PER', 'word': 'john doe', 'start': 2, 'end': 10},
+             {'entity_group': 'LOC', 'word': 'new york', 'start': 14, 'end': 22}],
+        ]
+
+        output = merge_window_outputs(window_outputs, windows, ['i am      john doe    new york'])
+
+        assert [(e['word'], e['start'], e['end']) for e in output[0]] == \
+               [('i am', 0, 4), ('john doe', 10, 18), ('new york', 22, 30)]
+
+    def test_merge_trims_groups_crossing_the_boundary(self):
+        from newsdejavu.ner.windows import merge_window_outputs
+
+        article = 'i am john doe and i live in new york, i work at google'
+        windows = [[(0, 20), (10, 40)]]
+        window_outputs = [
+            [{'entity_group': 'O', 'word': article[0:20], 'start': 0, 'end': 20}],
+            [{'entity_group': 'O', 'word': article[10:35], 'start': 0, 'end': 25},
+             {'entity_group': 'PER', 'word': article[35:40], 'start': 25, 'end': 30}],
+        ]
+
+        output = merge_window_outputs(window_outputs, windows, [article])
+
+        assert [(e['entity_group'], e['start'], e['end']) for e in output[0]] == \
+               [('O', 0, 20), ('O', 20, 35), ('PER', 35, 40)]
+        assert output[0][1]['word'] == article[20:35]
+
+    def test_long_article_is_not_truncated(self, tiny_ner_model):
+        # Only words in the tiny model's vocabulary, so every entity word can be found in the article
+        article = ' '.join(['i am john doe and i live in new york, i work at google.'] * 10)
+        output = ner([article], tiny_ner_model, max_length = 16, stride = 4, torch_device = 'cpu')[0]
+
+        assert output[-1]['end'] == len(article)
+        starts = [e['start'] for e in output]
+        assert starts == sorted(starts)
+        assert all(e["word"].replace(' ', '') == article[e['start']:e['end']].lower().replace(' ', '') for e in output)
+
+        # Every non-space character of the article is in exactly one group
+        covered = [0] * len(article)
+        for e in output:
+            for i in range(e['start'], e['end']):
+                covered[i] += 1
+        assert all(covered[i] == 1 for i, character in enumerate(article) if not character.isspace())
+
+    def test_short_articles_match_unwindowed(self, sample_sentences, tiny_ner_model):
+        expected = ner(sample_sentences, tiny_ner_model, batch_size = 2, torch_device = 'cpu')
+        output = ner(sample_sentences, tiny_ner_model, batch_size = 2, torch_device = 'cpu', stride = 32)
+
+        assert output == expected
+
+    def test_rejects_stride_larger_than_window(self, tiny_ner_model):
+        with pytest.raises(ValueError):
+            ner(['i am john doe'], tiny_ner_model, max_length = 16, stride = 14, torch_device = 'cpu')
+
+
+class TestOCRCleaningNER:
+
+    def test_matches_cleaning_up_front(self, sample_sentences, tiny_ner_model, monkeypatch):
+        from newsdejavu.utils import clean_ocr_texts
+
+        ner_module = importlib.import_module('newsdejavu.ner.ner')
+        monkeypatch.setattr(ner_module, 'OCR_CLEANING_SHARD_SIZE', 3)
+        sentences = [sentence.replace(' ', '\n', i) + ' #' for i, sentence in enumerate(sample_sentences)]
+
+        cleaned, _ = clean_ocr_texts(sentences, True, [], with_offsets = False)
+        expected = ner(cleaned, tiny_ner_model, batch_size = 2, torch_device = 'cpu')
+        output = ner(sentences, tiny_ner_model, batch_size = 2, torch_device = 'cpu', preprocess_for_ocr_errors = True)
+
+        assert output == expected
+
+
+class TestOffsetMasking:
+
+    text = 'John  Doe lives in\nNew York, and works at Google.'
+    entities = [{'entity_group': 'PER', 'word': 'john doe', 'start': 0, 'end': 9},
+                {'entity_group': 'O', 'word': 'lives in', 'start': 10, 'end': 18},
+                {'entity_group': 'ORG', 'word': 'google', 'start': 42, 'end': 48},
+                {'entity_group': 'LOC', 'word': 'new york', 'start': 19, 'end': 27}]
+
+    def test_keeps_original_text_around_masks(self):
+        assert mask([self.entities], texts = [self.text]) == ['[MASK] lives in\n[MASK], and works at [MASK].']
+        assert mask([self.entities], ['LOC'], all_masks_same = False, texts = [self.text]) == \
+               ['John  Doe lives in\nLOC, and works at Google.']
+
+    def test_offsets_map_back_to_source(self):
+        (masked_text,), (offsets,) = mask([self.entities], texts = [self.text], return_offsets = True)
+
+        assert len(offsets) == len(masked_text)
+        assert all(masked_text[i] == self.text[offsets[i]] for i in range(len(masked_text)) if masked_text[i] not in '[MASK]')
+        assert offsets[masked_text.index('lives')] == self.text.index('lives')
+        assert offsets[masked_text.rindex('[MASK]')] == self.text.index('Google')
+
+    def test_mask_dataset(self):
+        from newsdejavu.ner.masking import mask_dataset
+
+        dataset = Dataset.from_dict({'article': [self.text, 'No entities here.'], 'ner': [self.entities, []]})
+        masked = mask_dataset(dataset, with_offsets = True)
+
+        assert masked['masked_article'] == mask([self.entities, []], texts = dataset['article'])
+        assert masked['masked_article_offsets'][1] == list(range(len('No entities here.')))
+
+    def test_ner_and_mask_with_offsets(self, sample_sentences, tiny_ner_model):
+        sentences = [sentence.replace('. ', '.\n\n') for sentence in sample_sentences[:2]]
+        ner_output = ner(sentences, tiny_ner_model, batch_size = 2, torch_device = 'cpu')
+        masked = ner_and_mask(sentences, tiny_ner_model, batch_size = 2, torch_device = 'cpu', use_offsets = True)
+
+        assert masked == mask(ner_output, texts = sentences)
+        # Paragraph breaks outside the masked entities are kept
+        for sentence, entities, masked_text in zip(sentences, ner_output, masked):
+            masked_spans = [(e['start'], e['end']) for e in entities if e['entity_group'] != 'O']
+            kept_breaks = [i for i in range(len(sentence)) if sentence.startswith('\n\n', i)
+                           and not any(start <= i + 1 and i < end for start, end in masked_spans)]
+            assert masked_text.count('\n\n') >= len(kept_breaks)
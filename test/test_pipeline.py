@@ -0,0 +1,165 @@
+'''
+Unit tests for the resumable corpus pipeline. NER and embedding are replaced with cheap deterministic functions so that
+only the sharding, checkpointing and resuming logic is exercised.
+'''
+
+import time
+import threading
+import importlib
+
+import numpy as np
+import pytest
+from datasets import Dataset
+
+from newsdejavu import run_pipeline, stream_ner_mask_embed
+from newsdejavu.utils.clean_text import clean_text
+
+runner = importlib.import_module('newsdejavu.pipeline.runner')
+streaming = importlib.import_module('newsdejavu.pipeline.streaming')
+
+
+articles = [f'Article {i} reports that Senator Smith visited Boston' + ' again' * i for i in range(7)]
+
+
+@pytest.fixture
+def model_calls(monkeypatch, fake_embed):
+    calls = {'ner': [], 'embed': fake_embed.install(runner).calls, 'crash_on_shard': None}
+
+    def fake_ner(dataset, model_path, batch_size = 1, **kwargs):
+        shard_articles = dataset['article']
+        if calls['crash_on_shard'] is not None and articles.index(shard_articles[0]) // 3 == calls['crash_on_shard']:
+            raise RuntimeError('worker died')
+        calls['ner'].append(shard_articles)
+        return [[{'entity_group': 'PER' if word == 'Smith' else 'O', 'word': word, 'score': np.float32(0.9)}
+                 for word in article.split()] for article in shard_articles]
+
+    monkeypatch.setattr(runner, 'ner', fake_ner)
+    return calls
+
+
+class TestRunPipeline:
+
+    def test_builds_index(self, tmp_path, model_calls):
+        dataset = Dataset.from_dict({'article': articles, 'article_id': [f'id_{i}' for i in range(7)]})
+        corpus_index = run_pipeline(dataset, 'ner', 'sbert', str(tmp_path), shard_size = 3, id_column = 'article_id')
+
+        assert len(corpus_index) == 7
+        assert corpus_index.id_map[6] == 'id_6'
+        assert len(model_calls['ner']) == 3
+        assert (tmp_path / 'masked_00002.json').read_text().startswith('["Article 6 reports that Senator [MASK] visited')
+
+        # A finished run is loaded from disk
+        model_calls['ner'] = []
+        assert len(run_pipeline(dataset, 'ner', 'sbert', str(tmp_path), shard_size = 3)) == 7
+        assert model_calls['ner'] == []
+
+    def test_resumes_after_crash(self, tmp_path, model_calls):
+        model_calls['crash_on_shard'] = 1
+        with pytest.raises(RuntimeError):
+            run_pipeline(articles, 'ner', 'sbert', str(tmp_path), shard_size = 3)
+
+        model_calls['crash_on_shard'] = None
+        model_calls['ner'] = []
+        corpus_index = run_pipeline(articles, 'ner', 'sbert', str(tmp_path), shard_size = 3)
+
+        assert model_calls['ner'] == [articles[3:6], articles[6:]]
+        assert len(model_calls['embed']) == 3
+        assert len(corpus_index) == 7
+
+    def test_rebuilds_index_for_different_index_settings(self, tmp_path, model_calls):
+        dataset = Dataset.from_dict({'article': articles, 'article_id': [f'id_{i}' for i in range(7)]})
+        run_pipeline(dataset, 'ner', 'sbert', str(tmp_path), shard_size = 3)
+
+        model_calls['ner'] = []
+        corpus_index = run_pipeline(dataset, 'ner', 'sbert', str(tmp_path), shard_size = 3, id_column = 'article_id',
+                                    index_type = 'hnsw', hnsw_m = 8)
+
+        # The shards are reused, and only the index is rebuilt
+        assert model_calls['ner'] == []
+        assert corpus_index.id_map[6] == 'id_6'
+        assert corpus_index.lookup(corpus_index.search(corpus_index.embeddings()[6:7], k = 1)[1]) == [['id_6']]
+        assert run_pipeline(dataset, 'ner', 'sbert', str(tmp_path), shard_size = 3).id_map is None
+
+    def test_rejects_empty_corpus(self, tmp_path, model_calls):
+        with pytest.raises(ValueError, match = 'no articles'):
+            run_pipeline([], 'ner', 'sbert', str(tmp_path))
+
+    def test_rejects_different_settings(self, tmp_path, model_calls):
+        run_pipeline(articles, 'ner', 'sbert', str(tmp_path), shard_size = 3)
+
+        with pytest.raises(ValueError):
+            run_pipeline(articles, 'ner', 'sbert', str(tmp_path), shard_size = 4)
+
+
+def wait_until(condition, timeout: float) -> bool:
+    """Polls condition until it holds or timeout seconds have passed, and returns whether it held."""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class TestStreamNerMaskEmbed:
+
+    @pytest.fixture
+    def stage_calls(self, monkeypatch, fake_embed):
+        fake_embed.install(streaming)
+        calls = {'ner': 0, 'embed': fake_embed.calls}
+
+        def fake_ner(dataset, model_path, batch_size = 1, **kwargs):
+            calls['ner'] += 1
+            return [[{'entity_group': 'PER' if word == 'Smith' else 'O', 'word': word,
+                      'start': article.index(word), 'end': article.index(word) + len(word)}
+                     for word in article.split()] for article in dataset['article']]
+
+        monkeypatch.setattr(streaming, 'ner', fake_ner)
+        return calls
+
+    def test_yields_records_in_order(self, stage_calls):
+        dataset = Dataset.from_dict({'article': articles, 'article_id': [f'id_{i}' for i in range(7)]})
+        records = list(stream_ner_mask_embed(dataset, 'ner', 'sbert', chunk_size = 3, id_column = 'article_id'))
+
+        assert [article_id for article_id, _, _ in records] == [f'id_{i}' for i in range(7)]
+        assert records[2][1] == 'Article 2 reports that Senator [MASK] visited Boston again again'
+        assert stage_calls['ner'] == 3
+        assert len(stage_calls['embed']) == 3
+        assert np.allclose(records[2][2], streaming.embed([records[2][1]], 'sbert')[0])
+
+    def test_offsets_keep_spacing(self, stage_calls):
+        records = list(stream_ner_mask_embed(['Senator  Smith\n\nvisited'], 'ner', 'sbert', use_offsets = True))
+
+        assert records == [(0, 'Senator  [MASK]\n\nvisited', records[0][2])]
+
+    def test_offsets_after_ocr_cleaning(self, monkeypatch, stage_calls):
+        def cleaning_ner(dataset, model_path, batch_size = 1, preprocess_for_ocr_errors = False, **kwargs):
+            # Like ner(), finds the entities (and their offsets) in the cleaned articles
+            articles = [clean_text(article, True, []) if preprocess_for_ocr_errors else article
+                        for article in dataset['article']]
+            return [[{'entity_group': 'PER' if word == 'Smith' else 'O', 'word': word,
+                      'start': article.index(word), 'end': article.index(word) + len(word)}
+                     for word in article.split()] for article in articles]
+
+        monkeypatch.setattr(streaming, 'ner', cleaning_ner)
+        records = list(stream_ner_mask_embed(['Sena-\ntor John\nSmith visited'], 'ner', 'sbert', use_offsets = True,
+                                             preprocess_for_ocr_errors = True))
+
+        assert records[0][1] == 'Senator John [MASK] visited'
+
+    def test_stages_stay_bounded(self, stage_calls):
+        dataset = Dataset.from_dict({'article': articles * 10})
+        threads_before = threading.active_count()
+        queue_size = 1
+        records = stream_ner_mask_embed(dataset, 'ner', 'sbert', chunk_size = 2, queue_size = queue_size)
+        next(records)
+
+        # The chunk being yielded, one chunk held by each of the embedding and NER stages and the chunks in their
+        # output queues. The stages get time to run ahead, but the bound holds at any moment.
+        bound = 2 * queue_size + 3
+        wait_until(lambda: stage_calls['ner'] > bound, timeout = 1)
+        assert stage_calls['ner'] <= bound
+
+        # Closing the stream stops every stage
+        records.close()
+        assert wait_until(lambda: threading.active_count() == threads_before, timeout = 10)
@@ -0,0 +1,456 @@
+'''
+Unit tests for nearest neighbour search and corpus indexes.
+'''
+
+import os
+
+import faiss
+import numpy as np
+import pandas as pd
+import pytest
+
+from newsdejavu import find_nearest_neighbours, CorpusIndex, ShardedCorpusIndex, IncrementalCorpusIndex
+from newsdejavu.query import index as index_module
+from newsdejavu.query.filters import filter_mask
+from newsdejavu.query.factory import build_faiss_index, index_bytes
+from newsdejavu.query.sharded import merge_top_k
+from newsdejavu.query.benchmark import recall_benchmark, recall_at_k
+
+
+def normalised(array):
+    return (array / np.linalg.norm(array, axis = 1, keepdims = True)).astype(np.float32)
+
+
+@pytest.fixture
+def corpus_embeddings():
+    return normalised(np.random.default_rng(0).standard_normal((500, 32)))
+
+
+@pytest.fixture
+def query_embeddings(corpus_embeddings):
+    noise = np.random.default_rng(1).standard_normal((10, 32)) * 0.01
+    return normalised(corpus_embeddings[:10] + noise)
+
+
+class TestCorpusIndex:
+
+    def test_search_matches_find_nearest_neighbours(self, corpus_embeddings, query_embeddings):
+        corpus_index = CorpusIndex.build(corpus_embeddings)
+        dist_list, nn_list = corpus_index.search(query_embeddings, k = 3)
+        expected_dist, expected_nn = find_nearest_neighbours(query_embeddings, corpus_embeddings, k = 3)
+
+        assert np.array_equal(nn_list, expected_nn)
+        assert np.allclose(dist_list, expected_dist)
+        assert list(nn_list[:, 0]) == list(range(10))
+
+    def test_find_nearest_neighbours_accepts_index(self, corpus_embeddings, query_embeddings):
+        corpus_index = CorpusIndex.build(corpus_embeddings)
+        _, nn_list = find_nearest_neighbours(query_embeddings, corpus_index, k = 1)
+
+        assert list(nn_list[:, 0]) == list(range(10))
+
+    def test_save_and_load(self, tmp_path, corpus_embeddings, query_embeddings):
+        id_map = {i: f'article_{i}' for i in range(len(corpus_embeddings))}
+        CorpusIndex.build(corpus_embeddings, id_map = id_map).save(str(tmp_path / 'index'))
+
+        corpus_index = CorpusIndex.load(str(tmp_path / 'index'))
+        assert len(corpus_index) == len(corpus_embeddings)
+        assert corpus_index.dim == 32
+        assert corpus_index.id_map == id_map
+
+        _, nn_list = corpus_index.search(query_embeddings, k = 1)
+        assert corpus_index.lookup(nn_list)[0] == ['article_0']
+
+    @pytest.mark.skipif(not hasattr(faiss, 'IO_FLAG_MMAP_IFC'), reason = 'faiss cannot memory-map flat indexes')
+    @pytest.mark.parametrize('mmap', [True, False])
+    def test_load_memory_maps_flat_index(self, tmp_path, corpus_embeddings, query_embeddings, mmap):
+        CorpusIndex.build(corpus_embeddings).save(str(tmp_path / 'index'))
+
+        corpus_index = CorpusIndex.load(str(tmp_path / 'index'), mmap = mmap)
+        assert isinstance(corpus_index.index, faiss.IndexFlatIP)
+        # Memory-mapped codes are a view of the file rather than a vector owned by the index
+        assert corpus_index.index.codes.is_owned != mmap
+
+        _, nn_list = corpus_index.search(query_embeddings, k = 1)
+        assert list(nn_list[:, 0]) == list(range(10))
+
+    def test_lookup_without_id_map(self, corpus_embeddings, query_embeddings):
+        corpus_index = CorpusIndex.build(corpus_embeddings[:2])
+        _, nn_list = corpus_index.search(query_embeddings[:1], k = 5)
+
+        assert corpus_index.lookup(nn_list) == [[0, 1]]
+
+
+class TestApproximateIndexes:
+
+    @pytest.mark.parametrize('index_type, index_kwargs, search_kwargs', [
+        ('ivf_flat', {'nlist': 8}, {'nprobe': 8}),
+        ('ivf_pq', {'nlist': 4, 'pq_m': 8, 'pq_nbits': 6}, {'nprobe': 4}),
+        ('hnsw', {'hnsw_m': 16}, {'ef_search': 64}),
+    ])
+    def test_finds_near_duplicates(self, corpus_embeddings, query_embeddings, index_type, index_kwargs, search_kwargs):
+        dist_list, nn_list = find_nearest_neighbours(query_embeddings, corpus_embeddings, k = 1,
+                                                     index_type = index_type, **index_kwargs, **search_kwargs)
+
+        assert nn_list.shape == (10, 1)
+        assert list(nn_list[:, 0]) == list(range(10))
+
+    def test_ivf_trains_on_sample(self, corpus_embeddings):
+        index = build_faiss_index(corpus_embeddings, 'ivf_flat', nlist = 4, train_size = 100)
+
+        assert index.is_trained
+        assert index.ntotal == len(corpus_embeddings)
+
+    def test_unrecognized_index_type(self, corpus_embeddings):
+        with pytest.raises(ValueError):
+            build_faiss_index(corpus_embeddings, 'gobbledegook')
+
+    def test_saved_approximate_index_keeps_search_knobs(self, tmp_path, corpus_embeddings, query_embeddings):
+        CorpusIndex.build(corpus_embeddings, index_type = 'ivf_flat', nlist = 8).save(str(tmp_path / 'index'))
+        corpus_index = CorpusIndex.load(str(tmp_path / 'index'))
+        _, nn_list = corpus_index.search(query_embeddings, k = 1, nprobe = 8)
+
+        assert list(nn_list[:, 0]) == list(range(10))
+
+
+    @pytest.mark.parametrize('index_type, index_kwargs, search_kwargs', [
+        ('ivf_flat', {'nlist': 8}, {'nprobe': 8}),
+        ('ivf_pq', {'nlist': 4, 'pq_m': 8, 'pq_nbits': 6}, {'nprobe': 4}),
+        ('hnsw', {'hnsw_m': 16}, {'ef_search': 64}),
+    ])
+    def test_memory_mapped_round_trip(self, tmp_path, corpus_embeddings, query_embeddings, index_type, index_kwargs,
+                                      search_kwargs):
+        built = CorpusIndex.build(corpus_embeddings, index_type = index_type, **index_kwargs)
+        built.save(str(tmp_path / 'index'))
+
+        corpus_index = CorpusIndex.load(str(tmp_path / 'index'), mmap = True)
+        assert len(corpus_index) == len(corpus_embeddings)
+        assert np.array_equal(corpus_index.search(query_embeddings, k = 5, **search_kwargs)[1],
+                              built.search(query_embeddings, k = 5, **search_kwargs)[1])
+
+
+class TestCompactIndexes:
+
+    @pytest.mark.parametrize('index_type, index_kwargs', [
+        ('sq_fp16', {}),
+        ('sq8', {}),
+        ('sq8', {'rescore': True}),
+        ('binary', {}),
+    ])
+    def test_matches_exact_search(self, corpus_embeddings, query_embeddings, index_type, index_kwargs):
+        expected_dist, expected_nn = CorpusIndex.build(corpus_embeddings).search(query_embeddings, k = 5)
+        corpus_index = CorpusIndex.build(corpus_embeddings, index_type = index_type, **index_kwargs)
+        dist_list, nn_list = corpus_index.search(query_embeddings, k = 5, rescore_factor = 40)
+
+        assert list(nn_list[:, 0]) == list(range(10))
+        assert recall_at_k(expected_nn, nn_list) >= 0.9
+        if corpus_index.rescore_embeddings is not None:
+            assert np.allclose(dist_list[nn_list == expected_nn], expected_dist[nn_list == expected_nn], atol = 1e-6)
+
+    def test_compact_indexes_are_smaller(self, corpus_embeddings):
+        sizes = {index_type: index_bytes(CorpusIndex.build(corpus_embeddings, index_type = index_type).index)
+                 for index_type in ['flat', 'sq_fp16', 'sq8', 'binary']}
+
+        assert sizes['flat'] > 1.9 * sizes['sq_fp16'] > 1.9 * sizes['sq8'] > 1.9 * 3.5 * sizes['binary']
+
+    def test_save_and_load_binary_index(self, tmp_path, corpus_embeddings, query_embeddings):
+        CorpusIndex.build(corpus_embeddings, index_type = 'binary').save(str(tmp_path / 'index'))
+        corpus_index = CorpusIndex.load(str(tmp_path / 'index'))
+
+        assert isinstance(corpus_index.rescore_embeddings, np.memmap)
+        dist_list, nn_list = corpus_index.search(query_embeddings, k = 1, rescore_factor = 40)
+        assert list(nn_list[:, 0]) == list(range(10))
+        assert np.all(dist_list > 0.9)
+
+    def test_pads_missing_results(self, corpus_embeddings, query_embeddings):
+        corpus_index = CorpusIndex.build(corpus_embeddings[:3], index_type = 'binary')
+        _, nn_list = corpus_index.search(query_embeddings[:1], k = 5)
+
+        assert sorted(nn_list[0, :3]) == [0, 1, 2]
+        assert list(nn_list[0, 3:]) == [-1, -1]
+
+
+class TestRecallBenchmark:
+
+    def test_recall_at_k(self):
+        exact_nn = np.array([[0, 1], [2, 3]])
+        approx_nn = np.array([[1, 5], [2, 3]])
+
+        assert recall_at_k(exact_nn, approx_nn) == 0.75
+
+        # Padding is not counted as a match, and only the neighbours found by exact search count
+        assert recall_at_k(np.array([[0, -1], [2, 3]]), np.array([[1, -1], [2, -1]])) == 1 / 3
+        assert recall_at_k(np.array([[-1, -1]]), np.array([[-1, -1]])) == 1.0
+
+    def test_benchmark(self, corpus_embeddings, query_embeddings):
+        results = recall_benchmark(query_embeddings, corpus_embeddings, k = 5,
+                                   configs = [{'index_type': 'ivf_flat', 'nlist': 8, 'nprobe': 8},
+                                              {'index_type': 'hnsw', 'ef_search': 32}])
+
+        assert [row['index_type'] for row in results] == ['flat', 'ivf_flat', 'hnsw']
+        assert results[0]['recall'] == 1.0
+        assert results[1]['recall'] == 1.0
+        assert all(row['search_ms_per_query'] >= 0 for row in results)
+        assert all(row['index_bytes'] > 0 for row in results)
+
+
+@pytest.fixture
+def corpus_metadata(corpus_embeddings):
+    years = np.arange(len(corpus_embeddings)) % 10 + 1860
+    return {'date': [f'{year}-01-{day % 28 + 1:02d}' for day, year in enumerate(years)],
+            'newspaper_name': ['The Sun' if i % 3 == 0 else 'The Globe' for i in range(len(corpus_embeddings))]}
+
+
+def brute_force_subset(query_embeddings, corpus_embeddings, allowed, k):
+    rows = np.flatnonzero(allowed)
+    scores = query_embeddings @ corpus_embeddings[rows].T
+    return rows[np.argsort(-scores, axis = 1)[:, :k]]
+
+
+class TestFilteredSearch:
+
+    @pytest.mark.parametrize('filters, expected', [
+        ({'newspaper_name': 'The Sun'}, lambda meta: meta['newspaper_name'] == 'The Sun'),
+        ({'newspaper_name': ['The Globe']}, lambda meta: meta['newspaper_name'] == 'The Globe'),
+        ({'date': ('1861', '1862')}, lambda meta: meta['date'].str[:4].isin(['1861', '1862'])),
+        ({'date': ('1861', None), 'newspaper_name': 'The Sun'},
+         lambda meta: (meta['date'] >= '1861') & (meta['newspaper_name'] == 'The Sun')),
+    ])
+    def test_matches_brute_force_over_subset(self, corpus_embeddings, query_embeddings, corpus_metadata, filters,
+                                             expected):
+        allowed = expected(pd.DataFrame(corpus_metadata)).to_numpy()
+        corpus_index = CorpusIndex.build(corpus_embeddings, metadata = corpus_metadata)
+        _, nn_list = corpus_index.search(query_embeddings, k = 5, filters = filters)
+
+        assert np.all(allowed[nn_list])
+        assert np.array_equal(nn_list, brute_force_subset(query_embeddings, corpus_embeddings, allowed, 5))
+
+    def test_pre_and_post_filtering_agree(self, monkeypatch, corpus_embeddings, query_embeddings, corpus_metadata):
+        corpus_index = CorpusIndex.build(corpus_embeddings, metadata = corpus_metadata)
+        filters = {'newspaper_name': 'The Globe'}
+        post_dist, post_nn = corpus_index.search(query_embeddings, k = 5, filters = filters)
+
+        monkeypatch.setattr(index_module, 'POST_FILTER_MIN_FRACTION', 1.1)
+        pre_dist, pre_nn = corpus_index.search(query_embeddings, k = 5, filters = filters)
+
+        assert np.array_equal(pre_nn, post_nn)
+        assert np.allclose(pre_dist, post_dist)
+
+    @pytest.mark.parametrize('index_type, index_kwargs, search_kwargs', [
+        ('ivf_flat', {'nlist': 8}, {'nprobe': 8}),
+        ('hnsw', {}, {'ef_search': 128}),
+        ('sq8', {}, {}),
+        ('binary', {}, {'rescore_factor': 40}),
+    ])
+    def test_approximate_indexes(self, corpus_embeddings, query_embeddings, corpus_metadata, index_type, index_kwargs,
+                                 search_kwargs):
+        allowed = np.array(corpus_metadata['date']) < '1861'
+        corpus_index = CorpusIndex.build(corpus_embeddings, index_type = index_type, metadata = corpus_metadata,
+                                         **index_kwargs)
+        _, nn_list = corpus_index.search(query_embeddings, k = 3, filters = {'date': (None, '1860')},
+                                         **search_kwargs)
+
+        assert np.all(allowed[nn_list[nn_list >= 0]])
+        # The first query is row 0, which is from 1860
+        assert nn_list[0, 0] == 0
+
+    def test_ranges_skip_missing_values(self):
+        dates = ['1860-01-01', None, '1865-03-01', np.nan, '1866-01-01']
+        metadata = pd.DataFrame({'date': pd.Series(dates, dtype = object),
+                                 'nullable_date': pd.Series(dates, dtype = 'string'),
+                                 'page': pd.Series([1, None, 3, 4, 5], dtype = 'Int64')})
+
+        for column in ['date', 'nullable_date']:
+            assert list(filter_mask(metadata, {column: ('1860', '1865')})) == [True, False, True, False, False]
+        assert list(filter_mask(metadata, {'page': (2, None)})) == [False, False, True, True, True]
+
+    def test_string_bounds_on_other_columns(self):
+        metadata = pd.DataFrame({'date': pd.to_datetime(['1860-01-01', '1864-06-01', '1866-01-01'])})
+
+        # Only string columns also match the values a high bound prefixes
+        assert list(filter_mask(metadata, {'date': ('1860', '1865')})) == [True, True, False]
+
+    def test_no_matching_rows(self, corpus_embeddings, query_embeddings, corpus_metadata):
+        corpus_index = CorpusIndex.build(corpus_embeddings, metadata = corpus_metadata)
+        _, nn_list = corpus_index.search(query_embeddings, k = 2, filters = {'newspaper_name': 'The Times'})
+
+        assert np.all(nn_list == -1)
+
+    def test_save_and_load_metadata(self, tmp_path, corpus_embeddings, query_embeddings, corpus_metadata):
+        CorpusIndex.build(corpus_embeddings, metadata = corpus_metadata).save(str(tmp_path / 'index'))
+        corpus_index = CorpusIndex.load(str(tmp_path / 'index'))
+
+        assert list(corpus_index.metadata.columns) == ['date', 'newspaper_name']
+        dist_list, nn_list = find_nearest_neighbours(query_embeddings, corpus_index, k = 1,
+                                                     filters = {'newspaper_name': 'The Sun'})
+        assert all(corpus_metadata['newspaper_name'][nn] == 'The Sun' for nn in nn_list[:, 0])
+
+    def test_errors(self, corpus_embeddings, query_embeddings, corpus_metadata):
+        with pytest.raises(ValueError):
+            CorpusIndex.build(corpus_embeddings).search(query_embeddings, filters = {'date': '1860'})
+        with pytest.raises(ValueError):
+            CorpusIndex.build(corpus_embeddings, metadata = corpus_metadata).search(query_embeddings,
+                                                                                    filters = {'page': 1})
+        with pytest.raises(ValueError):
+            CorpusIndex.build(corpus_embeddings, metadata = {'date': ['1860']})
+
+
+@pytest.fixture
+def year_shards(corpus_embeddings):
+    return {year: corpus_embeddings[i * 100:(i + 1) * 100] for i, year in enumerate(range(1850, 1855))}
+
+
+class TestShardedCorpusIndex:
+
+    @pytest.mark.parametrize('num_workers', [1, 4])
+    def test_matches_single_index(self, corpus_embeddings, query_embeddings, year_shards, num_workers):
+        expected_dist, expected_nn = CorpusIndex.build(corpus_embeddings).search(query_embeddings, k = 5)
+        sharded_index = ShardedCorpusIndex.build(year_shards, num_workers = num_workers)
+        dist_list, nn_list = sharded_index.search(query_embeddings, k = 5)
+
+        assert len(sharded_index) == len(corpus_embeddings)
+        assert np.array_equal(nn_list, expected_nn)
+        assert np.allclose(dist_list, expected_dist)
+
+    def test_merge_top_k_pads(self):
+        dist_list, nn_list = merge_top_k([(np.array([[0.5, 0.1]]), np.array([[3, -1]])),
+                                          (np.array([[0.9]]), np.array([[7]]))], k = 4)
+
+        assert list(nn_list[0]) == [7, 3, -1, -1]
+        assert list(dist_list[0, :2]) == [0.9, 0.5]
+
+    def test_search_selected_shards(self, query_embeddings, year_shards):
+        sharded_index = ShardedCorpusIndex.build(year_shards)
+        _, nn_list = sharded_index.search(query_embeddings, k = 3, shards = [1852, '1853'])
+
+        assert np.all((nn_list >= 200) & (nn_list < 400))
+        with pytest.raises(ValueError):
+            sharded_index.search(query_embeddings, shards = [1900])
+
+    def test_id_map_and_lookup(self, query_embeddings, year_shards):
+        id_maps = {year: {i: f'{year}-{i}' for i in range(100)} for year in year_shards}
+        sharded_index = ShardedCorpusIndex.build(year_shards, id_maps = id_maps)
+        _, nn_list = sharded_index.search(query_embeddings, k = 1)
+
+        assert sharded_index.lookup(nn_list[:2]) == [['1850-0'], ['1850-1']]
+        assert sharded_index.id_map[250] == '1852-50'
+        assert ShardedCorpusIndex.build(year_shards).id_map is None
+
+    def test_save_and_load_lazily(self, tmp_path, corpus_embeddings, query_embeddings, year_shards):
+        path = str(tmp_path / 'index')
+        ShardedCorpusIndex.build(year_shards, index_type = 'sq8').save(path)
+        sharded_index = ShardedCorpusIndex.load(path)
+
+        assert len(sharded_index) == 500
+        assert not any(shard.loaded for shard in sharded_index.shards)
+        _, nn_list = sharded_index.search(query_embeddings, k = 1, shards = ['1850'])
+        assert list(nn_list[:, 0]) == list(range(10))
+        assert [shard.loaded for shard in sharded_index.shards] == [True, False, False, False, False]
+
+    def test_add_shard(self, tmp_path, corpus_embeddings, query_embeddings, year_shards):
+        path = str(tmp_path / 'index')
+        ShardedCorpusIndex.build(year_shards).save(path)
+        sharded_index = ShardedCorpusIndex.load(path)
+        new_shard = CorpusIndex.build(query_embeddings[:3])
+        sharded_index.add_shard(1855, new_shard)
+        sharded_index.save(path)
+
+        sharded_index = ShardedCorpusIndex.load(path)
+        assert sharded_index.shard_names == ['1850', '1851', '1852', '1853', '1854', '1855']
+        dist_list, nn_list = find_nearest_neighbours(query_embeddings[:3], sharded_index, k = 1)
+        assert list(nn_list[:, 0]) == [500, 501, 502]
+        with pytest.raises(ValueError):
+            sharded_index.add_shard('1855', new_shard)
+
+    def test_filters_apply_to_every_shard(self, corpus_embeddings, query_embeddings, year_shards, corpus_metadata):
+        metadata = {year: pd.DataFrame(corpus_metadata)[i * 100:(i + 1) * 100] for i, year in enumerate(year_shards)}
+        sharded_index = ShardedCorpusIndex.build(year_shards, metadata = metadata)
+        _, nn_list = sharded_index.search(query_embeddings, k = 5, filters = {'newspaper_name': 'The Sun'})
+
+        allowed = np.array(corpus_metadata['newspaper_name']) == 'The Sun'
+        assert np.array_equal(nn_list, brute_force_subset(query_embeddings, corpus_embeddings, allowed, 5))
+
+
+class TestIncrementalCorpusIndex:
+
+    def expected_search(self, embeddings_by_id, query_embeddings, k):
+        ids = list(embeddings_by_id)
+        _, nn_list = CorpusIndex.build(np.stack(list(embeddings_by_id.values()))).search(query_embeddings, k = k)
+        return [[ids[nn] for nn in row] for row in nn_list]
+
+    def test_add_and_remove(self, corpus_embeddings, query_embeddings):
+        ids = [f'article_{i}' for i in range(400)]
+        corpus_index = IncrementalCorpusIndex.build(corpus_embeddings[:400], ids)
+        corpus_index.add(corpus_embeddings[400:], [f'article_{i}' for i in range(400, 500)])
+        corpus_index.remove(['article_1', 'article_450'])
+
+        embeddings_by_id = {f'article_{i}': embedding for i, embedding in enumerate(corpus_embeddings)
+                            if i not in [1, 450]}
+        _, nn_list = corpus_index.search(query_embeddings, k = 5)
+
+        assert corpus_index.num_articles == 498
+        assert 'article_1' not in corpus_index and 'article_2' in corpus_index
+        assert corpus_index.lookup(nn_list) == self.expected_search(embeddings_by_id, query_embeddings, 5)
+        with pytest.raises(ValueError):
+            corpus_index.remove(['article_1'])
+
+    def test_adding_existing_id_replaces_article(self, corpus_embeddings, query_embeddings):
+        corpus_index = IncrementalCorpusIndex.build(corpus_embeddings[:100], range(100))
+        corpus_index.add(corpus_embeddings[200:201], [0])
+
+        _, nn_list = corpus_index.search(query_embeddings[:1], k = 1)
+        assert corpus_index.num_articles == 100
+        assert corpus_index.lookup(nn_list) != [[0]]
+        _, nn_list = corpus_index.search(corpus_embeddings[200:201], k = 1)
+        assert corpus_index.lookup(nn_list) == [[0]]
+
+    def test_save_writes_only_new_segments(self, tmp_path, corpus_embeddings, query_embeddings):
+        path = str(tmp_path / 'index')
+        IncrementalCorpusIndex.build(corpus_embeddings[:400], range(400), index_type = 'sq8').save(path)
+        base_mtime = os.path.getmtime(os.path.join(path, 'base_00000', 'index.faiss'))
+
+        corpus_index = IncrementalCorpusIndex.load(path)
+        corpus_index.add(corpus_embeddings[400:], range(400, 500))
+        corpus_index.remove([3])
+        corpus_index.save(path)
+
+        assert os.path.getmtime(os.path.join(path, 'base_00000', 'index.faiss')) == base_mtime
+        assert sorted(os.listdir(path)) == ['base_00000', 'segment_00001', 'shards.json']
+        corpus_index = IncrementalCorpusIndex.load(path)
+        _, nn_list = corpus_index.search(corpus_embeddings[[3, 4, 450]], k = 1)
+        assert corpus_index.lookup(nn_list)[1:] == [[4], [450]]
+        assert corpus_index.lookup(nn_list)[0] != [3]
+        assert corpus_index.num_articles == 499
+
+    def test_compact(self, tmp_path, corpus_embeddings, query_embeddings):
+        path = str(tmp_path / 'index')
+        metadata = {'year': list(range(400))}
+        corpus_index = IncrementalCorpusIndex.build(corpus_embeddings[:400], range(400), metadata = metadata,
+                                                    index_type = 'ivf_flat', nlist = 8)
+        corpus_index.add(corpus_embeddings[400:], range(400, 500), metadata = {'year': list(range(400, 500))})
+        corpus_index.remove(list(range(0, 400, 2)))
+        corpus_index.save(path)
+
+        assert not corpus_index.compact_if_needed(max_deleted_fraction = 0.5)
+        assert corpus_index.compact_if_needed()
+        corpus_index.save(path)
+
+        assert sorted(os.listdir(path)) == ['base_00001', 'shards.json']
+        corpus_index = IncrementalCorpusIndex.load(path)
+        assert len(corpus_index) == corpus_index.num_articles == 300
+        assert corpus_index.shards[0].corpus_index.metadata['year'].tolist() == corpus_index.lookup([range(300)])[0]
+        _, nn_list = corpus_index.search(corpus_embeddings[[1, 2, 499]], k = 1, nprobe = 8,
+                                         filters = {'year': (None, 450)})
+        assert corpus_index.lookup(nn_list)[0] == [1]
+        assert corpus_index.lookup(nn_list)[1] != [2]
+        assert corpus_index.lookup(nn_list)[2] != [499]
+
+    def test_add_checks_metadata(self, corpus_embeddings):
+        corpus_index = IncrementalCorpusIndex.build(corpus_embeddings[:10], range(10), metadata = {'year': range(10)})
+
+        with pytest.raises(ValueError):
+            corpus_index.add(corpus_embeddings[10:12], [10, 11])
+        with pytest.raises(ValueError):
+            corpus_index.add(corpus_embeddings[10:12], [10, 11], metadata = {'date': ['1860', '1861']})
+        with pytest.raises(ValueError):
+            corpus_index.add(corpus_embeddings[10:12], [10, 10], metadata = {'year': [10, 10]})
@@ -0,0 +1,197 @@
+'''
+Unit tests for search_same_story and its corpus caches. The NER and embedding models are replaced with cheap
+deterministic functions so that only the search and caching logic is exercised.
+'''
+
+import numpy as np
+import pytest
+
+import newsdejavu.ner_mask_embed_query as ner_mask_embed_query
+from newsdejavu import search_same_story, QueryCache
+from newsdejavu.utils.cache import corpus_fingerprint, load_embeddings, load_masked_sentences, save_masked_sentences
+
+
+corpus_sentences = ["Tesla, founded by Elon Musk, revolutionizes the electric vehicle market.",
+                    "The Paris Agreement aims to strengthen the global response to the threat of climate change.",
+                    "Roger Federer is known for his exceptional achievements in tennis."]
+
+query_sentences = ["The Paris Agreement aims to strengthen the global response to the threat of climate change."]
+
+
+@pytest.fixture
+def model_calls(monkeypatch, fake_embed):
+    calls = {'ner_and_mask': 0, 'embed': 0}
+
+    def fake_ner_and_mask(sentences, model_path, batch_size = 1, **kwargs):
+        calls['ner_and_mask'] += 1
+        return [sentence.lower() for sentence in sentences]
+
+    def counted_embed(*args, **kwargs):
+        calls['embed'] += 1
+        return fake_embed(*args, **kwargs)
+
+    monkeypatch.setattr(ner_mask_embed_query, 'ner_and_mask', fake_ner_and_mask)
+    monkeypatch.setattr(ner_mask_embed_query, 'embed', counted_embed)
+    return calls
+
+
+class TestCorpusCache:
+
+    def test_fingerprint(self):
+        assert corpus_fingerprint(['ab', 'c']) != corpus_fingerprint(['a', 'bc'])
+        assert corpus_fingerprint(corpus_sentences) == corpus_fingerprint(list(corpus_sentences))
+
+    def test_writes_then_reuses_cache(self, tmp_path, model_calls):
+        mask_path = str(tmp_path / 'masked.json')
+        embed_path = str(tmp_path / 'embeddings.npy')
+
+        first = search_same_story(query_sentences, corpus_sentences, 'ner', 'sbert',
+                                  corpus_ner_mask_path = mask_path, corpus_embed_path = embed_path)
+        assert model_calls == {'ner_and_mask': 2, 'embed': 2}
+        assert load_masked_sentences(mask_path) == [sentence.lower() for sentence in corpus_sentences]
+        assert load_embeddings(embed_path).shape == (3, 4)
+
+        second = search_same_story(query_sentences, corpus_sentences, 'ner', 'sbert',
+                                   corpus_ner_mask_path = mask_path, corpus_embed_path = embed_path)
+        # Only the queries are masked and embedded on the second run
+        assert model_calls == {'ner_and_mask': 3, 'embed': 3}
+        assert second[0]['neighbor_list'] == first[0]['neighbor_list'] == [corpus_sentences[1]]
+
+    def test_recomputes_after_interrupted_embeddings_save(self, tmp_path, model_calls):
+        embed_path = str(tmp_path / 'embeddings.npy')
+        # A crash between writing the .npy and its sidecar leaves the array without metadata
+        np.save(embed_path, np.zeros((3, 4), dtype = np.float32))
+
+        search_same_story(query_sentences, corpus_sentences, 'ner', 'sbert', corpus_embed_path = embed_path)
+        assert model_calls == {'ner_and_mask': 2, 'embed': 2}
+        assert np.abs(load_embeddings(embed_path)).sum() > 0
+
+    def test_mask_cache_only(self, tmp_path, model_calls):
+        mask_path = str(tmp_path / 'masked.json')
+        save_masked_sentences(mask_path, [sentence.lower() for sentence in corpus_sentences],
+                              {'ner_model': 'ner', 'corpus_fingerprint': corpus_fingerprint(corpus_sentences),
+                               'dedup_threshold': None, 'mask_options': {}})
+
+        search_same_story(query_sentences, corpus_sentences, 'ner', 'sbert', corpus_ner_mask_path = mask_path)
+        assert model_calls == {'ner_and_mask': 1, 'embed': 2}
+
+    def test_corpus_from_caches_only(self, tmp_path, model_calls):
+        embed_path = str(tmp_path / 'embeddings.npy')
+        with pytest.raises(ValueError, match = 'corpus_index or an existing cache'):
+            search_same_story(query_sentences, None, 'ner', 'sbert', corpus_embed_path = embed_path)
+
+        search_same_story(query_sentences, corpus_sentences, 'ner', 'sbert', corpus_embed_path = embed_path)
+        with pytest.raises(ValueError, match = 'corpus_id_map'):
+            search_same_story(query_sentences, None, 'ner', 'sbert', corpus_embed_path = embed_path)
+
+        results = search_same_story(query_sentences, None, 'ner', 'sbert', corpus_embed_path = embed_path,
+                                    corpus_id_map = dict(enumerate(corpus_sentences)))
+        assert results[0]['neighbor_list'] == [corpus_sentences[1]]
+
+    def test_rejects_cache_for_other_model(self, tmp_path, model_calls):
+        embed_path = str(tmp_path / 'embeddings.npy')
+        search_same_story(query_sentences, corpus_sentences, 'ner', 'sbert', corpus_embed_path = embed_path)
+
+        with pytest.raises(ValueError):
+            search_same_story(query_sentences, corpus_sentences, 'ner', 'other-sbert', corpus_embed_path = embed_path)
+
+    def test_rejects_cache_for_other_corpus(self, tmp_path, model_calls):
+        mask_path = str(tmp_path / 'masked.json')
+        search_same_story(query_sentences, corpus_sentences, 'ner', 'sbert', corpus_ner_mask_path = mask_path)
+
+        with pytest.raises(ValueError):
+            search_same_story(query_sentences, corpus_sentences[:2], 'ner', 'sbert', corpus_ner_mask_path = mask_path)
+
+    def test_rejects_cache_for_other_dedup_threshold(self, tmp_path, model_calls):
+        embed_path = str(tmp_path / 'embeddings.npy')
+        search_same_story(query_sentences, corpus_sentences, 'ner', 'sbert', corpus_embed_path = embed_path,
+                          dedup_threshold = 0.5)
+
+        # The cached embeddings hold one row per reprint cluster, not one per corpus sentence
+        with pytest.raises(ValueError):
+            search_same_story(query_sentences, corpus_sentences, 'ner', 'sbert', corpus_embed_path = embed_path)
+
+    def test_rejects_cache_without_recorded_settings(self, tmp_path, model_calls):
+        mask_path = str(tmp_path / 'masked.json')
+        save_masked_sentences(mask_path, [sentence.lower() for sentence in corpus_sentences],
+                              {'ner_model': 'ner', 'corpus_fingerprint': corpus_fingerprint(corpus_sentences)})
+
+        with pytest.raises(ValueError):
+            search_same_story(query_sentences, corpus_sentences, 'ner', 'sbert', corpus_ner_mask_path = mask_path)
+
+    def test_rejects_cache_for_other_mask_options(self, tmp_path, model_calls):
+        mask_path = str(tmp_path / 'masked.json')
+        embed_path = str(tmp_path / 'embeddings.npy')
+        mask_options = {'labels_to_mask': ('PER', 'ORG'), 'all_masks_same': False}
+        search_same_story(query_sentences, corpus_sentences, 'ner', 'sbert', corpus_ner_mask_path = mask_path,
+                          corpus_embed_path = embed_path, mask_options = mask_options)
+
+        # The same options are read back from the cache, even with tuples turned into lists
+        search_same_story(query_sentences, corpus_sentences, 'ner', 'sbert', corpus_ner_mask_path = mask_path,
+                          corpus_embed_path = embed_path, mask_options = mask_options)
+        assert model_calls['embed'] == 3
+
+        with pytest.raises(ValueError):
+            search_same_story(query_sentences, corpus_sentences, 'ner', 'sbert', corpus_embed_path = embed_path)
+        with pytest.raises(ValueError):
+            search_same_story(query_sentences, corpus_sentences, 'ner', 'sbert', corpus_ner_mask_path = mask_path)
+
+    def test_query_cache(self, model_calls):
+        query_cache = QueryCache()
+        first = search_same_story(query_sentences, corpus_sentences, 'ner', 'sbert', query_cache = query_cache)
+        second = search_same_story(query_sentences, corpus_sentences, 'ner', 'sbert', query_cache = query_cache)
+
+        # The corpus is masked and embedded on both runs, the query only on the first
+        assert model_calls == {'ner_and_mask': 3, 'embed': 3}
+        assert second[0]['neighbor_list'] == first[0]['neighbor_list'] == [corpus_sentences[1]]
+        assert query_cache.stats()['masked_texts']['hits'] == 1
+
+    def test_mask_options_are_part_of_the_cache_keys(self, tmp_path, model_calls):
+        query_cache = QueryCache()
+        mask_path = str(tmp_path / 'masked.json')
+        search_same_story(query_sentences, corpus_sentences, 'ner', 'sbert', corpus_ner_mask_path = mask_path,
+                          query_cache = query_cache)
+        search_same_story(query_sentences, corpus_sentences, 'ner', 'sbert', query_cache = query_cache,
+                          mask_options = {'labels_to_mask': ['PER']})
+
+        assert query_cache.stats()['masked_texts']['hits'] == 0
+        assert query_cache.stats()['masked_texts']['misses'] == 2
+        with pytest.raises(ValueError):
+            search_same_story(query_sentences, corpus_sentences, 'ner', 'sbert', corpus_ner_mask_path = mask_path,
+                              mask_options = {'labels_to_mask': ['PER']})
+
+
+class TestReprintDedup:
+
+    def test_embeds_each_reprint_once(self, monkeypatch, fake_embed):
+        def fake_ner_and_mask(sentences, model_path, batch_size = 1, **kwargs):
+            return list(sentences)
+
+        monkeypatch.setattr(ner_mask_embed_query, 'ner_and_mask', fake_ner_and_mask)
+        fake_embed.install(ner_mask_embed_query)
+
+        reprinted_corpus = [corpus_sentences[1], corpus_sentences[0], corpus_sentences[1].upper(),
+                            corpus_sentences[2], corpus_sentences[1].replace('-', ' ') + ' (Reprint)']
+        results = search_same_story(query_sentences, reprinted_corpus, 'ner', 'sbert', k = 3, dedup_threshold = 0.5,
+                                    corpus_metadata = {'page': [1, 2, 3, 4, 5]}, filters = {'page': (None, 4)})
+
+        assert fake_embed.calls[0] == [corpus_sentences[1], corpus_sentences[0], corpus_sentences[2]]
+        assert results[0]['neighbor_list'][0] == corpus_sentences[1]
+        # The reprint on page 5 is filtered out, and not counted
+        assert results[0]['reprint_count_list'][0] == 2
+        assert sorted(results[0]['reprint_count_list']) == [1, 1, 2]
+
+    def test_filters_match_any_reprint(self, model_calls):
+        reprinted_corpus = [corpus_sentences[1], corpus_sentences[0], corpus_sentences[1].upper(),
+                            corpus_sentences[2], corpus_sentences[1].replace('-', ' ') + ' (Reprint)']
+        results = search_same_story(query_sentences, reprinted_corpus, 'ner', 'sbert', k = 3, dedup_threshold = 0.5,
+                                    corpus_metadata = {'page': [1, 2, 3, 4, 5]}, filters = {'page': [3, 4, 5]})
+
+        # The cluster's first printing is on page 1, but its reprints on pages 3 and 5 match
+        assert results[0]['neighbor_list'] == [reprinted_corpus[2], corpus_sentences[2]]
+        assert results[0]['reprint_count_list'] == [2, 1]
+
+    def test_dedup_needs_corpus_sentences(self, tmp_path, model_calls):
+        with pytest.raises(ValueError):
+            search_same_story(query_sentences, None, 'ner', 'sbert', dedup_threshold = 0.5,
+                              corpus_embed_path = str(tmp_path / 'embeddings.npy'))
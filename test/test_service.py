@@ -0,0 +1,222 @@
+'''
+Unit tests for the search service. NER and embedding are replaced with cheap deterministic functions so that only the
+batching, protocol and metrics logic is exercised.
+'''
+
+import json
+import asyncio
+import importlib
+
+import pytest
+
+from newsdejavu import SearchService, serve, CorpusIndex, ShardedCorpusIndex, QueryCache
+from newsdejavu.service import load_corpus_index
+
+server = importlib.import_module('newsdejavu.service.server')
+
+
+corpus_sentences = ["Tesla, founded by Elon Musk, revolutionizes the electric vehicle market.",
+                    "The Paris Agreement aims to strengthen the global response to the threat of climate change.",
+                    "Roger Federer is known for his exceptional achievements in tennis."]
+
+
+@pytest.fixture
+def batches(monkeypatch, fake_embed):
+    batches = []
+
+    def fake_ner_and_mask(sentences, model_path, batch_size = 1, **kwargs):
+        batches.append(list(sentences))
+        return [sentence.lower() for sentence in sentences]
+
+    monkeypatch.setattr(server, 'ner_and_mask', fake_ner_and_mask)
+    fake_embed.install(server)
+    return batches
+
+
+@pytest.fixture
+def corpus_index(fake_embed):
+    return CorpusIndex.build(fake_embed.embeddings([sentence.lower() for sentence in corpus_sentences]),
+                             id_map = dict(enumerate(corpus_sentences)), metadata = {'year': [1850, 1851, 1852]})
+
+
+class TestSearchService:
+
+    def test_coalesces_concurrent_queries(self, batches, corpus_index):
+        async def run():
+            service = SearchService('ner', 'sbert', corpus_index, batch_window_ms = 50)
+            results = await asyncio.gather(*[service.search(sentence, k = 2) for sentence in corpus_sentences])
+            metrics = service.metrics_snapshot()
+            await service.stop()
+            return results, metrics
+
+        results, metrics = asyncio.run(run())
+
+        assert batches == [corpus_sentences]
+        for sentence, result in zip(corpus_sentences, results):
+            assert result['query'] == sentence
+            assert result['neighbor_list'][0] == sentence
+            assert len(result['distance_list']) == 2
+        assert metrics['requests'] == 3
+        assert metrics['batches'] == 1
+        assert metrics['mean_batch_size'] == 3
+        assert metrics['queue_depth'] == 0
+        assert metrics['max_queue_depth'] >= 1
+        assert metrics['latency_p99_ms'] >= metrics['latency_p50_ms'] > 0
+
+    def test_batch_size_limit_and_filters(self, batches, corpus_index):
+        async def run():
+            service = SearchService('ner', 'sbert', corpus_index, batch_window_ms = 50, max_batch_size = 2)
+            results = await asyncio.gather(service.search(corpus_sentences[1], k = 1),
+                                           service.search(corpus_sentences[1], k = 3, filters = {'year': [1850, 1852]}),
+                                           service.search(corpus_sentences[2], k = 1))
+            await service.stop()
+            return results
+
+        results = asyncio.run(run())
+
+        assert [len(batch) for batch in batches] == [2, 1]
+        assert results[0]['neighbor_list'] == [corpus_sentences[1]]
+        assert sorted(results[1]['neighbor_list']) == sorted([corpus_sentences[0], corpus_sentences[2]])
+        assert results[2]['neighbor_list'] == [corpus_sentences[2]]
+
+    def test_errors_reach_every_query_of_the_batch(self, batches, corpus_index):
+        async def run():
+            service = SearchService('ner', 'sbert', corpus_index, batch_window_ms = 50)
+            results = await asyncio.gather(service.search(corpus_sentences[0], filters = {'missing': 1}),
+                                           service.search(corpus_sentences[1], filters = {'missing': 1}),
+                                           return_exceptions = True)
+            await service.stop()
+            return results, service.metrics_snapshot()
+
+        results, metrics = asyncio.run(run())
+
+        assert all(isinstance(result, ValueError) for result in results)
+        assert metrics['errors'] == 2
+
+    def test_errors_only_reach_the_failing_filters(self, batches, corpus_index):
+        async def run():
+            service = SearchService('ner', 'sbert', corpus_index, batch_window_ms = 50)
+            results = await asyncio.gather(service.search(corpus_sentences[0]),
+                                           service.search(corpus_sentences[1], filters = {'page': 1}),
+                                           service.search(corpus_sentences[2], filters = {'year': 1852}),
+                                           return_exceptions = True)
+            await service.stop()
+            return results, service.metrics_snapshot()
+
+        results, metrics = asyncio.run(run())
+
+        assert len(batches) == 1
+        assert results[0]['neighbor_list'] == [corpus_sentences[0]]
+        assert isinstance(results[1], ValueError)
+        assert results[2]['neighbor_list'] == [corpus_sentences[2]]
+        assert metrics['errors'] == 1
+
+    def test_ranges_and_value_lists_are_not_mixed_up(self, batches, corpus_index):
+        async def run():
+            service = SearchService('ner', 'sbert', corpus_index, batch_window_ms = 50)
+            results = await asyncio.gather(service.search(corpus_sentences[1], k = 3, filters = {'year': (1850, 1852)}),
+                                           service.search(corpus_sentences[1], k = 3, filters = {'year': [1850, 1852]}))
+            await service.stop()
+            return results
+
+        results = asyncio.run(run())
+
+        assert len(batches) == 1
+        assert sorted(results[0]['neighbor_list']) == sorted(corpus_sentences)
+        assert sorted(results[1]['neighbor_list']) == sorted([corpus_sentences[0], corpus_sentences[2]])
+
+    def test_restarts_after_stop(self, batches, corpus_index):
+        async def run():
+            service = SearchService('ner', 'sbert', corpus_index, batch_window_ms = 1)
+            first = await service.search(corpus_sentences[0])
+            await service.stop()
+            second = await service.search(corpus_sentences[0])
+            await service.stop()
+            return first, second
+
+        first, second = asyncio.run(run())
+
+        assert second == first
+
+    def test_query_cache(self, batches, corpus_index):
+        async def run():
+            service = SearchService('ner', 'sbert', corpus_index, batch_window_ms = 1, query_cache = QueryCache())
+            first = await service.search(corpus_sentences[0])
+            second = await asyncio.gather(service.search(corpus_sentences[0]), service.search(corpus_sentences[1]))
+            await service.stop()
+            return first, second, service.metrics_snapshot()
+
+        first, second, metrics = asyncio.run(run())
+
+        assert batches == [[corpus_sentences[0]], [corpus_sentences[1]]]
+        assert second[0] == first
+        assert metrics['query_cache']['masked_texts']['hits'] == 1
+        assert metrics['query_cache']['masked_texts']['misses'] == 2
+
+    def test_mask_options(self, monkeypatch, fake_embed, corpus_index):
+        mask_calls = []
+
+        def fake_ner_and_mask(sentences, model_path, batch_size = 1, **kwargs):
+            mask_calls.append(kwargs)
+            return [sentence.lower() for sentence in sentences]
+
+        monkeypatch.setattr(server, 'ner_and_mask', fake_ner_and_mask)
+        fake_embed.install(server)
+
+        async def run(service):
+            result = await service.search(corpus_sentences[0])
+            await service.stop()
+            return result
+
+        query_cache = QueryCache()
+        asyncio.run(run(SearchService('ner', 'sbert', corpus_index, query_cache = query_cache,
+                                      mask_options = {'labels_to_mask': ['PER']})))
+        asyncio.run(run(SearchService('ner', 'sbert', corpus_index, query_cache = query_cache)))
+
+        # Queries masked with other options are masked again
+        assert mask_calls == [{'labels_to_mask': ['PER']}, {}]
+        assert query_cache.stats()['masked_texts']['hits'] == 0
+
+    def test_json_lines_protocol(self, batches, corpus_index, tmp_path):
+        async def run():
+            service = SearchService('ner', 'sbert', corpus_index, batch_window_ms = 20)
+            socket_server = await serve(service, path = str(tmp_path / 'search.sock'))
+            reader, writer = await asyncio.open_unix_connection(str(tmp_path / 'search.sock'))
+
+            requests = [{'id': i, 'query': sentence, 'k': 1} for i, sentence in enumerate(corpus_sentences)]
+            requests.append({'id': 'bad'})
+            requests.append({'id': 'range', 'query': corpus_sentences[0], 'k': 3,
+                             'filters': {'year': {'range': [1851, 1852]}}})
+            requests.append({'id': 'bad range', 'query': corpus_sentences[0], 'filters': {'year': {'from': 1851}}})
+            for request in requests:
+                writer.write(json.dumps(request).encode('utf-8') + b'\n')
+            await writer.drain()
+            responses = [json.loads(await reader.readline()) for _ in requests]
+
+            writer.write(json.dumps({'id': 'm', 'metrics': True}).encode('utf-8') + b'\n')
+            await writer.drain()
+            metrics = json.loads(await reader.readline())
+
+            writer.close()
+            socket_server.close()
+            await socket_server.wait_closed()
+            await service.stop()
+            return responses, metrics
+
+        responses, metrics = asyncio.run(run())
+
+        responses = {response['id']: response for response in responses}
+        for i, sentence in enumerate(corpus_sentences):
+            assert responses[i]['neighbor_list'] == [sentence]
+        assert 'error' in responses['bad']
+        assert sorted(responses['range']['neighbor_list']) == sorted(corpus_sentences[1:])
+        assert responses['bad range']['error'].startswith('ValueError')
+        assert metrics['id'] == 'm'
+        assert metrics['metrics']['requests'] == 4
+
+    def test_load_corpus_index(self, corpus_index, tmp_path):
+        corpus_index.save(str(tmp_path / 'single'))
+        ShardedCorpusIndex({'1850s': corpus_index}).save(str(tmp_path / 'sharded'))
+
+        assert isinstance(load_corpus_index(str(tmp_path / 'single')), CorpusIndex)
+        assert isinstance(load_corpus_index(str(tmp_path / 'sharded')), ShardedCorpusIndex)
@@ -0,0 +1,277 @@
+'''
+Unit tests for utility functions.
+'''
+
+import numpy as np
+import pytest
+import torch
+
+from datasets import Dataset
+
+from newsdejavu.utils import clean_ocr_text, clean_ocr_texts, get_dataset
+from newsdejavu.utils.clean_text import clean_ocr_dataset, OCR_ERROR_CHARACTERS
+from newsdejavu.utils.prefetch import prefetch
+from newsdejavu.utils.batching import token_budget_batches
+from newsdejavu.utils.query_cache import LRUCache, QueryCache
+
+
+class TestTokenBudgetBatches:
+
+    def test_batches_by_length(self):
+        lengths = [10, 200, 12, 11, 190, 9]
+        batches = token_budget_batches(lengths, max_batch_tokens = 400)
+
+        assert batches == [[5, 0, 3, 2], [4, 1]]
+        assert all(len(batch) * max(lengths[i] for i in batch) <= 400 for batch in batches)
+
+    def test_covers_every_index_once(self):
+        lengths = np.random.default_rng(0).integers(1, 512, size = 1000)
+        batches = token_budget_batches(lengths, max_batch_tokens = 4096, max_batch_size = 64)
+
+        assert sorted(i for batch in batches for i in batch) == list(range(1000))
+        assert max(len(batch) for batch in batches) <= 64
+
+    def test_oversized_item_gets_own_batch(self):
+        assert token_budget_batches([1000, 5, 5], max_batch_tokens = 100) == [[1, 2], [0]]
+
+
+def reference_clean_ocr_text(text, basic, remove_list):
+    """The original quadratic implementation of clean_ocr_text, kept to check the rewrite gives identical output."""
+    cleaned_text = text.replace("-\n", "")
+    if not basic:
+      cleaned_text = cleaned_text.replace("é", "e").replace("ï", "i").replace("ﬁ", "fi").replace("ﬂ", "fl")
+      cleaned_text = cleaned_text.translate({ord(x): '' for x in remove_list})
+
+    z = 0
+    while z < (len(cleaned_text)-1):
+          if cleaned_text[z] == "\n" and cleaned_text[z+1] == "\n":
+              z += 2
+          elif cleaned_text[z] == "\n" and cleaned_text[z+1] != "\n":
+              temp = list(cleaned_text)
+              temp[z] = " "
+              cleaned_text = "".join(temp)
+              z += 1
+          else:
+              z += 1
+    if cleaned_text[len(cleaned_text)-1] == "\n" and cleaned_text[len(cleaned_text)-2] != "\n":
+      temp = list(cleaned_text)
+      temp[len(cleaned_text)-1] = " "
+      cleaned_text = "".join(temp)
+
+    offsets = []
+    cur_offset = 0
+    i = 0
+
+    while i < len(text):
+      if i+1 < len(text) and text[i:i+2] == '-\n':
+        offsets.extend([cur_offset, cur_offset + 1])
+        cur_offset += 2
+        i += 2
+      else:
+        offsets.append(cur_offset)
+        i += 1
+
+    if not basic:
+      for j in range(len(text)):
+        if text[j] == "ﬁ" or text[j] == "ﬂ":
+            for a in range(j+1,len(text)):
+                offsets[a] = offsets[a] - 1
+        elif text[j] in remove_list:
+            for a in range(j+1,len(text)):
+                offsets[a] = offsets[a] + 1
+        else:
+            j += 1
+
+    return cleaned_text, offsets
+
+
+class TestCleanOCRText:
+
+    remove_list = ["#", "/", "*", "@", "~", "¢", "©", "®", "°", "-"]
+
+    def random_texts(self, count, max_length = 40):
+        rng = np.random.default_rng(0)
+        alphabet = list("ab -\n#*éïﬁﬂ°")
+        return [''.join(rng.choice(alphabet, size = rng.integers(1, max_length))) for _ in range(count)]
+
+    @pytest.mark.parametrize('basic', [True, False])
+    def test_matches_reference(self, basic):
+        for text in self.random_texts(2000) + ["\n", "a\n", "a\n\n\n", "\n\n\na", "co-\noperation\nof ﬁve"]:
+            try:
+                expected = reference_clean_ocr_text(text, basic, self.remove_list)
+            except IndexError:
+                # The original implementation fails on texts that are empty after cleaning
+                continue
+            assert clean_ocr_text(text, basic, self.remove_list) == expected, repr(text)
+
+    def test_offset_array(self):
+        text = "co-\noperation\nof ﬁve #1"
+        cleaned_text, offsets = clean_ocr_text(text, False, self.remove_list, return_array = True)
+
+        assert offsets.dtype == np.int32
+        assert offsets.tolist() == reference_clean_ocr_text(text, False, self.remove_list)[1]
+
+    def test_batch(self):
+        texts = self.random_texts(50)
+        cleaned_texts, offsets = clean_ocr_texts(texts, False, self.remove_list)
+        assert (cleaned_texts, offsets) == tuple(map(list, zip(*[clean_ocr_text(t, False, self.remove_list) for t in texts])))
+
+        assert clean_ocr_texts(texts, False, self.remove_list, with_offsets = False) == (cleaned_texts, None)
+
+
+class TestCleanOCRDataset:
+
+    @pytest.mark.parametrize('num_proc', [None, 2])
+    def test_matches_clean_ocr_texts(self, num_proc):
+        articles = TestCleanOCRText().random_texts(100)
+        dataset = Dataset.from_dict({'article': articles, 'article_id': list(range(100))})
+
+        cleaned = clean_ocr_dataset(dataset, num_proc = num_proc, batch_size = 16)
+
+        assert list(cleaned['article']) == clean_ocr_texts(articles, True, OCR_ERROR_CHARACTERS, with_offsets = False)[0]
+        assert list(cleaned['article_id']) == list(range(100))
+
+    def test_reuses_arrow_cache(self, tmp_path):
+        Dataset.from_dict({'article': ['co-\noperation\nof ﬁve'] * 10}).to_json(str(tmp_path / 'dataset.json'))
+        from datasets import load_dataset
+        dataset = load_dataset('json', data_files = str(tmp_path / 'dataset.json'), cache_dir = str(tmp_path / 'cache'))['train']
+
+        first = clean_ocr_dataset(dataset)
+        second = clean_ocr_dataset(dataset)
+
+        assert first.cache_files and first.cache_files == second.cache_files
+
+
+class TestPrefetch:
+
+    def test_keeps_order(self):
+        assert list(prefetch(iter(range(100)), buffer_size = 3)) == list(range(100))
+
+    def test_raises_producer_errors(self):
+        def produce():
+            yield 1
+            raise RuntimeError('failed')
+
+        items = prefetch(produce())
+        assert next(items) == 1
+        with pytest.raises(RuntimeError):
+            next(items)
+
+    def test_stops_early(self):
+        items = prefetch(iter(range(1000000)))
+        assert next(items) == 0
+        items.close()
+
+
+class TestGetDataset:
+
+    def write_corpus(self, directory):
+        articles = [f'article {i}' for i in range(6)]
+        (directory / 'texts').mkdir()
+        for i, article in enumerate(articles[:2]):
+            (directory / 'texts' / f'{i}.txt').write_text(article)
+        Dataset.from_dict({'article': articles[2:4], 'date': ['1840-01-01'] * 2}).to_json(str(directory / 'dataset_1840.json'))
+        Dataset.from_dict({'article': articles[4:], 'date': ['1841-01-01'] * 2}).to_parquet(str(directory / 'dataset_1841.parquet'))
+        (directory / 'README.md').write_text('not an article')
+
+        return articles
+
+    def test_directory(self, tmp_path):
+        articles = self.write_corpus(tmp_path)
+
+        dataset = get_dataset(str(tmp_path), columns = ['article'])
+
+        assert dataset.column_names == ['article']
+        assert sorted(dataset['article']) == articles
+
+    def test_file_paths(self, tmp_path):
+        self.write_corpus(tmp_path)
+
+        dataset = get_dataset([str(tmp_path / 'dataset_1840.json'), str(tmp_path / 'dataset_1841.parquet')])
+
+        assert list(dataset['article']) == ['article 2', 'article 3', 'article 4', 'article 5']
+        assert dataset.column_names == ['article', 'date']
+        assert get_dataset(str(tmp_path / 'dataset_1841.parquet'), columns = ['date'])['date'] == ['1841-01-01'] * 2
+
+    def test_texts_are_not_file_paths(self):
+        texts = ['Some article text.'] * 1000
+
+        assert list(get_dataset(texts)['article']) == texts
+        assert get_dataset([{'article': 'text'}])['article'] == ['text']
+
+    def test_rejects_unsupported_files(self, tmp_path):
+        (tmp_path / 'articles.csv').write_text('article\ntext')
+
+        with pytest.raises(ValueError):
+            get_dataset([str(tmp_path / 'articles.csv')])
+
+
+class TestQueryCache:
+
+    def test_lru_eviction_and_ttl(self):
+        now = [0.0]
+        cache = LRUCache(max_size = 2, ttl = 10, clock = lambda: now[0])
+        cache.put('a', 1)
+        cache.put('b', 2)
+        assert cache.get('a') == 1
+        cache.put('c', 3)
+
+        assert cache.get('b') is None
+        assert cache.get('c') == 3
+        now[0] = 11
+        assert cache.get('a') is None
+        assert cache.stats() == {'size': 1, 'max_size': 2, 'hits': 2, 'misses': 2, 'hit_rate': 0.5, 'evictions': 1,
+                                 'expirations': 1}
+
+    def test_skips_cached_queries(self):
+        masked, embedded = [], []
+
+        def mask_function(queries):
+            masked.extend(queries)
+            return [query.split(' ', 1)[1] for query in queries]
+
+        def embed_function(texts):
+            embedded.extend(texts)
+            return np.array([[len(text), 1.0] for text in texts])
+
+        cache = QueryCache(max_size = 10)
+        first = cache.mask_and_embed(['Lincoln wins election', 'Douglas wins election'], 'ner', 'sbert',
+                                     mask_function, embed_function)
+        second = cache.mask_and_embed(['Douglas wins election', 'Lincoln wins election', 'Grant wins election'],
+                                      'ner', 'sbert', mask_function, embed_function)
+
+        assert first[0] == ['wins election', 'wins election']
+        assert second[1].dtype == np.float32 and second[1].shape == (3, 2)
+        assert masked == ['Lincoln wins election', 'Douglas wins election', 'Grant wins election']
+        # Queries masking to the same text share one embedding
+        assert embedded == ['wins election']
+        assert cache.stats()['masked_texts']['hits'] == 2
+        assert cache.stats()['embeddings']['hits'] == 3
+
+        cache.mask_and_embed(['Lincoln wins election'], 'other-ner', 'sbert', mask_function, embed_function)
+        cache.mask_and_embed(['Lincoln wins election'], 'ner', 'sbert', mask_function, embed_function,
+                             mask_options = {'all_masks_same': False})
+        assert masked[3:] == ['Lincoln wins election', 'Lincoln wins election']
+
+    def test_backends_and_dtypes_are_cached_apart(self):
+        masked, embedded = [], []
+
+        def mask_function(queries):
+            masked.extend(queries)
+            return [query.lower() for query in queries]
+
+        def embed_function(texts):
+            embedded.extend(texts)
+            return np.array([[len(text), 1.0] for text in texts])
+
+        cache = QueryCache(max_size = 10)
+        for backend, torch_dtype in [('torch', None), ('onnx', None), ('onnx-int8', None), ('torch', torch.float16),
+                                     ('torch', torch.float32)]:
+            cache.mask_and_embed(['Lincoln wins election'], 'ner', 'sbert', mask_function, embed_function,
+                                 torch_dtype = torch_dtype, backend = backend)
+        cache.mask_and_embed(['Lincoln wins election'], 'ner', 'sbert', mask_function, embed_function,
+                             mask_options = {'backend': 'onnx'})
+
+        # float32 is the default dtype, and the NER backend only changes the masked text key
+        assert len(embedded) == 4
+        assert len(masked) == 2